@@ -0,0 +1,179 @@
+"""Генератор синтетического архива DICOM для бенчмарков.
+
+Файлы: `<root>/P000001/ST01/SE01/IM00001.dcm` — пациенты, исследования, серии и
+срезы в заданном количестве, transfer syntax по сериям по кругу из списка.
+Всё детерминировано: одинаковые параметры и seed дают одинаковые UID, имена
+и пиксели, поэтому результаты разных версий сравнимы.
+
+Для поиска на миллионах экземпляров файлы не нужны: `populate_index`
+пишет те же синтетические записи прямо в индекс (BatchWriter), без диска.
+
+Запуск: python -m benchmarks.generate /tmp/bench/data --patients 10 --instances 40
+"""
+import argparse, random, time
+from pathlib import Path
+from typing import Iterator, NamedTuple
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.encaps import encapsulate
+from pydicom.uid import (ExplicitVRLittleEndian, ImplicitVRLittleEndian, RLELossless, JPEGBaseline8Bit,
+                         CTImageStorage, PYDICOM_IMPLEMENTATION_UID)
+
+# меняется вместе с содержимым файлов — сгенерированное прежней версией дерево не переиспользуется
+GENERATOR_VERSION = 2
+# корень UID бенчмарка: <корень>.<пациент>.<исследование>.<серия>.<срез>
+UID_ROOT = "1.2.826.0.1.3680043.8.498.77"
+SYNTAXES = {
+    "explicit": ExplicitVRLittleEndian,
+    "implicit": ImplicitVRLittleEndian,
+    "rle": RLELossless,
+    # содержимое кадров — случайные байты размером с типичный JPEG (1:8): для индексатора
+    # и упаковщика важны заголовок и несжимаемость, декодировать их никто не будет
+    "jpeg": JPEGBaseline8Bit,
+}
+_SURNAMES = ["Иванов", "Петров", "Сидоров", "Кузнецов", "Смирнов", "Попов", "Васильев", "Соколов", "Михайлов",
+             "Новиков", "Фёдоров", "Морозов", "Волков", "Алексеев", "Лебедев", "Семёнов", "Егоров", "Павлов"]
+_GIVEN = ["Иван", "Пётр", "Сергей", "Алексей", "Дмитрий", "Андрей", "Николай", "Михаил", "Олег", "Юрий"]
+_PATRONYMIC = ["Иванович", "Петрович", "Сергеевич", "Алексеевич", "Дмитриевич", "Андреевич", "Николаевич"]
+
+class Patient(NamedTuple):
+    patient_id: str
+    name: str          # DICOM PN: Фамилия^Имя^Отчество
+    birth_date: str
+    sex: str
+
+class Layout(NamedTuple):
+    patients: int = 10
+    studies: int = 2     # на пациента
+    series: int = 3      # на исследование
+    instances: int = 40  # на серию
+
+    @property
+    def total(self) -> int:
+        return self.patients * self.studies * self.series * self.instances
+
+def patients(n: int, seed: int = 0) -> list[Patient]:
+    rnd = random.Random(seed)
+    out = []
+    for p in range(1, n + 1):
+        sex = rnd.choice("MF")
+        surname, given, patr = rnd.choice(_SURNAMES), rnd.choice(_GIVEN), rnd.choice(_PATRONYMIC)
+        if sex == "F":
+            # Иванов -> Иванова, Иванович -> Ивановна; имя оставляем — поиску это не важно
+            surname, patr = surname + "а", patr[:-2] + "на"
+        dob = f"{rnd.randint(1930, 2015):04d}{rnd.randint(1, 12):02d}{rnd.randint(1, 28):02d}"
+        out.append(Patient(f"BENCH{p:07d}", f"{surname}^{given}^{patr}", dob, sex))
+    return out
+
+def study_date(p: int, st: int) -> str:
+    return f"{2015 + (p + st) % 10:04d}{(p * 7 + st) % 12 + 1:02d}{(p + st * 3) % 28 + 1:02d}"
+
+def series_syntax(layout: Layout, syntaxes: list[str], p: int, st: int, se: int) -> str:
+    """Transfer syntax серии (p, st, se — с единицы): по кругу из syntaxes в порядке генерации."""
+    n = ((p - 1) * layout.studies + (st - 1)) * layout.series + (se - 1)
+    return SYNTAXES[syntaxes[n % len(syntaxes)]]
+
+def uid(*parts: int) -> str:
+    return ".".join((UID_ROOT, *map(str, parts)))
+
+def _frame(rows: int, cols: int, k: int, rnd: np.random.Generator) -> np.ndarray:
+    # «фантом»: плавный градиент с кругом, смещённым по номеру среза, и шумом — сжимается как КТ
+    y, x = np.mgrid[0:rows, 0:cols]
+    img = 400 + (x + y) * 600 // (rows + cols)
+    cy, cx, r = rows / 2, cols / 2 + (k % 16) - 8, min(rows, cols) / 3
+    img = img + ((y - cy) ** 2 + (x - cx) ** 2 < r * r) * 800
+    return (img + rnd.integers(0, 24, size=(rows, cols))).astype(np.uint16)
+
+def _template(pat: Patient, p: int, st: int, se: int, rows: int, cols: int) -> Dataset:
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = CTImageStorage
+    ds.file_meta.ImplementationClassUID = PYDICOM_IMPLEMENTATION_UID
+    ds.SpecificCharacterSet = "ISO_IR 192"  # UTF-8: ФИО кириллицей
+    ds.SOPClassUID = CTImageStorage
+    ds.PatientName, ds.PatientID, ds.PatientBirthDate, ds.PatientSex = pat.name, pat.patient_id, pat.birth_date, pat.sex
+    ds.StudyInstanceUID, ds.SeriesInstanceUID = uid(p, st), uid(p, st, se)
+    ds.StudyDate, ds.StudyTime, ds.StudyID = study_date(p, st), "120000", str(st)
+    ds.Modality, ds.SeriesNumber = "CT", se
+    ds.Rows, ds.Columns, ds.SamplesPerPixel = rows, cols, 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 12, 11, 0
+    return ds
+
+def generate(root: Path, layout: Layout = Layout(), syntaxes: list[str] = ("explicit",), rows: int = 128,
+             cols: int = 128, seed: int = 0) -> Iterator[tuple[Path, str]]:
+    """Записать дерево файлов; отдавать (путь, transfer syntax) по мере записи."""
+    rnd = np.random.default_rng(seed)
+    for p, pat in enumerate(patients(layout.patients, seed), 1):
+        for st in range(1, layout.studies + 1):
+            for se in range(1, layout.series + 1):
+                ts = series_syntax(layout, syntaxes, p, st, se)
+                d = root / f"P{p:06d}" / f"ST{st:02d}" / f"SE{se:02d}"
+                d.mkdir(parents=True, exist_ok=True)
+                ds = _template(pat, p, st, se, rows, cols)
+                ds.file_meta.TransferSyntaxUID = ts
+                for i in range(1, layout.instances + 1):
+                    sop = uid(p, st, se, i)
+                    ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID = sop
+                    ds.InstanceNumber = i
+                    ds.ImagePositionPatient = [0, 0, i * 1.25]
+                    if ts == RLELossless:
+                        # кодер RLE в pydicom на чистом Python: ~30 мс на кадр 256x256
+                        ds.compress(RLELossless, _frame(rows, cols, i, rnd), generate_instance_uid=False)
+                    elif ts == JPEGBaseline8Bit:
+                        ds.PixelData = encapsulate([rnd.bytes(rows * cols * 2 // 8)])
+                        ds["PixelData"].VR = "OB"
+                    else:
+                        ds.PixelData = _frame(rows, cols, i, rnd).tobytes()
+                        ds["PixelData"].VR = "OW"
+                    path = d / f"IM{i:05d}.dcm"
+                    ds.save_as(path, implicit_vr=ts.is_implicit_VR, little_endian=True, enforce_file_format=True)
+                    yield path, ts
+
+def populate_index(layout: Layout, seed: int = 0, batch: int = 5000, modality: str = "CT") -> int:
+    """Записать синтетические экземпляры прямо в индекс текущей БД (DB_URL); вернуть сколько."""
+    from server.bulk import BatchWriter, HeaderRecord
+    from server.db import SessionLocal
+    writer = BatchWriter(SessionLocal)
+    records: list[HeaderRecord] = []
+    n = 0
+    size = 512 * 512 * 2 + 1024
+    for p, pat in enumerate(patients(layout.patients, seed), 1):
+        for st in range(1, layout.studies + 1):
+            for se in range(1, layout.series + 1):
+                for i in range(1, layout.instances + 1):
+                    records.append(HeaderRecord(
+                        f"/bench/P{p:06d}/ST{st:02d}/SE{se:02d}/IM{i:05d}.dcm", size, uid(p, st), uid(p, st, se),
+                        uid(p, st, se, i), pat.patient_id, pat.name, pat.birth_date, pat.sex, study_date(p, st),
+                        modality, ExplicitVRLittleEndian))
+                    if len(records) >= batch:
+                        writer.write(records)
+                        n += len(records)
+                        records = []
+    if records:
+        writer.write(records)
+        n += len(records)
+    return n
+
+def main():
+    ap = argparse.ArgumentParser(description="Синтетический архив DICOM для бенчмарков")
+    ap.add_argument("root", type=Path, help="куда писать файлы")
+    ap.add_argument("--patients", type=int, default=10)
+    ap.add_argument("--studies", type=int, default=2, help="исследований на пациента")
+    ap.add_argument("--series", type=int, default=3, help="серий на исследование")
+    ap.add_argument("--instances", type=int, default=40, help="срезов на серию")
+    ap.add_argument("--syntaxes", default="explicit", help=f"по сериям по кругу: {','.join(SYNTAXES)}")
+    ap.add_argument("--rows", type=int, default=128)
+    ap.add_argument("--cols", type=int, default=128)
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+    layout = Layout(args.patients, args.studies, args.series, args.instances)
+    t0 = time.perf_counter()
+    n = nbytes = 0
+    for path, _ in generate(args.root, layout, args.syntaxes.split(","), args.rows, args.cols, args.seed):
+        n += 1
+        nbytes += path.stat().st_size
+    print(f"files={n} bytes={nbytes} {time.perf_counter() - t0:.1f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+"""Бенчмарки: индексатор, поиск, упаковка в tar.zst, распаковка на клиенте.
+
+Запуск из корня репозитория:
+  python -m benchmarks.run --work /tmp/bench --out before.json
+  python -m benchmarks.run --work /tmp/bench --out after.json
+  python -m benchmarks.run --compare before.json after.json
+
+БД — DB_URL (--db-url), по умолчанию SQLite в --work. На PostgreSQL нужна
+отдельная пустая база: таблицы пересоздаются перед каждым бенчмарком.
+Данные синтетические и детерминированные (generate.py); дерево файлов
+переиспользуется между прогонами с теми же параметрами. Результат — JSON с
+версией кода, окружением, параметрами и метриками; --compare печатает
+разницу и завершается с кодом 1, если что-то ухудшилось больше --threshold.
+"""
+import argparse, json, os, platform, random, shutil, statistics, subprocess, sys, time
+from pathlib import Path
+from .generate import (GENERATOR_VERSION, SYNTAXES, Layout, generate, patients, populate_index, series_syntax,
+                       study_date, uid)
+
+REPO = Path(__file__).resolve().parent.parent
+BENCHMARKS = ("indexer", "search", "package", "extract")
+# в среднем 200 экземпляров на пациента: 2 исследования по 4 серии по 25 срезов
+SEARCH_LAYOUT = (2, 4, 25)
+
+def _git() -> dict:
+    def run(*cmd):
+        try:
+            return subprocess.run(["git", *cmd], cwd=REPO, capture_output=True, text=True, timeout=30).stdout.strip()
+        except (OSError, subprocess.SubprocessError):
+            return ""
+    return {"commit": run("rev-parse", "--short", "HEAD") or None, "dirty": bool(run("status", "--porcelain", "-uno"))}
+
+def _percentiles(ms: list[float]) -> dict:
+    ms = sorted(ms)
+    pick = lambda q: round(ms[min(int(len(ms) * q), len(ms) - 1)], 2)
+    return {"p50_ms": pick(0.5), "p95_ms": pick(0.95), "p99_ms": pick(0.99), "mean_ms": round(statistics.fmean(ms), 2)}
+
+def reset_db():
+    from server.db import Base, engine, ensure_schema
+    Base.metadata.drop_all(engine)
+    ensure_schema()
+
+def ensure_data(data: Path, layout: Layout, syntaxes: list[str], rows: int, cols: int, seed: int) -> dict:
+    """Сгенерировать дерево, если его нет или параметры другие; вернуть описание."""
+    params = {"layout": layout._asdict(), "syntaxes": syntaxes, "rows": rows, "cols": cols, "seed": seed,
+              "generator": GENERATOR_VERSION}
+    marker = data / "bench.json"
+    try:
+        info = json.loads(marker.read_text())
+        if info["params"] == params:
+            return info
+    except (OSError, ValueError, KeyError):
+        pass
+    shutil.rmtree(data, ignore_errors=True)
+    t0 = time.perf_counter()
+    files = nbytes = 0
+    for path, _ in generate(data, layout, syntaxes, rows, cols, seed):
+        files += 1
+        nbytes += path.stat().st_size
+    info = {"params": params, "files": files, "bytes": nbytes, "generate_seconds": round(time.perf_counter() - t0, 2)}
+    marker.write_text(json.dumps(info))
+    return info
+
+def bench_indexer(data: Path, info: dict, workers: int) -> dict:
+    # индексатор — отдельным процессом, как в эксплуатации; сначала полный проход, потом
+    # инкрементальный без изменений (стоимость обхода и сверки отпечатков)
+    reset_db()
+    env = dict(os.environ, PYTHONPATH=str(REPO))
+    out = {"files": info["files"], "mb": round(info["bytes"] / 1024**2, 1), "workers": workers}
+    for name, extra in (("full", []), ("incremental", ["--incremental"])):
+        t0 = time.perf_counter()
+        proc = subprocess.run([sys.executable, str(REPO / "scripts" / "indexer.py"), "--root", str(data),
+                               "--workers", str(workers), "--progress", "0", *extra],
+                              env=env, capture_output=True, text=True)
+        el = time.perf_counter() - t0
+        if proc.returncode != 0:
+            raise RuntimeError(f"indexer failed: {proc.stderr[-2000:]}")
+        out[f"{name}_seconds"] = round(el, 2)
+        out[f"{name}_files_per_sec"] = round(info["files"] / el, 1)
+        if name == "full":
+            out["full_mb_per_sec"] = round(info["bytes"] / 1024**2 / el, 2)
+            out["indexer_output"] = proc.stdout.strip().splitlines()[-1:]
+    return out
+
+def bench_search(n_patients: int, queries: int, seed: int) -> dict:
+    reset_db()
+    layout = Layout(n_patients, *SEARCH_LAYOUT)
+    t0 = time.perf_counter()
+    n = populate_index(layout, seed)
+    populate_s = time.perf_counter() - t0
+    from fastapi.testclient import TestClient
+    from server.app import app, name_index
+    name_index.refresh(force=True)
+    client = TestClient(app)
+    rnd = random.Random(seed)
+    pats = patients(n_patients, seed)
+    out = {"instances": n, "patients": n_patients, "populate_seconds": round(populate_s, 1),
+           "populate_instances_per_sec": round(n / populate_s)}
+
+    def typo(name: str) -> str:
+        # фамилия с пропущенной буквой, без отчества — как вводят в регистратуре
+        surname, given, _ = name.split("^")
+        i = rnd.randrange(1, len(surname))
+        return f"{surname[:i]}{surname[i + 1:]} {given}"
+
+    scenarios = {
+        "exact": lambda k, p: {"name": p.name.replace("^", " "), "dob": p.birth_date},
+        "exact_year": lambda k, p: {"name": p.name.replace("^", " "), "dob": p.birth_date,
+                                    "year": int(study_date(k, 1)[:4])},
+        "fuzzy": lambda k, p: {"name": typo(p.name), "dob": p.birth_date, "fuzzy": "true"},
+    }
+    for scenario, params in scenarios.items():
+        client.get("/search", params=params(1, pats[0]))  # прогрев
+        ms, hits = [], 0
+        t0 = time.perf_counter()
+        for _ in range(queries):
+            k = rnd.randrange(n_patients)
+            q = params(k + 1, pats[k])
+            t = time.perf_counter()
+            r = client.get("/search", params=q)
+            ms.append((time.perf_counter() - t) * 1000)
+            r.raise_for_status()
+            # нашёлся ли искомый пациент (его исследования — <UID_ROOT>.<номер пациента>.<исследование>)
+            hits += any(row["study_uid"].startswith(uid(k + 1) + ".") for row in r.json())
+        el = time.perf_counter() - t0
+        out[scenario] = dict(_percentiles(ms), qps=round(queries / el, 1), hit_rate=round(hits / queries, 3))
+    return out
+
+def _pack_files(data: Path, info: dict) -> list[tuple]:
+    # (PackFile, transfer syntax) всех файлов дерева в порядке генерации
+    from server.readahead import PackFile
+    layout = Layout(**info["params"]["layout"])
+    out = []
+    for p in range(1, layout.patients + 1):
+        for st in range(1, layout.studies + 1):
+            for se in range(1, layout.series + 1):
+                ts = str(series_syntax(layout, info["params"]["syntaxes"], p, st, se))
+                for f in sorted((data / f"P{p:06d}" / f"ST{st:02d}" / f"SE{se:02d}").iterdir()):
+                    stt = f.stat()
+                    out.append((PackFile(str(f.relative_to(data)), str(f), stt.st_size, int(stt.st_mtime)), ts))
+    return out
+
+def bench_package(data: Path, info: dict, work: Path, repeat: int) -> dict:
+    from server.packager import build_tar_zst, is_compressed_ts, compression_level, InstanceRow
+    from server.config import PACK_LEVEL_RAW, PACK_LEVEL_COMPRESSED
+    pkg_dir = work / "packages"
+    shutil.rmtree(pkg_dir, ignore_errors=True)
+    pkg_dir.mkdir(parents=True)
+    entries = _pack_files(data, info)
+    names = {str(v): k for k, v in SYNTAXES.items()}
+    sets: dict[str, list] = {}
+    for f, ts in entries:
+        sets.setdefault(names[ts], []).append(f)
+    if len(sets) > 1:
+        sets["all"] = [f for f, _ in entries]
+    out = {}
+    for name, files in sets.items():
+        if name == "all":
+            # смешанный состав — уровень, который выберет сервер
+            level = compression_level(InstanceRow(f.rel, f.size, f.path, t, f.mtime, "") for f, t in entries)
+        else:
+            level = PACK_LEVEL_COMPRESSED if is_compressed_ts(str(SYNTAXES[name])) else PACK_LEVEL_RAW
+        size_in = sum(f.size for f in files)
+        path = pkg_dir / f"{name}.tar.zst"
+        best = None
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            build_tar_zst(path, data, files, level=level)
+            el = time.perf_counter() - t0
+            best = el if best is None else min(best, el)
+        size_out = path.stat().st_size
+        out[name] = {"files": len(files), "level": level, "input_mb": round(size_in / 1024**2, 2),
+                     "output_mb": round(size_out / 1024**2, 2), "ratio": round(size_in / size_out, 3),
+                     "seconds": round(best, 3), "mb_per_sec": round(size_in / 1024**2 / best, 1),
+                     "package": str(path)}
+    return out
+
+def bench_extract(packages: dict, work: Path, repeat: int) -> dict:
+    from client.extract import extract_archive
+    target = work / "extract"
+    out = {}
+    for ts, pkg in packages.items():
+        best = None
+        for _ in range(repeat):
+            shutil.rmtree(target, ignore_errors=True)
+            target.mkdir(parents=True)
+            t0 = time.perf_counter()
+            extract_archive(Path(pkg["package"]), target)
+            el = time.perf_counter() - t0
+            best = el if best is None else min(best, el)
+        out[ts] = {"files": pkg["files"], "seconds": round(best, 3),
+                   "mb_per_sec": round(pkg["input_mb"] / best, 1), "files_per_sec": round(pkg["files"] / best)}
+    shutil.rmtree(target, ignore_errors=True)
+    return out
+
+# направление метрик для --compare: что больше — лучше, что меньше — лучше
+_HIGHER = ("per_sec", "ratio", "qps", "hit_rate")
+_LOWER = ("_ms", "seconds")
+
+def _flatten(d: dict, prefix: str = "") -> dict[str, float]:
+    out = {}
+    for k, v in d.items():
+        key = f"{prefix}{k}"
+        if isinstance(v, dict):
+            out.update(_flatten(v, key + "."))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            out[key] = v
+    return out
+
+def compare(old_path: Path, new_path: Path, threshold: float) -> int:
+    old, new = (json.loads(Path(p).read_text()) for p in (old_path, new_path))
+    a, b = _flatten(old["results"]), _flatten(new["results"])
+    print(f"{old.get('git', {}).get('commit')} -> {new.get('git', {}).get('commit')}")
+    worse = 0
+    for key in sorted(a.keys() & b.keys()):
+        if not a[key]:
+            continue
+        change = (b[key] - a[key]) / abs(a[key]) * 100
+        mark = ""
+        if key.endswith(_HIGHER) or key.endswith(_LOWER):
+            better = change > 0 if key.endswith(_HIGHER) else change < 0
+            if abs(change) >= threshold:
+                mark = "лучше" if better else "ХУЖЕ"
+                worse += not better
+        print(f"{key:45} {a[key]:>12} {b[key]:>12} {change:+7.1f}% {mark}")
+    return 1 if worse else 0
+
+def main():
+    ap = argparse.ArgumentParser(description="Бенчмарки индексатора, поиска, упаковки и распаковки")
+    ap.add_argument("--work", type=Path, default=Path("/tmp/dicom-bench"), help="рабочий каталог (данные, БД, архивы)")
+    ap.add_argument("--db-url", help="БД для бенчмарка (по умолчанию SQLite в --work); таблицы пересоздаются!")
+    ap.add_argument("--only", default=",".join(BENCHMARKS), help="какие бенчмарки запускать")
+    ap.add_argument("--out", type=Path, help="куда записать JSON с результатами")
+    ap.add_argument("--patients", type=int, default=10, help="дерево файлов: пациентов")
+    ap.add_argument("--studies", type=int, default=2, help="исследований на пациента")
+    ap.add_argument("--series", type=int, default=4, help="серий на исследование")
+    ap.add_argument("--instances", type=int, default=50, help="срезов на серию")
+    ap.add_argument("--syntaxes", default="explicit,rle,jpeg", help="transfer syntax серий по кругу")
+    ap.add_argument("--rows", type=int, default=256)
+    ap.add_argument("--cols", type=int, default=256)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 4, help="воркеры индексатора")
+    ap.add_argument("--search-patients", type=int, default=5000,
+                    help=f"пациентов в индексе для поиска, по {SEARCH_LAYOUT[0] * SEARCH_LAYOUT[1] * SEARCH_LAYOUT[2]} "
+                         "экземпляров (5000 — 1 млн)")
+    ap.add_argument("--queries", type=int, default=200, help="запросов на сценарий поиска")
+    ap.add_argument("--repeat", type=int, default=3, help="повторов упаковки/распаковки (берётся лучший)")
+    ap.add_argument("--compare", nargs=2, type=Path, metavar=("OLD", "NEW"), help="сравнить два файла результатов")
+    ap.add_argument("--threshold", type=float, default=5.0, help="порог ухудшения для --compare, %%")
+    args = ap.parse_args()
+    if args.compare:
+        sys.exit(compare(*args.compare, args.threshold))
+
+    work = args.work.resolve()
+    work.mkdir(parents=True, exist_ok=True)
+    db_url = args.db_url or f"sqlite:///{work / 'bench.sqlite3'}"
+    # до импорта server.*: конфигурация читается при импорте
+    os.environ.update(DB_URL=db_url, CACHE_DIR=str(work / "cache"), DICOM_ROOT=str(work / "store"))
+    os.environ.pop("METRICS_TEXTFILE", None)
+    only = [b.strip() for b in args.only.split(",") if b.strip()]
+    data = work / "data"
+    layout = Layout(args.patients, args.studies, args.series, args.instances)
+    syntaxes = args.syntaxes.split(",")
+
+    from sqlalchemy import __version__ as sa_version
+    from server.db import engine
+    result = {
+        "version": 1,
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git": _git(),
+        "env": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+                "db": engine.dialect.name, "sqlalchemy": sa_version},
+        "params": {k: (str(v) if isinstance(v, Path) else v) for k, v in vars(args).items() if k != "compare"},
+        "results": {},
+    }
+    results = result["results"]
+    info = None
+    if {"indexer", "package", "extract"} & set(only):
+        info = ensure_data(data, layout, syntaxes, args.rows, args.cols, args.seed)
+        print(f"data: files={info['files']} mb={info['bytes'] / 1024**2:.1f}", flush=True)
+    if "indexer" in only:
+        results["indexer"] = r = bench_indexer(data, info, args.workers)
+        print(f"indexer: {r['full_files_per_sec']} files/s, incremental {r['incremental_files_per_sec']} files/s",
+              flush=True)
+    if "search" in only:
+        results["search"] = r = bench_search(args.search_patients, args.queries, args.seed)
+        print(f"search: {r['instances']} instances, " + ", ".join(
+            f"{k} p50={r[k]['p50_ms']}ms p99={r[k]['p99_ms']}ms" for k in ("exact", "exact_year", "fuzzy")),
+              flush=True)
+    if {"package", "extract"} & set(only):
+        results["package"] = r = bench_package(data, info, work, args.repeat)
+        for ts, v in r.items():
+            print(f"package {ts}: {v['mb_per_sec']} MB/s ratio {v['ratio']} level {v['level']}", flush=True)
+    if "extract" in only:
+        results["extract"] = r = bench_extract(results["package"], work, args.repeat)
+        for ts, v in r.items():
+            print(f"extract {ts}: {v['mb_per_sec']} MB/s {v['files_per_sec']} files/s", flush=True)
+    out = args.out or work / f"results-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    Path(out).write_text(json.dumps(result, ensure_ascii=False, indent=1))
+    print(f"results: {out}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""Кэш распакованных исследований на рабочей станции.
+
+Раскладка: `<root>/<StudyUID>/<SeriesUID>/файлы` и `<root>/<StudyUID>.json` —
+ключи серий из манифеста сервера (`/package/manifest`), объём и время
+последнего открытия. Повторное открытие исследования: сверить манифест,
+докачать только изменившиеся серии и разложить файлы в целевую папку
+жёсткими ссылками (на другом разделе — копией). Объём кэша ограничен,
+давно не открывавшиеся исследования вытесняются.
+"""
+import json, os, shutil, threading, time
+from pathlib import Path
+from typing import Callable
+
+MaterializeProgress = Callable[[int, int], None]  # (файлов разложено, всего)
+
+def _remove_tree(path: Path):
+    shutil.rmtree(path, ignore_errors=True)
+
+class StudyCache:
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # исследование в работе: сколько загрузок его держат и замок на сверку/докачку/раскладку
+        self._in_use: dict[str, int] = {}
+        self._study_locks: dict[str, threading.Lock] = {}
+
+    def _meta_path(self, suid: str) -> Path:
+        return self.root / f"{suid}.json"
+
+    def _load(self, suid: str) -> dict:
+        try:
+            return json.loads(self._meta_path(suid).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, suid: str, meta: dict):
+        path = self._meta_path(suid)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(json.dumps(meta), encoding="utf-8")
+        os.replace(tmp, path)
+
+    def acquire(self, suid: str) -> threading.Lock:
+        """Отметить исследование в работе (не вытеснять) и вернуть его замок.
+
+        Под замком идут missing_series, put и materialize: две загрузки одного
+        исследования (в разные папки) не докачивают и не переносят серии наперегонки.
+        """
+        with self._lock:
+            self._in_use[suid] = self._in_use.get(suid, 0) + 1
+            return self._study_locks.setdefault(suid, threading.Lock())
+
+    def release(self, suid: str):
+        with self._lock:
+            n = self._in_use.get(suid, 0) - 1
+            if n > 0:
+                self._in_use[suid] = n
+            else:
+                self._in_use.pop(suid, None)
+                self._study_locks.pop(suid, None)
+
+    def staging(self, suid: str, tag: str) -> Path:
+        """Пустая папка для распаковки докачиваемых серий; tag — своя у каждой загрузки."""
+        path = self.root / ".incoming" / f"{suid}.{tag}"
+        _remove_tree(path)
+        path.mkdir(parents=True)
+        return path
+
+    def drop_staging(self, path: Path):
+        # докачка не удалась или отменена — недокачанное в кэш не попадает
+        _remove_tree(path)
+
+    def missing_series(self, suid: str, manifest: dict) -> list[str]:
+        """Серии манифеста, которых в кэше нет, они изменились или у них пропали файлы."""
+        cached = self._load(suid).get("series", {})
+        by_series: dict[str, list[dict]] = {}
+        for f in manifest["files"]:
+            by_series.setdefault(f["series"], []).append(f)
+        missing = []
+        for s in manifest["series"]:
+            uid = s["series_uid"]
+            if cached.get(uid) != s["key"] or not self._complete(by_series.get(uid, [])):
+                missing.append(uid)
+        return missing
+
+    def _complete(self, files: list[dict]) -> bool:
+        for f in files:
+            try:
+                size = (self.root / f["path"]).stat().st_size
+            except OSError:
+                return False
+            if f.get("size") is not None and size != f["size"]:
+                return False
+        return True
+
+    def put(self, suid: str, staging: Path, manifest: dict, series_uids: list[str]):
+        """Перенести распакованные в staging серии в кэш и запомнить манифест."""
+        study_dir = self.root / suid
+        study_dir.mkdir(parents=True, exist_ok=True)
+        for uid in series_uids:
+            src = staging / suid / uid
+            dst = study_dir / uid
+            _remove_tree(dst)
+            if src.is_dir():
+                os.replace(src, dst)
+        # серии, которых больше нет в исследовании, в кэше не держим
+        keep = {s["series_uid"] for s in manifest["series"]}
+        for d in study_dir.iterdir():
+            if d.is_dir() and d.name not in keep:
+                _remove_tree(d)
+        _remove_tree(staging)
+        self._save(suid, {
+            "key": manifest["key"],
+            "series": {s["series_uid"]: s["key"] for s in manifest["series"]},
+            "bytes": sum(s["bytes"] for s in manifest["series"]),
+            "last_access": time.time(),
+        })
+
+    def materialize(self, suid: str, manifest: dict, target_dir: Path,
+                    progress: MaterializeProgress | None = None) -> int:
+        """Разложить файлы исследования из кэша в target_dir (StudyUID/SeriesUID/файл).
+
+        Вернуть, сколько файлов пришлось скопировать: жёсткие ссылки работают только
+        в пределах раздела, на другом разделе кэш не экономит ни места, ни времени.
+        """
+        link = True
+        copied = 0
+        total = len(manifest["files"])
+        for i, f in enumerate(manifest["files"], 1):
+            src = self.root / f["path"]
+            dst = target_dir / f["path"]
+            if not self._same(src, dst):
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                dst.unlink(missing_ok=True)
+                if link:
+                    try:
+                        os.link(src, dst)
+                    except OSError:
+                        link = False  # другой раздел или ФС без жёстких ссылок — копируем
+                if not link:
+                    shutil.copy2(src, dst)
+                    copied += 1
+            if progress:
+                progress(i, total)
+        meta = self._load(suid)
+        if meta:
+            meta["last_access"] = time.time()
+            self._save(suid, meta)
+        return copied
+
+    @staticmethod
+    def _same(src: Path, dst: Path) -> bool:
+        # в целевой папке уже та же ссылка либо копия того же файла (copy2 сохраняет mtime)
+        try:
+            a, b = src.stat(), dst.stat()
+        except FileNotFoundError:
+            return False
+        return (a.st_dev, a.st_ino) == (b.st_dev, b.st_ino) or (
+            a.st_size == b.st_size and int(a.st_mtime) == int(b.st_mtime))
+
+    def evict(self):
+        """Вытеснить давно не открывавшиеся исследования сверх бюджета."""
+        if self.max_bytes <= 0:
+            return
+        with self._lock:
+            metas = []
+            for p in self.root.glob("*.json"):
+                suid = p.name[:-len(".json")]
+                meta = self._load(suid)
+                metas.append((meta.get("last_access", 0), suid, meta.get("bytes", 0)))
+            used = sum(b for _, _, b in metas)
+            for _, suid, size in sorted(metas):
+                if used <= self.max_bytes:
+                    break
+                if suid in self._in_use:
+                    continue
+                self._meta_path(suid).unlink(missing_ok=True)
+                _remove_tree(self.root / suid)
+                used -= size
+
+    def stats(self) -> dict:
+        metas = [self._load(p.name[:-len(".json")]) for p in self.root.glob("*.json")]
+        return {"studies": len(metas), "bytes": sum(m.get("bytes", 0) for m in metas), "max_bytes": self.max_bytes}
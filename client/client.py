@@ -1,12 +1,17 @@
 
-import sys, os, io, zipfile, tarfile, tempfile, subprocess, shutil, requests, time, re
+import sys, subprocess
 from pathlib import Path
-import pycdlib
 from PySide6.QtWidgets import (QApplication, QWidget, QLineEdit, QFormLayout, QPushButton,
                                QTableWidget, QTableWidgetItem, QFileDialog, QHBoxLayout, QMessageBox,
-                               QLabel, QProgressBar)
+                               QLabel, QProgressBar, QCheckBox, QSpinBox, QAbstractItemView)
 from PySide6.QtCore import Qt
-from .config import API_BASE, DOWNLOAD_DIR, VIEWER_CMD
+from .config import (API_BASE, DOWNLOAD_DIR, VIEWER_CMD, DOWNLOAD_CONNECTIONS, DOWNLOAD_RETRIES, PACKAGE_JOBS,
+                     STREAM_EXTRACT, KEEP_ARCHIVE, TRANSFER_WORKERS, STUDY_CACHE, STUDY_CACHE_DIR,
+                     STUDY_CACHE_MAX_BYTES, ISO_DICOM_ONLY, ISO_WRITERS)
+from .cache import StudyCache
+from .manager import TransferManager, Transfer, QUEUED, RUNNING, DONE, FAILED, CANCELLED
+
+STATE_NAMES = {QUEUED: "В очереди", RUNNING: "Выполняется", DONE: "Готово", FAILED: "Ошибка", CANCELLED: "Отменено"}
 
 def human_mb(n):
     return f"{n/1024/1024:.1f} MB"
@@ -19,37 +24,75 @@ class App(QWidget):
         self.dob  = QLineEdit()  # YYYYMMDD
         self.sex  = QLineEdit()  # M/F (опц.)
         self.year = QLineEdit()  # 2024 (опц.)
+        self.fuzzy = QCheckBox("Нечёткий поиск (опечатки, латиница, без отчества)")
         self.btn_search = QPushButton("Искать")
         self.btn_search.clicked.connect(self.do_search)
-        self.tbl = QTableWidget(0,4)
-        self.tbl.setHorizontalHeaderLabels(["StudyUID","Дата","Файлов","Объём"])
-        self.btn_dl = QPushButton("Скачать выбранное исследование")
+        self.tbl = QTableWidget(0,5)
+        self.tbl.setHorizontalHeaderLabels(["StudyUID","Дата","Файлов","Объём","Пациент"])
+        self.tbl.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.tbl.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.btn_dl = QPushButton("Скачать выбранные исследования")
         self.btn_dl.clicked.connect(self.do_download)
         self.btn_view = QPushButton("Открыть в просмотрщике (папка)")
         self.btn_view.clicked.connect(self.open_viewer)
+        self.keep_archive = QCheckBox("Сохранить исходный архив в папке загрузок")
+        self.keep_archive.setChecked(KEEP_ARCHIVE)
+        self.btn_iso = QPushButton("Распаковать ISO…")
+        self.btn_iso.clicked.connect(self.do_extract_iso)
+        self.iso_dicom_only = QCheckBox("Из ISO — только DICOM (по DICOMDIR)")
+        self.iso_dicom_only.setChecked(ISO_DICOM_ONLY)
         self.status = QLabel("")
-        self.progress = QProgressBar()
-        self.progress.setRange(0, 100)
-        self.progress.setValue(0)
-        self.progress.setTextVisible(True)
-        self.progress.setFormat("Готово")
+
+        # очередь загрузок: работают в фоне, поиск при этом доступен
+        study_cache = StudyCache(Path(STUDY_CACHE_DIR), STUDY_CACHE_MAX_BYTES) if STUDY_CACHE else None
+        self.transfers = TransferManager(API_BASE, Path(DOWNLOAD_DIR), workers=TRANSFER_WORKERS,
+                                         connections=DOWNLOAD_CONNECTIONS, retries=DOWNLOAD_RETRIES,
+                                         package_jobs=PACKAGE_JOBS, stream=STREAM_EXTRACT, cache=study_cache,
+                                         iso_writers=ISO_WRITERS, parent=self)
+        self.transfers.changed.connect(self.on_transfer)
+        self.queue = QTableWidget(0, 4)
+        self.queue.setHorizontalHeaderLabels(["StudyUID", "Состояние", "Прогресс", ""])
+        self.queue.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.queue.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.queue.horizontalHeader().setStretchLastSection(True)
+        self.btn_cancel = QPushButton("Отменить")
+        self.btn_cancel.clicked.connect(self.cancel_transfers)
+        self.btn_retry = QPushButton("Повторить")
+        self.btn_retry.clicked.connect(self.retry_transfers)
+        self.btn_clear = QPushButton("Убрать завершённые")
+        self.btn_clear.clicked.connect(self.clear_transfers)
+        self.parallel = QSpinBox()
+        self.parallel.setRange(1, 8)
+        self.parallel.setValue(self.transfers.workers)
+        self.parallel.valueChanged.connect(self.transfers.set_workers)
 
         form = QFormLayout()
         form.addRow("ФИО:", self.name)
         form.addRow("Дата рождения (YYYYMMDD):", self.dob)
         form.addRow("Пол (M/F, опц.):", self.sex)
         form.addRow("Год (опц.):", self.year)
+        form.addRow(self.fuzzy)
 
         h = QHBoxLayout()
         h.addWidget(self.btn_search)
         h.addWidget(self.btn_dl)
         h.addWidget(self.btn_view)
+        h.addWidget(self.btn_iso)
 
         layout = QFormLayout(self)
         layout.addRow(form)
         layout.addRow(self.tbl)
         layout.addRow(h)
-        layout.addRow(self.progress)
+        layout.addRow(self.keep_archive)
+        layout.addRow(self.iso_dicom_only)
+        layout.addRow(self.queue)
+        q = QHBoxLayout()
+        q.addWidget(self.btn_cancel)
+        q.addWidget(self.btn_retry)
+        q.addWidget(self.btn_clear)
+        q.addWidget(QLabel("Одновременно:"))
+        q.addWidget(self.parallel)
+        layout.addRow(q)
         layout.addRow(self.status)
 
         self.results = []
@@ -58,8 +101,11 @@ class App(QWidget):
         params = {"name": self.name.text().strip(), "dob": self.dob.text().strip()}
         if self.sex.text().strip(): params["sex"] = self.sex.text().strip()
         if self.year.text().strip(): params["year"] = int(self.year.text().strip())
+        if self.fuzzy.isChecked():
+            params["fuzzy"] = "true"
+            if not params["dob"]: del params["dob"]
         try:
-            r = requests.get(f"{API_BASE}/search", params=params, timeout=60)
+            r = self.transfers.session.get(f"{API_BASE}/search", params=params, timeout=60)
             r.raise_for_status()
             data = r.json()
         except Exception as e:
@@ -72,33 +118,41 @@ class App(QWidget):
             self.tbl.setItem(i,1,QTableWidgetItem(row.get("study_date","")))
             self.tbl.setItem(i,2,QTableWidgetItem(str(row["files"])))
             self.tbl.setItem(i,3,QTableWidgetItem(human_mb(row["bytes"])))
-
-    def current_study(self):
-        i = self.tbl.currentRow()
-        if i < 0:
-            QMessageBox.information(self, "Внимание", "Выберите строку в таблице результатов.")
-            return None
-        return self.tbl.item(i,0).text()
+            patient = f'{row.get("patient_name") or ""} {row.get("birth_date") or ""}'.strip()
+            if "score" in row:
+                patient += f' ({row["score"]:.0%})'
+            self.tbl.setItem(i,4,QTableWidgetItem(patient))
+
+    def selected_studies(self) -> list[str]:
+        rows = sorted({i.row() for i in self.tbl.selectedIndexes()})
+        if not rows and self.tbl.currentRow() >= 0:
+            rows = [self.tbl.currentRow()]
+        if not rows:
+            QMessageBox.information(self, "Внимание", "Выберите строки в таблице результатов.")
+        return [self.tbl.item(i, 0).text() for i in rows]
 
     def do_download(self):
-        suid = self.current_study()
-        if not suid:
+        suids = self.selected_studies()
+        if not suids:
             return
         target_dir = QFileDialog.getExistingDirectory(self, "Выберите папку для распаковки", DOWNLOAD_DIR)
         if not target_dir:
             return
-        pkg_path = self._download_package(suid)
-        if not pkg_path:
+        keep = self.keep_archive.isChecked()
+        # архивы разложены как StudyUID/..., так что несколько исследований в одной папке не смешиваются
+        for suid in suids:
+            self.transfers.add(suid, Path(target_dir), keep_archive=keep)
+
+    def do_extract_iso(self):
+        # распаковка идёт в очереди загрузок, окно не блокируется
+        paths, _ = QFileDialog.getOpenFileNames(self, "Выберите образы ISO", DOWNLOAD_DIR, "Образы ISO (*.iso)")
+        if not paths:
             return
-        if not self._extract_package(Path(pkg_path), Path(target_dir)):
+        target_dir = QFileDialog.getExistingDirectory(self, "Выберите папку для распаковки", DOWNLOAD_DIR)
+        if not target_dir:
             return
-        QMessageBox.information(self, "Готово", f"Распаковано в: {target_dir}")
-        now = time.time()
-        os.utime(target_dir, (now, now))
-        try:
-            os.remove(pkg_path)
-        except OSError:
-            pass
+        for p in paths:
+            self.transfers.add_iso(Path(p), Path(target_dir), dicom_only=self.iso_dicom_only.isChecked())
 
     def open_viewer(self):
         # открываем просмотрщик на выбранной папке (после распаковки)
@@ -110,126 +164,66 @@ class App(QWidget):
         except Exception as e:
             QMessageBox.critical(self, "Ошибка", f"Не удалось запустить просмотрщик: {e}")
 
-    def _download_package(self, suid: str) -> str | None:
-        self.progress.setFormat("Скачивание %p%")
-        self.progress.setRange(0, 0)  # неопределённый прогресс
-        self.progress.setValue(0)
-        self.status.setText("Подготовка к скачиванию...")
-        QApplication.processEvents()
-        try:
-            r = requests.get(f"{API_BASE}/package", params={"study_uid": suid}, stream=True, timeout=600)
-            r.raise_for_status()
-        except Exception as e:
-            self.progress.setRange(0, 100)
-            self.progress.setValue(0)
-            self.progress.setFormat("Ошибка")
-            QMessageBox.critical(self, "Ошибка", str(e))
-            return None
-
-        filename = self._resolve_filename(r, suid)
-        pkg_path = Path(DOWNLOAD_DIR) / filename
-        total = int(r.headers.get("Content-Length") or 0)
-        if total:
-            self.progress.setRange(0, 100)
-            self.progress.setValue(0)
-        downloaded = 0
-        try:
-            with open(pkg_path, "wb") as f:
-                for chunk in r.iter_content(chunk_size=1024*1024):
-                    if not chunk:
-                        continue
-                    f.write(chunk)
-                    downloaded += len(chunk)
-                    if total:
-                        pct = int(downloaded * 100 / total)
-                        self.progress.setValue(min(pct, 100))
-                        self.status.setText(f"Скачано {human_mb(downloaded)} из {human_mb(total)}")
-                        QApplication.processEvents()
-        except Exception as e:
-            self.progress.setRange(0, 100)
-            self.progress.setValue(0)
-            self.progress.setFormat("Ошибка")
-            QMessageBox.critical(self, "Ошибка", f"Не удалось скачать архив: {e}")
-            return None
-        self.progress.setRange(0, 100)
-        self.progress.setValue(100)
-        self.progress.setFormat("Загрузка завершена")
-        self.status.setText(f"Файл сохранён: {pkg_path}")
-        return str(pkg_path)
-
-    def _resolve_filename(self, response: requests.Response, suid: str) -> str:
-        cd = response.headers.get("Content-Disposition", "")
-        m = re.search(r'filename="?([^";]+)"?', cd)
-        if m:
-            return m.group(1)
-        ctype = response.headers.get("Content-Type", "")
-        if "zip" in ctype:
-            return f"{suid}.zip"
-        if "tar" in ctype:
-            return f"{suid}.tar"
-        if "zstd" in ctype:
-            return f"{suid}.tar.zst"
-        if "iso" in ctype:
-            return f"{suid}.iso"
-        return f"{suid}.pkg"
-
-    def _extract_package(self, pkg_path: Path, target_dir: Path) -> bool:
-        self.progress.setFormat("Распаковка %p%")
-        self.progress.setRange(0, 0)
-        self.progress.setValue(0)
-        self.status.setText("Распаковка архива...")
-        QApplication.processEvents()
-
-        try:
-            suffix = "".join(pkg_path.suffixes).lower()
-            if suffix.endswith(".tar.zst"):
-                import zstandard as zstd
-                with open(pkg_path, "rb") as src:
-                    dctx = zstd.ZstdDecompressor()
-                    with dctx.stream_reader(src) as reader:
-                        with tarfile.open(fileobj=reader, mode="r|") as tf:
-                            tf.extractall(path=target_dir)
-            elif suffix.endswith(".zip"):
-                with zipfile.ZipFile(pkg_path, "r") as zf:
-                    zf.extractall(path=target_dir)
-            elif suffix.endswith(".iso"):
-                self._extract_iso(pkg_path, target_dir)
-            elif suffix.endswith(".tar") or suffix.endswith(".tgz") or suffix.endswith(".tar.gz"):
-                with tarfile.open(pkg_path, mode="r:*") as tf:
-                    tf.extractall(path=target_dir)
-            else:
-                QMessageBox.warning(self, "Неизвестный формат", f"Неизвестный тип архива: {pkg_path.name}")
-                return False
-        except Exception as e:
-            self.progress.setRange(0, 100)
-            self.progress.setValue(0)
-            self.progress.setFormat("Ошибка")
-            QMessageBox.critical(self, "Ошибка распаковки", str(e))
-            return False
-        self.progress.setRange(0, 100)
-        self.progress.setValue(100)
-        self.progress.setFormat("Готово")
-        self.status.setText(f"Распаковано в: {target_dir}")
-        return True
-
-    def _extract_iso(self, iso_path: Path, target_dir: Path) -> None:
-        iso = pycdlib.PyCdlib()
-        iso.open(str(iso_path))
-        try:
-            for parent, dirs, files in iso.walk(iso_path="/"):
-                parent_rel = Path(parent.lstrip("/"))
-                for dname in dirs:
-                    (target_dir / parent_rel / dname).mkdir(parents=True, exist_ok=True)
-                for fname in files:
-                    iso_rel = Path("/") / parent_rel / fname
-                    dest_path = target_dir / parent_rel / fname
-                    dest_path.parent.mkdir(parents=True, exist_ok=True)
-                    with open(dest_path, "wb") as out_fp:
-                        iso.get_file_from_iso_fp(iso_path=str(iso_rel), outfp=out_fp)
-        finally:
-            iso.close()
+    def _queue_row(self, tid: int) -> int:
+        for i in range(self.queue.rowCount()):
+            if self.queue.item(i, 0).data(Qt.UserRole) == tid:
+                return i
+        i = self.queue.rowCount()
+        self.queue.insertRow(i)
+        item = QTableWidgetItem()
+        item.setData(Qt.UserRole, tid)
+        self.queue.setItem(i, 0, item)
+        self.queue.setItem(i, 1, QTableWidgetItem())
+        bar = QProgressBar()
+        bar.setRange(0, 100)
+        self.queue.setCellWidget(i, 2, bar)
+        self.queue.setItem(i, 3, QTableWidgetItem())
+        return i
+
+    def on_transfer(self, t: Transfer):
+        i = self._queue_row(t.id)
+        self.queue.item(i, 0).setText(t.study_uid)
+        self.queue.item(i, 1).setText(STATE_NAMES.get(t.state, t.state))
+        bar = self.queue.cellWidget(i, 2)
+        if t.state == DONE:
+            bar.setRange(0, 100)
+            bar.setValue(100)
+        elif t.state == RUNNING and not t.total:
+            bar.setRange(0, 0)  # неопределённый прогресс
+        else:
+            bar.setRange(0, 100)
+            bar.setValue(min(int(t.done * 100 / t.total), 100) if t.total else 0)
+        bar.setFormat(f"{t.phase} %p%" if t.phase and t.state == RUNNING else "%p%")
+        size = f"{human_mb(t.done)} из {human_mb(t.total)}" if t.total else ""
+        self.queue.item(i, 3).setText(", ".join(x for x in (t.message, size if t.state == RUNNING else "") if x))
+        if t.state == FAILED:
+            self.queue.item(i, 3).setToolTip(t.error or "")
+        active = sum(1 for x in self.transfers.items() if x.state in (QUEUED, RUNNING))
+        self.status.setText(f"Загрузок в работе: {active}" if active else "Все загрузки завершены")
+
+    def _selected_transfers(self) -> list[int]:
+        rows = {i.row() for i in self.queue.selectedIndexes()}
+        return [self.queue.item(i, 0).data(Qt.UserRole) for i in sorted(rows)]
+
+    def cancel_transfers(self):
+        for tid in self._selected_transfers():
+            self.transfers.cancel(tid)
+
+    def retry_transfers(self):
+        for tid in self._selected_transfers():
+            self.transfers.retry(tid)
+
+    def clear_transfers(self):
+        gone = set(self.transfers.remove_finished())
+        for i in reversed(range(self.queue.rowCount())):
+            if self.queue.item(i, 0).data(Qt.UserRole) in gone:
+                self.queue.removeRow(i)
+
+    def closeEvent(self, event):
+        self.transfers.shutdown()
+        super().closeEvent(event)
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
-    w = App(); w.resize(1000, 600); w.show()
+    w = App(); w.resize(1000, 800); w.show()
     sys.exit(app.exec())
@@ -3,4 +3,25 @@ import os
 API_BASE = os.getenv("API_BASE", "http://127.0.0.1:8000")
 DOWNLOAD_DIR = os.getenv("DOWNLOAD_DIR", "./downloads")
 VIEWER_CMD = os.getenv("RADIANT_CMD", "RadiantViewer")
+# Параллельных соединений на один архив (1 — обычная докачиваемая загрузка)
+DOWNLOAD_CONNECTIONS = int(os.getenv("DOWNLOAD_CONNECTIONS", "1"))
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", "5"))
+# Сколько исследований качается одновременно (меняется и в окне клиента)
+TRANSFER_WORKERS = int(os.getenv("TRANSFER_WORKERS", "2"))
+# Сначала собрать архив заданием на сервере (/package-jobs) и показать прогресс сборки.
+# По умолчанию выключено: /package отдаёт архив потоком сразу, распаковка идёт во время сборки,
+# а задание ждёт конца сборки до первого байта
+PACKAGE_JOBS = os.getenv("PACKAGE_JOBS", "0") == "1"
+# Распаковывать tar.zst прямо во время скачивания, не сохраняя архив на диск
+STREAM_EXTRACT = os.getenv("STREAM_EXTRACT", "1") == "1"
+# Сохранять исходный архив в DOWNLOAD_DIR (значение флажка по умолчанию)
+KEEP_ARCHIVE = os.getenv("KEEP_ARCHIVE", "0") == "1"
+# Кэш распакованных исследований: повторное открытие без скачивания (0 — выключен)
+STUDY_CACHE = os.getenv("STUDY_CACHE", "1") == "1"
+# файлы раскладываются жёсткими ссылками — кэш должен быть на том же томе, что и папки загрузки
+STUDY_CACHE_DIR = os.getenv("STUDY_CACHE_DIR", os.path.join(DOWNLOAD_DIR, "cache"))
+STUDY_CACHE_MAX_BYTES = int(float(os.getenv("STUDY_CACHE_MAX_GB", "20")) * 1024 ** 3)  # 0 — без ограничения
+# Распаковка локальных ISO: только DICOM (по DICOMDIR) — значение флажка, потоков записи
+ISO_DICOM_ONLY = os.getenv("ISO_DICOM_ONLY", "1") == "1"
+ISO_WRITERS = int(os.getenv("ISO_WRITERS", "4"))
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
@@ -0,0 +1,243 @@
+"""Распаковка скачанных архивов без привязки к GUI: tar.zst, ZIP, TAR, ISO.
+
+ISO читается не по файлам через pycdlib, а самим образом: файлы сортируются
+по экстентам и вычитываются крупными последовательными кусками (оптика и USB
+читаются без скачков головки), запись на диск — небольшим пулом потоков.
+"""
+import tarfile, zipfile
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+from typing import BinaryIO, Callable, NamedTuple
+import pycdlib
+
+# образ читается кусками такого размера; файлы крупнее пишутся потоком, без буфера целиком
+ISO_READ_CHUNK = 8 * 1024 * 1024
+# сколько прочитанных, но ещё не записанных байт может ждать пул писателей
+ISO_WRITE_BUFFER = 64 * 1024 * 1024
+ISO_WRITERS = 4
+
+# файлов распаковано, байт распаковано, всего байт, имя последнего файла
+IsoProgress = Callable[[int, int, int, str], None]
+
+def extract_archive(pkg_path: Path, target_dir: Path, progress: IsoProgress | None = None,
+                    dicom_only: bool = False) -> None:
+    """Распаковать архив в target_dir по расширению; неизвестный формат — ValueError.
+
+    Члены tar, выходящие за target_dir (абсолютные пути, "..", ссылки наружу), — tarfile.FilterError.
+    """
+    suffix = "".join(pkg_path.suffixes).lower()
+    if suffix.endswith(".tar.zst"):
+        import zstandard as zstd
+        with open(pkg_path, "rb") as src:
+            dctx = zstd.ZstdDecompressor()
+            # архив — склейка кадров zstd по сериям, читаем их все
+            with dctx.stream_reader(src, read_across_frames=True) as reader:
+                with tarfile.open(fileobj=reader, mode="r|") as tf:
+                    tf.extractall(path=target_dir, filter="data")
+    elif suffix.endswith(".zip"):
+        with zipfile.ZipFile(pkg_path, "r") as zf:
+            zf.extractall(path=target_dir)
+    elif suffix.endswith(".iso"):
+        extract_iso(pkg_path, target_dir, progress=progress, dicom_only=dicom_only)
+    elif suffix.endswith(".tar") or suffix.endswith(".tgz") or suffix.endswith(".tar.gz"):
+        # filter="data": абсолютные пути, ".." и ссылки за пределы target_dir отклоняются
+        with tarfile.open(pkg_path, mode="r:*") as tf:
+            tf.extractall(path=target_dir, filter="data")
+    else:
+        raise ValueError(f"Неизвестный тип архива: {pkg_path.name}")
+
+class IsoFile(NamedTuple):
+    rel: str       # путь при распаковке: имена Rock Ridge, иначе ISO9660 без версии ";1"
+    key: str       # нормализованный путь ISO9660 — так на файлы ссылается DICOMDIR
+    offset: int    # байт от начала образа
+    size: int
+    iso_path: str  # путь для pycdlib (файлы из нескольких экстентов читаются через него)
+    multi: bool = False
+
+def _norm(name: str) -> str:
+    # "IM000001;1" / "IM000001." -> "IM000001": так имена записаны в DICOMDIR
+    return name.split(";", 1)[0].rstrip(".").upper()
+
+def iso_listing(iso: pycdlib.PyCdlib) -> tuple[list[IsoFile], list[str]]:
+    """Файлы образа (в порядке обхода) и каталоги по записям каталогов, без поиска по путям."""
+    block = iso.logical_block_size
+    files: list[IsoFile] = []
+    dirs: list[str] = []
+    stack = [("/", "", "")]
+    while stack:
+        iso_dir, rel_dir, key_dir = stack.pop()
+        for rec in iso.list_children(iso_path=iso_dir):
+            if rec.is_dot() or rec.is_dotdot():
+                continue
+            ident = rec.file_identifier().decode("ascii", "replace")
+            rr = rec.rock_ridge.name() if rec.rock_ridge is not None else b""
+            name = rr.decode("utf-8", "replace") if rr else ident.split(";", 1)[0].rstrip(".")
+            iso_path = f"{iso_dir.rstrip('/')}/{ident}"
+            rel = f"{rel_dir}/{name}" if rel_dir else name
+            key = f"{key_dir}/{_norm(ident)}" if key_dir else _norm(ident)
+            if rec.is_dir():
+                dirs.append(rel)
+                stack.append((iso_path, rel, key))
+            else:
+                files.append(IsoFile(rel, key, rec.extent_location() * block, rec.get_data_length(), iso_path,
+                                     rec.data_continuation is not None))
+    return files, dirs
+
+def _dicomdir_refs(data: bytes) -> set[str]:
+    import io
+    import pydicom
+    ds = pydicom.dcmread(io.BytesIO(data), force=True)
+    refs = set()
+    for rec in ds.get("DirectoryRecordSequence", []):
+        ref = rec.get("ReferencedFileID")
+        if ref:
+            parts = [ref] if isinstance(ref, str) else list(ref)
+            refs.add("/".join(_norm(str(p)) for p in parts))
+    return refs
+
+def plan_iso(iso: pycdlib.PyCdlib, src: BinaryIO, dicom_only: bool = False) -> tuple[list[IsoFile], list[str], bool]:
+    """Файлы к распаковке в порядке экстентов, каталоги и признак «только DICOM по DICOMDIR».
+
+    dicom_only с DICOMDIR — сам DICOMDIR и файлы, на которые он ссылается; без
+    DICOMDIR (или если он не читается) отбор идёт по сигнатуре DICM при распаковке.
+    """
+    files, dirs = iso_listing(iso)
+    by_dicomdir = False
+    if dicom_only:
+        dicomdirs = sorted((f for f in files if f.key.rsplit("/", 1)[-1] == "DICOMDIR"), key=lambda f: len(f.key))
+        if dicomdirs:
+            dd = dicomdirs[0]
+            base = dd.key.rsplit("/", 1)[0] + "/" if "/" in dd.key else ""
+            try:
+                src.seek(dd.offset)
+                refs = {base + r for r in _dicomdir_refs(src.read(dd.size))}
+            except Exception:
+                refs = set()
+            picked = [f for f in files if f.key in refs]
+            if picked:
+                files, by_dicomdir = [dd] + picked, True
+        # каталоги создаются по мере надобности — пустые и не-DICOM не нужны
+        dirs = []
+    files.sort(key=lambda f: f.offset)
+    return files, dirs, by_dicomdir
+
+class _SequentialReader:
+    """Чтение образа окнами по chunk байт: соседние файлы берутся из одного окна."""
+
+    def __init__(self, f: BinaryIO, chunk: int = ISO_READ_CHUNK):
+        self.f = f
+        self.chunk = chunk
+        self.buf = b""
+        self.start = 0
+
+    def _fill(self, offset: int):
+        self.f.seek(offset)
+        self.buf = self.f.read(self.chunk)
+        self.start = offset
+        if not self.buf:
+            raise EOFError(f"образ обрывается на байте {offset}")
+
+    def read(self, offset: int, size: int) -> bytes:
+        parts = []
+        while size > 0:
+            if not (self.start <= offset < self.start + len(self.buf)):
+                self._fill(offset)
+            i = offset - self.start
+            part = self.buf[i:i + size]
+            parts.append(part)
+            offset += len(part)
+            size -= len(part)
+        return b"".join(parts) if len(parts) != 1 else parts[0]
+
+    def copy(self, offset: int, size: int, out: BinaryIO):
+        # крупный файл: теми же окнами, но сразу в out
+        while size > 0:
+            n = min(size, self.chunk)
+            out.write(self.read(offset, n))
+            offset += n
+            size -= n
+
+def _write_file(path: Path, data: bytes):
+    with open(path, "wb") as f:
+        f.write(data)
+
+def extract_iso(iso_path: Path, target_dir: Path, progress: IsoProgress | None = None,
+                dicom_only: bool = False, writers: int = ISO_WRITERS) -> int:
+    """Распаковать образ в target_dir в порядке экстентов; вернуть число записанных файлов.
+
+    dicom_only — только DICOM: по DICOMDIR, если он есть, иначе файлы с сигнатурой DICM.
+    progress вызывается в потоке распаковки после записи каждого файла; исключение
+    из него (отмена) прерывает распаковку.
+    """
+    iso = pycdlib.PyCdlib()
+    iso.open(str(iso_path))
+    try:
+        with open(iso_path, "rb", buffering=0) as src:
+            files, dirs, by_dicomdir = plan_iso(iso, src, dicom_only)
+            total = sum(f.size for f in files)
+            for d in dirs:
+                (target_dir / d).mkdir(parents=True, exist_ok=True)
+            made = set(dirs)
+            reader = _SequentialReader(src)
+            pending: deque[tuple[Future, IsoFile]] = deque()
+            pending_bytes = written = done_bytes = 0
+
+            def done(f: IsoFile):
+                nonlocal written, done_bytes
+                written += 1
+                done_bytes += f.size
+                if progress:
+                    progress(written, done_bytes, total, f.rel)
+
+            def finish(fut: Future, f: IsoFile):
+                nonlocal pending_bytes
+                fut.result()
+                pending_bytes -= f.size
+                done(f)
+
+            def skip(f: IsoFile, head: bytes) -> bool:
+                # без DICOMDIR DICOM узнаём по сигнатуре Part 10 после 128-байтной преамбулы
+                nonlocal total
+                if dicom_only and not by_dicomdir and head[128:132] != b"DICM":
+                    total -= f.size
+                    return True
+                return False
+
+            with ThreadPoolExecutor(max_workers=max(writers, 1), thread_name_prefix="iso-write") as pool:
+                try:
+                    for f in files:
+                        dest = target_dir / PurePosixPath(f.rel)
+                        parent = str(PurePosixPath(f.rel).parent)
+                        if parent not in made:
+                            dest.parent.mkdir(parents=True, exist_ok=True)
+                            made.add(parent)
+                        if f.multi:
+                            # файл из нескольких экстентов (больше 4 ГБ) — редкость, его собирает pycdlib
+                            with open(dest, "wb") as out:
+                                iso.get_file_from_iso_fp(out, iso_path=f.iso_path)
+                            done(f)
+                        elif f.size > reader.chunk:
+                            if skip(f, reader.read(f.offset, 132)):
+                                continue
+                            # крупный файл пишем сами, окнами: очередь писателей не растёт на его размер
+                            with open(dest, "wb") as out:
+                                reader.copy(f.offset, f.size, out)
+                            done(f)
+                        else:
+                            data = reader.read(f.offset, f.size)
+                            if skip(f, data):
+                                continue
+                            pending.append((pool.submit(_write_file, dest, data), f))
+                            pending_bytes += f.size
+                        while pending and (pending[0][0].done() or pending_bytes > ISO_WRITE_BUFFER):
+                            finish(*pending.popleft())
+                    while pending:
+                        finish(*pending.popleft())
+                except BaseException:
+                    for fut, _ in pending:
+                        fut.cancel()
+                    raise
+            return written
+    finally:
+        iso.close()
@@ -0,0 +1,314 @@
+"""Менеджер загрузок: очередь исследований, фоновые потоки, отмена и повтор.
+
+Сеть и распаковка идут в рабочих потоках, GUI получает изменения сигналом
+`changed` (доставляется в поток GUI очередью Qt). Одновременно выполняется
+не больше `workers` загрузок, число можно менять на ходу. Все загрузки
+делят один requests.Session с пулом соединений. С кэшем исследований
+(`StudyCache`) качаются только отсутствующие или изменившиеся серии.
+Локальные образы ISO распаковываются в той же очереди (`add_iso`).
+"""
+import itertools, os, threading, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+import requests
+from requests.adapters import HTTPAdapter
+from PySide6.QtCore import QObject, Signal
+from .cache import StudyCache
+from .extract import extract_archive, extract_iso
+from .transfer import (download_package, prepare_package, stream_extract, fetch_manifest, package_params,
+                       DownloadCancelled)
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+# предел потоков пула; фактическую параллельность ограничивает workers
+MAX_WORKERS = 16
+# как часто (с) передавать в GUI прогресс одной загрузки
+NOTIFY_INTERVAL = 0.1
+
+class Cancelled(Exception):
+    """Загрузка отменена пользователем."""
+
+@dataclass
+class Transfer:
+    id: int
+    study_uid: str
+    target_dir: Path
+    state: str = QUEUED
+    phase: str = ""           # сборка / скачивание / распаковка
+    done: int = 0             # байт (скачано или собрано)
+    total: int = 0
+    files: int = 0
+    message: str = ""
+    error: str | None = None
+    kept: Path | None = None  # сохранённый исходный архив
+    fetched: int | None = None  # серий скачано (с кэшем; 0 — всё взято из кэша)
+    copied: int = 0             # файлов скопировано из кэша вместо жёстких ссылок
+    source: Path | None = None  # локальный образ ISO вместо загрузки с сервера
+    dicom_only: bool = False    # из образа — только DICOM
+    keep_archive: bool = False  # сохранить исходный архив в папке загрузок (как было при постановке)
+    cancel: threading.Event = field(default_factory=threading.Event)
+    notified: float = 0.0
+
+    @property
+    def finished(self) -> bool:
+        return self.state in (DONE, FAILED, CANCELLED)
+
+class TransferManager(QObject):
+    changed = Signal(object)  # Transfer
+
+    def __init__(self, api_base: str, download_dir: Path, workers: int = 2, connections: int = 1,
+                 retries: int = 5, package_jobs: bool = False, stream: bool = True,
+                 cache: StudyCache | None = None, iso_writers: int = 4, parent=None):
+        super().__init__(parent)
+        self.api_base = api_base
+        self.download_dir = Path(download_dir)
+        self.connections = connections
+        self.retries = retries
+        self.package_jobs = package_jobs
+        self.stream = stream
+        self.cache = cache
+        self.iso_writers = iso_writers
+        self._workers = max(1, workers)
+        self._ids = itertools.count(1)
+        self._items: dict[int, Transfer] = {}
+        self._queue: deque[Transfer] = deque()
+        self._running = 0
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="transfer")
+        self.session = requests.Session()
+        # соединений в пуле — на все одновременные загрузки (каждая может качать в несколько потоков)
+        size = MAX_WORKERS * max(1, connections) + 2
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    def set_workers(self, n: int):
+        with self._lock:
+            self._workers = max(1, min(n, MAX_WORKERS))
+        self._pump()
+
+    def items(self) -> list[Transfer]:
+        with self._lock:
+            return list(self._items.values())
+
+    def add(self, study_uid: str, target_dir: Path, keep_archive: bool = False) -> Transfer:
+        target_dir = Path(target_dir)
+        with self._lock:
+            # то же исследование в ту же папку уже в очереди или качается — второе не ставим;
+            # в другую папку — отдельная загрузка
+            for t in self._items.values():
+                if (t.source is None and t.study_uid == study_uid and t.target_dir == target_dir
+                        and not t.finished):
+                    return t
+            t = Transfer(next(self._ids), study_uid, target_dir, keep_archive=keep_archive)
+            self._items[t.id] = t
+            self._queue.append(t)
+        self.changed.emit(t)
+        self._pump()
+        return t
+
+    def add_iso(self, iso_path: Path, target_dir: Path, dicom_only: bool = True) -> Transfer:
+        """Распаковать локальный образ в target_dir/<имя образа> в фоне."""
+        iso_path = Path(iso_path)
+        target_dir = Path(target_dir) / iso_path.stem
+        with self._lock:
+            for t in self._items.values():
+                if t.source == iso_path and t.target_dir == target_dir and not t.finished:
+                    return t
+            t = Transfer(next(self._ids), iso_path.name, target_dir,
+                         source=iso_path, dicom_only=dicom_only)
+            self._items[t.id] = t
+            self._queue.append(t)
+        self.changed.emit(t)
+        self._pump()
+        return t
+
+    def cancel(self, tid: int):
+        with self._lock:
+            t = self._items.get(tid)
+            if t is None or t.finished:
+                return
+            t.cancel.set()
+            if t.state == QUEUED:
+                self._queue.remove(t)
+                t.state, t.message = CANCELLED, "Отменено"
+        self.changed.emit(t)
+
+    def retry(self, tid: int):
+        with self._lock:
+            t = self._items.get(tid)
+            if t is None or t.state not in (FAILED, CANCELLED):
+                return
+            t.cancel = threading.Event()
+            t.state, t.phase, t.error, t.message = QUEUED, "", None, ""
+            t.done = t.total = t.files = t.copied = 0
+            t.fetched = t.kept = None
+            self._queue.append(t)
+        self.changed.emit(t)
+        self._pump()
+
+    def remove_finished(self) -> list[int]:
+        with self._lock:
+            gone = [tid for tid, t in self._items.items() if t.finished]
+            for tid in gone:
+                del self._items[tid]
+        return gone
+
+    def shutdown(self):
+        with self._lock:
+            for t in self._items.values():
+                t.cancel.set()
+            self._queue.clear()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+    def _pump(self):
+        started = []
+        with self._lock:
+            while self._queue and self._running < self._workers:
+                t = self._queue.popleft()
+                t.state = RUNNING
+                self._running += 1
+                started.append(t)
+        for t in started:
+            self.changed.emit(t)
+            self._pool.submit(self._run, t)
+
+    def _notify(self, t: Transfer, force: bool = False):
+        if t.cancel.is_set():
+            raise Cancelled()
+        now = time.monotonic()
+        if force or now - t.notified >= NOTIFY_INTERVAL:
+            t.notified = now
+            self.changed.emit(t)
+
+    def _run(self, t: Transfer):
+        try:
+            self._transfer(t)
+            t.state = DONE
+            t.message = f"Распаковано в: {t.target_dir}" + (f", архив: {t.kept}" if t.kept else "")
+            if t.fetched == 0:
+                t.message += " (из кэша)"
+            if t.copied:
+                # папка на другом разделе, чем STUDY_CACHE_DIR: ссылки невозможны, файлы копируются
+                t.message += f"; скопировано из кэша файлов: {t.copied} — кэш на другом разделе"
+        except (Cancelled, DownloadCancelled):
+            t.state, t.message = CANCELLED, "Отменено"
+        except Exception as e:
+            t.state, t.error, t.message = FAILED, str(e), f"Ошибка: {e}"
+        finally:
+            with self._lock:
+                self._running -= 1
+            self.changed.emit(t)
+            self._pump()
+
+    def _transfer(self, t: Transfer):
+        suid = t.study_uid
+        self._notify(t, force=True)
+        if t.source is not None:
+            self._extract_iso(t)
+            return
+        manifest = fetch_manifest(self.session, self.api_base, suid) if self.cache is not None else None
+        if manifest is None:
+            self._fetch(t, t.target_dir)
+        else:
+            self._from_cache(t, manifest)
+        now = time.time()
+        os.utime(t.target_dir, (now, now))
+
+    def _from_cache(self, t: Transfer, manifest: dict):
+        suid = t.study_uid
+        lock = self.cache.acquire(suid)
+        try:
+            # то же исследование качается в другую папку — ждём его, потом берём готовое из кэша
+            while not lock.acquire(timeout=0.5):
+                t.phase, t.message = "Ожидание кэша", "исследование скачивается другой загрузкой"
+                self._notify(t)
+            try:
+                self._from_cache_locked(t, manifest)
+            finally:
+                lock.release()
+        finally:
+            self.cache.release(suid)
+        self.cache.evict()
+
+    def _from_cache_locked(self, t: Transfer, manifest: dict):
+        suid = t.study_uid
+        missing = self.cache.missing_series(suid, manifest)
+        t.fetched = len(missing)
+        if missing:
+            staging = self.cache.staging(suid, str(t.id))
+            try:
+                # не хватает всего исследования — полный архив (его сервер скорее всего уже собрал)
+                subset = missing if len(missing) < len(manifest["series"]) else None
+                self._fetch(t, staging, subset)
+                self.cache.put(suid, staging, manifest, missing)
+            finally:
+                self.cache.drop_staging(staging)
+
+        def on_local(files: int, total: int):
+            t.phase = "Из кэша"
+            t.files, t.done, t.total = files, files, total
+            t.message = f"файлов {files} из {total}"
+            self._notify(t)
+
+        t.copied = self.cache.materialize(suid, manifest, t.target_dir, progress=on_local)
+
+    def _extract_iso(self, t: Transfer):
+        t.phase = "Распаковка ISO"
+
+        def on_file(files: int, done: int, total: int, name: str):
+            t.files, t.done, t.total = files, done, total
+            t.message = f"распаковано файлов: {files}"
+            self._notify(t)
+
+        extract_iso(t.source, t.target_dir, progress=on_file, dicom_only=t.dicom_only, writers=self.iso_writers)
+
+    def _fetch(self, t: Transfer, dest: Path, series_uids: list[str] | None = None):
+        # скачать архив исследования (или только series_uids) и распаковать в dest
+        suid = t.study_uid
+
+        def on_job(job: dict):
+            t.phase = "Сборка архива"
+            t.done, t.total = job["bytes_done"], job["bytes_total"]
+            eta = f", осталось ~{int(job['eta_sec'])} с" if job.get("eta_sec") is not None else ""
+            t.message = f"файлов {job['files_done']} из {job['files_total']}{eta}"
+            self._notify(t)
+
+        def on_file(files: int, downloaded: int, total: int, name: str):
+            t.phase = "Скачивание и распаковка"
+            t.files, t.done, t.total = files, downloaded, total
+            t.message = f"распаковано файлов: {files}"
+            self._notify(t)
+
+        def on_bytes(downloaded: int, total: int):
+            t.phase = "Скачивание"
+            t.done, t.total = downloaded, total
+            self._notify(t)
+
+        url, params = f"{self.api_base}/package", package_params(suid, series_uids)
+        if self.package_jobs:
+            url, params = prepare_package(self.session, self.api_base, suid, progress=on_job, series_uids=series_uids)
+        keep_dir = self.download_dir if t.keep_archive else None
+        if self.stream:
+            # распаковка на лету: архив целиком на диск не пишется и заново не читается
+            t.kept = stream_extract(self.session, url, params, suid, dest, progress=on_file,
+                                    keep_dir=keep_dir, retries=self.retries)
+        else:
+            pkg_path = download_package(self.session, url, params, suid, self.download_dir, progress=on_bytes,
+                                        connections=self.connections, retries=self.retries, cancel=t.cancel)
+            t.phase, t.message = "Распаковка", ""
+            self._notify(t, force=True)
+            extract_archive(pkg_path, dest)
+            if keep_dir is None:
+                try:
+                    os.remove(pkg_path)
+                except OSError:
+                    pass
+            else:
+                t.kept = pkg_path
@@ -0,0 +1,398 @@
+"""Скачивание архивов с сервера без привязки к GUI.
+
+Докачка после обрыва через Range/If-Range (ETag архива) и, по желанию,
+параллельная загрузка одного архива несколькими диапазонами. Большие
+архивы сначала собираются заданием на сервере (`/package-jobs`), клиент
+опрашивает его прогресс и качает уже готовый файл. `stream_extract`
+распаковывает tar.zst прямо из ответа, не записывая архив на диск.
+"""
+import json, os, re, tarfile, time, threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from pathlib import Path
+from typing import Callable
+import requests
+
+CHUNK_SIZE = 1024 * 1024
+# меньше этого архив на диапазоны не режем — накладные расходы дороже выигрыша
+MIN_SEGMENT = 8 * 1024 * 1024
+RETRY_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+Progress = Callable[[int, int], None]  # (скачано байт, всего байт; 0 — неизвестно)
+JobProgress = Callable[[dict], None]   # статус задания сборки: files_done, bytes_done, eta_sec...
+FileProgress = Callable[[int, int, int, str], None]  # (распаковано файлов, скачано байт, всего байт, имя файла)
+
+class DownloadCancelled(Exception):
+    """Загрузку отменили (событие cancel) — потоки диапазонов остановились, .part остаётся для докачки."""
+
+class ArchiveChanged(Exception):
+    """Сервер отдал архив целиком вместо диапазона: ETag сменился, докачка невозможна."""
+
+class PackageJobFailed(Exception):
+    """Сборка архива на сервере завершилась ошибкой."""
+
+def resolve_filename(response: requests.Response, suid: str) -> str:
+    cd = response.headers.get("Content-Disposition", "")
+    m = re.search(r'filename="?([^";]+)"?', cd)
+    if m:
+        return m.group(1)
+    ctype = response.headers.get("Content-Type", "")
+    if "zip" in ctype:
+        return f"{suid}.zip"
+    if "tar" in ctype:
+        return f"{suid}.tar"
+    if "zstd" in ctype:
+        return f"{suid}.tar.zst"
+    if "iso" in ctype:
+        return f"{suid}.iso"
+    return f"{suid}.pkg"
+
+def _total_from(r: requests.Response, offset: int) -> int:
+    m = re.match(r"bytes \d+-\d+/(\d+)", r.headers.get("Content-Range", ""))
+    if m:
+        return int(m.group(1))
+    length = r.headers.get("Content-Length")
+    return offset + int(length) if length else 0
+
+def _remove(path: Path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+class _Meta:
+    """Состояние недокачанного архива рядом с .part: ETag, имя, размер, диапазоны."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.data: dict = {}
+        if path.exists():
+            try:
+                self.data = json.loads(path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                self.data = {}
+
+    def save(self):
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps(self.data), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+    def reset(self):
+        self.data = {}
+        _remove(self.path)
+
+def _fetch_stream(session: requests.Session, url: str, params: dict, suid: str, part: Path,
+                  meta: _Meta, progress: Progress | None, timeout) -> None:
+    offset = part.stat().st_size if part.exists() and meta.data.get("etag") else 0
+    headers = {}
+    if offset:
+        headers = {"Range": f"bytes={offset}-", "If-Range": meta.data["etag"]}
+    with session.get(url, params=params, headers=headers, stream=True, timeout=timeout) as r:
+        if r.status_code == 416 and offset and offset == meta.data.get("total"):
+            return  # всё уже скачано, не успели только переименовать
+        r.raise_for_status()
+        if r.status_code != 206:
+            offset = 0  # сервер отдал архив заново
+        total = _total_from(r, offset)
+        meta.data.update(etag=r.headers.get("ETag"), filename=resolve_filename(r, suid), total=total)
+        meta.save()
+        with open(part, "r+b" if offset else "wb") as f:
+            f.seek(offset)
+            f.truncate()
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                if not chunk:
+                    continue
+                f.write(chunk)
+                offset += len(chunk)
+                if progress:
+                    progress(offset, total)
+    if total and offset < total:
+        raise requests.exceptions.ChunkedEncodingError(f"получено {offset} из {total} байт")
+
+def _probe(session: requests.Session, url: str, params: dict, suid: str, timeout) -> dict | None:
+    # HEAD: сервер дожидается готового архива и сообщает длину и ETag
+    r = session.head(url, params=params, timeout=timeout)
+    r.raise_for_status()
+    total = int(r.headers.get("Content-Length") or 0)
+    etag = r.headers.get("ETag")
+    if not total or not etag or r.headers.get("Accept-Ranges") != "bytes":
+        return None
+    return {"etag": etag, "filename": resolve_filename(r, suid), "total": total}
+
+def _fetch_segment(session: requests.Session, url: str, params: dict, part: Path, seg: list,
+                   etag: str, lock: threading.Lock, timeout, cancel: threading.Event | None = None) -> None:
+    start, end, pos = seg
+    if pos >= end or (cancel is not None and cancel.is_set()):
+        return
+    headers = {"Range": f"bytes={pos}-{end - 1}", "If-Range": etag}
+    with session.get(url, params=params, headers=headers, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise ArchiveChanged(url)
+        with open(part, "r+b") as f:
+            f.seek(pos)
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                if not chunk:
+                    continue
+                chunk = chunk[:end - pos]
+                f.write(chunk)
+                pos += len(chunk)
+                with lock:
+                    seg[2] = pos
+                if pos >= end:
+                    break
+                if cancel is not None and cancel.is_set():
+                    # докачанное сохранено в seg — при повторе продолжим с pos
+                    return
+    if pos < end:
+        raise requests.exceptions.ChunkedEncodingError(f"диапазон {start}-{end}: получено до {pos}")
+
+def _fetch_parallel(session: requests.Session, url: str, params: dict, part: Path, meta: _Meta,
+                    connections: int, progress: Progress | None, timeout,
+                    cancel: threading.Event | None = None) -> None:
+    total = meta.data["total"]
+    if not meta.data["segments"] or not part.exists():
+        step = -(-total // connections)
+        meta.data["segments"] = [[a, min(a + step, total), a] for a in range(0, total, step)]
+        with open(part, "wb") as f:
+            f.truncate(total)
+        meta.save()
+    segments = meta.data["segments"]
+    lock = threading.Lock()
+    try:
+        with ThreadPoolExecutor(max_workers=connections) as ex:
+            pending = {ex.submit(_fetch_segment, session, url, params, part, seg, meta.data["etag"], lock, timeout,
+                                 cancel)
+                       for seg in segments}
+            while pending:
+                # прогресс отдаём из вызывающего потока — колбэк может трогать GUI
+                done, pending = wait(pending, timeout=0.2, return_when=FIRST_EXCEPTION)
+                if progress:
+                    with lock:
+                        got = sum(pos - start for start, _, pos in segments)
+                    progress(got, total)
+                for f in done:
+                    if f.exception() is not None:
+                        raise f.exception()
+        if cancel is not None and cancel.is_set():
+            raise DownloadCancelled(url)
+    finally:
+        with lock:
+            meta.save()
+
+def download_package(session: requests.Session, url: str, params: dict, suid: str, dest_dir: Path,
+                     progress: Progress | None = None, connections: int = 1, retries: int = 5,
+                     timeout=(10, 600), cancel: threading.Event | None = None) -> Path:
+    """Скачать архив в dest_dir с докачкой; вернуть путь к готовому файлу.
+
+    Недокачанный архив лежит как `<suid>.part` (+ `.part.json` с ETag и диапазонами)
+    и продолжается при следующем вызове, если архив на сервере не изменился.
+    cancel — событие отмены: потоки диапазонов проверяют его на каждом куске.
+    """
+    part = dest_dir / f"{suid}.part"
+    meta = _Meta(dest_dir / f"{suid}.part.json")
+    attempt = 0
+    while True:
+        try:
+            if connections > 1 and "segments" not in meta.data and not part.exists():
+                probed = _probe(session, url, params, suid, timeout)
+                if probed and probed["total"] >= MIN_SEGMENT * 2:
+                    meta.data = dict(probed, segments=[])
+            if "segments" in meta.data:
+                _fetch_parallel(session, url, params, part, meta, connections, progress, timeout, cancel)
+            else:
+                _fetch_stream(session, url, params, suid, part, meta, progress, timeout)
+            break
+        except (ArchiveChanged, *RETRY_ERRORS) as e:
+            if isinstance(e, ArchiveChanged):
+                # архив на сервере пересобран — начинаем с нуля
+                meta.reset()
+                _remove(part)
+            attempt += 1
+            if attempt > retries:
+                raise
+            time.sleep(min(2 ** attempt, 30))
+    final = dest_dir / (meta.data.get("filename") or f"{suid}.pkg")
+    os.replace(part, final)
+    meta.reset()
+    return final
+
+def package_params(suid: str, series_uids: list[str] | None = None) -> dict:
+    params = {"study_uid": suid}
+    if series_uids:
+        params["series_uid"] = list(series_uids)  # повторяемый параметр
+    return params
+
+def fetch_manifest(session: requests.Session, api_base: str, suid: str, timeout=(10, 60)) -> dict | None:
+    """Состав архива исследования без скачивания; None — сервер не умеет `/package/manifest`."""
+    r = session.get(f"{api_base}/package/manifest", params={"study_uid": suid}, timeout=timeout)
+    if r.status_code == 405:
+        return None
+    if r.status_code == 404 and "application/json" in r.headers.get("Content-Type", ""):
+        if r.json().get("detail") == "Not Found":
+            return None  # маршрута нет — старый сервер (иначе 404 — нет исследования)
+    r.raise_for_status()
+    return r.json()
+
+def prepare_package(session: requests.Session, api_base: str, suid: str, progress: JobProgress | None = None,
+                    poll: float = 1.0, timeout=(10, 60), series_uids: list[str] | None = None) -> tuple[str, dict]:
+    """Дождаться сборки архива заданием на сервере; вернуть (url, params) для download_package.
+
+    Сервер без `/package-jobs` — сразу отдаём прежний `/package` (сборка внутри запроса).
+    series_uids — только эти серии исследования.
+    """
+    fallback = (f"{api_base}/package", package_params(suid, series_uids))
+    r = session.post(f"{api_base}/package-jobs", params=package_params(suid, series_uids), timeout=timeout)
+    if r.status_code in (404, 405):
+        return fallback  # старый сервер; если исследования нет, /package сам ответит 404
+    r.raise_for_status()
+    job = r.json()
+    while True:
+        if progress:
+            progress(job)
+        if job["state"] == "done":
+            return f"{api_base}/package-jobs/{job['id']}/download", {}
+        if job["state"] == "failed":
+            raise PackageJobFailed(job.get("error") or "package build failed")
+        time.sleep(poll)
+        try:
+            r = session.get(f"{api_base}/package-jobs/{job['id']}", timeout=timeout)
+        except RETRY_ERRORS:
+            continue
+        if r.status_code == 404:
+            return fallback  # сервер перезапущен и задание потеряно
+        r.raise_for_status()
+        job = r.json()
+
+class _HttpStream:
+    """Тело ответа как файл (read) для распаковщика.
+
+    После обрыва переподключается с того же байта (Range/If-Range), так что
+    состояние распаковщика не теряется. Архив на сервере сменился — ArchiveChanged.
+    Полученные байты по желанию дублируются в keep (сохранение исходного архива).
+    """
+
+    def __init__(self, session: requests.Session, url: str, params: dict, suid: str,
+                 keep=None, retries: int = 5, timeout=(10, 600)):
+        self.session, self.url, self.params, self.suid = session, url, params, suid
+        self.keep = keep
+        self.retries = retries
+        self.timeout = timeout
+        self.offset = 0
+        self.total = 0
+        self.etag: str | None = None
+        self.filename: str | None = None
+        self._attempt = 0
+        self._resp: requests.Response | None = None
+        self._it = None
+        self._buf = b""
+        self._connect()
+
+    def _open(self):
+        headers = {}
+        if self.offset:
+            if not self.etag:
+                raise ArchiveChanged(self.url)  # без ETag продолжить с середины нельзя
+            headers = {"Range": f"bytes={self.offset}-", "If-Range": self.etag}
+        r = self.session.get(self.url, params=self.params, headers=headers, stream=True, timeout=self.timeout)
+        try:
+            r.raise_for_status()
+            if self.offset and r.status_code != 206:
+                raise ArchiveChanged(self.url)
+        except BaseException:
+            r.close()
+            raise
+        if not self.offset:
+            self.total = _total_from(r, 0)
+            self.etag = r.headers.get("ETag")
+            self.filename = resolve_filename(r, self.suid)
+        self._resp = r
+        self._it = r.iter_content(chunk_size=CHUNK_SIZE)
+
+    def _connect(self):
+        while True:
+            try:
+                self._open()
+                return
+            except RETRY_ERRORS as e:
+                self._backoff(e)
+
+    def _backoff(self, error: Exception):
+        self.close()
+        self._attempt += 1
+        if self._attempt > self.retries:
+            raise error
+        time.sleep(min(2 ** self._attempt, 30))
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._buf:
+            try:
+                chunk = next(self._it, None)
+                if chunk is None and self.total and self.offset < self.total:
+                    raise requests.exceptions.ChunkedEncodingError(f"получено {self.offset} из {self.total} байт")
+            except RETRY_ERRORS as e:
+                self._backoff(e)
+                self._connect()
+                continue
+            if chunk is None:
+                return b""
+            self.offset += len(chunk)
+            if self.keep is not None:
+                self.keep.write(chunk)
+            self._buf = chunk
+        out = self._buf if size < 0 else self._buf[:size]
+        self._buf = self._buf[len(out):]
+        return out
+
+    def close(self):
+        if self._resp is not None:
+            self._resp.close()
+            self._resp = None
+
+def stream_extract(session: requests.Session, url: str, params: dict, suid: str, target_dir: Path,
+                   progress: FileProgress | None = None, keep_dir: Path | None = None, retries: int = 5,
+                   timeout=(10, 600)) -> Path | None:
+    """Скачать tar.zst и распаковать на лету: ответ → zstd → tar → файлы в target_dir.
+
+    Архив на диск не пишется; keep_dir — сохранить его ещё и туда (вернуть путь).
+    Файлы появляются по мере прихода, прогресс — после каждого файла.
+    """
+    import zstandard as zstd
+    attempt = 0
+    while True:
+        keep_part = keep_dir / f"{suid}.stream.part" if keep_dir else None
+        keep = open(keep_part, "wb") if keep_part else None
+        src = None
+        try:
+            src = _HttpStream(session, url, params, suid, keep=keep, retries=retries, timeout=timeout)
+            if not (src.filename or "").lower().endswith(".tar.zst"):
+                raise ValueError(f"потоковая распаковка поддерживает только tar.zst, получен {src.filename}")
+            # архив — склейка кадров zstd по сериям, читаем их все
+            with zstd.ZstdDecompressor().stream_reader(src, read_across_frames=True) as reader, \
+                    tarfile.open(fileobj=reader, mode="r|") as tf:
+                files = 0
+                for member in tf:
+                    # имена приходят из сети: filter="data" не пускает абсолютные пути, ".." и ссылки наружу
+                    tf.extract(member, path=target_dir, filter="data")
+                    if member.isfile():
+                        files += 1
+                        if progress:
+                            progress(files, src.offset, src.total, member.name)
+            break
+        except BaseException as e:
+            if keep is not None:
+                keep.close()
+                _remove(keep_part)
+            # архив пересобран посреди загрузки — распаковываем заново, файлы перезапишутся
+            attempt += 1
+            if not isinstance(e, ArchiveChanged) or attempt > retries:
+                raise
+        finally:
+            if src is not None:
+                src.close()
+            if keep is not None:
+                keep.close()
+    if keep_part is None:
+        return None
+    final = keep_dir / (src.filename or f"{suid}.tar.zst")
+    os.replace(keep_part, final)
+    return final
@@ -1,77 +1,405 @@
-
-import argparse
+import argparse, errno, multiprocessing, os, sys, time, queue, threading
+from itertools import islice
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import pydicom
-from pydicom.errors import InvalidDicomError
-from sqlalchemy import select
-from server.db import SessionLocal, Base, engine, Patient, Study, Series, Instance
+from typing import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from sqlalchemy import select, func
+from sqlalchemy.exc import OperationalError
+from server.db import (SessionLocal, ReadSession, stream, ensure_schema, Patient, Study, Series, Instance, IndexedFile,
+                       IndexedDir)
 from server.utils import normalize_name
+from server.packager import coordinator
+from server.bulk import HeaderRecord, BatchWriter, file_row, bump_study_aggregates
+from server.dcmheader import parse_header, parse_many
+from server.metrics import INDEX_BYTES, count_files, file_counts, finish_run
 
-TAGS = ["StudyInstanceUID","SeriesInstanceUID","SOPInstanceUID",
-        "PatientID","PatientName","PatientBirthDate","PatientSex",
-        "StudyDate","Modality","TransferSyntaxUID"]
+# файлов на одну задачу пула разбора
+PARSE_CHUNK = 256
+# сколько найденных файлов может ждать разбора — память не растёт с размером дерева
+WALK_QUEUE = 20000
 
-def process_file(p: Path) -> tuple[bool,str]:
-    try:
-        ds = pydicom.dcmread(str(p), stop_before_pixels=True, force=True, specific_tags=TAGS)
-    except InvalidDicomError:
-        return False, "invalid"
-    except Exception as e:
-        return False, "error"
-    # minimal required tags
-    for key in ("StudyInstanceUID","SeriesInstanceUID","SOPInstanceUID"):
-        if not getattr(ds, key, None):
-            return False, "missing_tags"
+Item = tuple[Path, int, int]  # (путь, размер, mtime_ns)
+
+def process_file(p: Path, touched: set[str] | None = None) -> tuple[bool,str]:
+    rec = parse_header(p)
+    if isinstance(rec, str):
+        return False, rec
     # write to DB (upserts)
     try:
         with SessionLocal() as s:
-            patient_id = str(getattr(ds, "PatientID", ""))
-            patient_name = str(getattr(ds, "PatientName", ""))
-            birth_date = str(getattr(ds, "PatientBirthDate", ""))
-            sex = str(getattr(ds, "PatientSex", ""))
-            study_uid = str(ds.StudyInstanceUID); series_uid = str(ds.SeriesInstanceUID); sop_uid = str(ds.SOPInstanceUID)
-            study_date = str(getattr(ds, "StudyDate", ""))
-            ts = str(getattr(ds, "TransferSyntaxUID", ""))
             # patient
-            p_row = s.execute(select(Patient).where(Patient.patient_id==patient_id, Patient.birth_date==birth_date)).scalar_one_or_none()
+            p_row = s.execute(select(Patient).where(Patient.patient_id==rec.patient_id, Patient.birth_date==rec.birth_date)).scalar_one_or_none()
             if not p_row:
-                p_row = Patient(patient_id=patient_id, birth_date=birth_date, sex=sex,
-                                patient_name=patient_name, patient_name_norm=normalize_name(patient_name))
+                p_row = Patient(patient_id=rec.patient_id, birth_date=rec.birth_date, sex=rec.sex,
+                                patient_name=rec.patient_name, patient_name_norm=normalize_name(rec.patient_name))
                 s.add(p_row); s.flush()
-            st = s.get(Study, study_uid)
+            st = s.get(Study, rec.study_uid)
             if not st:
-                st = Study(study_uid=study_uid, patient_fk=p_row.id, study_date=study_date, modality=str(getattr(ds, "Modality", "")))
+                st = Study(study_uid=rec.study_uid, patient_fk=p_row.id, study_date=rec.study_date, modality=rec.modality)
                 s.add(st)
-            se = s.get(Series, series_uid)
+            se = s.get(Series, rec.series_uid)
+            new_series = False
             if not se:
-                se = Series(series_uid=series_uid, study_uid=study_uid)
+                se = Series(series_uid=rec.series_uid, study_uid=rec.study_uid, modality=rec.modality)
                 s.add(se)
-            inst = s.get(Instance, sop_uid)
+                new_series = True
+            inst = s.get(Instance, rec.sop_uid)
+            added = False
             if not inst:
-                size = Path(p).stat().st_size
-                inst = Instance(sop_uid=sop_uid, series_uid=series_uid, transfer_syntax=ts, size_bytes=size, path=str(p))
+                inst = Instance(sop_uid=rec.sop_uid, series_uid=rec.series_uid, transfer_syntax=rec.transfer_syntax,
+                                size_bytes=rec.size, path=rec.path, mtime=rec.mtime_ns // 1_000_000_000 or None)
                 s.add(inst)
+                added = True
+                s.flush()
+                bump_study_aggregates(s, rec.study_uid, rec.size, new_series)
             s.commit()
+            if touched is not None and added:
+                touched.add(rec.study_uid)
         return True, "ok"
     except Exception as e:
         return False, "db_error"
 
+class Changes:
+    """Итог инкрементального обхода: изменившиеся и исчезнувшие файлы, mtime каталогов."""
+
+    def __init__(self):
+        self.changed: set[str] = set()
+        self.deleted: list[str] = []
+        self.dirs: dict[str, int] = {}
+        self.gone_dirs: list[str] = []
+
+def visit_full(d: str, subdirs: list[str]) -> Iterator[Item]:
+    # один каталог: файлы отдаём, подкаталоги складываем в subdirs
+    with os.scandir(d) as it:
+        for de in it:
+            try:
+                if de.is_dir(follow_symlinks=False):
+                    subdirs.append(de.path)
+                    continue
+                if not de.is_file():
+                    continue
+                st = de.stat()
+            except OSError:
+                continue
+            yield Path(de.path), st.st_size, st.st_mtime_ns
+
+class IncrementalVisitor:
+    """Отдаёт только новые/изменённые файлы (по size+mtime), собирает удалённые.
+
+    trust_dir_mtime: в каталогах с прежним mtime не делать stat известных файлов
+    (состав каталога не менялся; перезапись файла на месте не заметим).
+    """
+
+    def __init__(self, root: Path, changes: Changes, trust_dir_mtime: bool = False):
+        self.changes = changes
+        self.trust_dir_mtime = trust_dir_mtime
+        self.root = str(root)
+        with ReadSession() as s:
+            q = select(IndexedDir.path, IndexedDir.mtime_ns).where(self._under(IndexedDir.path))
+            self.known_dirs = {path: mtime for path, mtime in stream(s, q)}
+
+    def _under(self, col):
+        return (col == self.root) | col.startswith(self.root + os.sep, autoescape=True)
+
+    def __call__(self, d: str, subdirs: list[str]) -> Iterator[Item]:
+        dir_mtime = os.stat(d).st_mtime_ns
+        prev_mtime = self.known_dirs.pop(d, None)
+        unchanged_dir = self.trust_dir_mtime and prev_mtime == dir_mtime
+        with ReadSession() as s:
+            known = {path: (size, mtime) for path, size, mtime in s.execute(
+                select(IndexedFile.path, IndexedFile.size, IndexedFile.mtime_ns).where(IndexedFile.dir == d))}
+        with os.scandir(d) as it:
+            for de in it:
+                try:
+                    if de.is_dir(follow_symlinks=False):
+                        subdirs.append(de.path)
+                        continue
+                    if not de.is_file():
+                        continue
+                    old = known.pop(de.path, None)
+                    if unchanged_dir and old is not None:
+                        continue
+                    st = de.stat()
+                except OSError:
+                    continue
+                if old == (st.st_size, st.st_mtime_ns):
+                    continue
+                if old is not None:
+                    self.changes.changed.add(de.path)
+                yield Path(de.path), st.st_size, st.st_mtime_ns
+        self.changes.deleted.extend(known)
+        self.changes.dirs[d] = dir_mtime
+
+    def finish(self, failed: Iterable[str] = ()):
+        # каталоги, которых больше нет, вместе с их файлами; берём их и из отпечатков файлов —
+        # mtime каталогов мог ещё ни разу не сохраняться (первый --incremental после полного прохода).
+        # failed — каталоги, которые не удалось прочитать (EIO, ESTALE на NAS): они и их
+        # поддеревья не удалены, их индекс не трогаем
+        failed = tuple(failed)
+        prefixes = tuple(f + os.sep for f in failed)
+
+        def unreadable(d: str) -> bool:
+            return d in failed or d.startswith(prefixes)
+
+        self.changes.gone_dirs = [d for d in self.known_dirs if not unreadable(d)]
+        with ReadSession() as s:
+            file_dirs = stream(s, select(IndexedFile.dir).where(self._under(IndexedFile.dir)).distinct()).scalars()
+            gone = set(self.changes.gone_dirs) | {d for d in file_dirs
+                                                  if d not in self.changes.dirs and not unreadable(d)}
+            for d in gone:
+                self.changes.deleted.extend(s.execute(select(IndexedFile.path).where(IndexedFile.dir == d)).scalars())
+
+_END = object()
+
+class Walker:
+    """Потоковый обход дерева на os.scandir.
+
+    Найденные файлы идут в ограниченную очередь, поэтому индексация начинается
+    сразу, а память не зависит от размера дерева. parallel > 1 — каталоги
+    верхнего уровня обходятся параллельно (на NAS задержка листинга велика).
+    Каталоги, которые не удалось прочитать (кроме исчезнувших), копятся в failed.
+    """
+
+    def __init__(self, root: Path, visit: Callable[[str, list[str]], Iterator[Item]] = visit_full,
+                 parallel: int = 1, queue_size: int = WALK_QUEUE):
+        self.root = str(root)
+        self.visit = visit
+        self.parallel = max(parallel, 1)
+        self.files = 0
+        self.bytes = 0
+        self.done = False
+        self.error: BaseException | None = None
+        self.failed: list[str] = []
+        self._q: queue.Queue = queue.Queue(maxsize=queue_size)
+
+    def _walk_dir(self, d: str) -> list[str]:
+        subdirs: list[str] = []
+        try:
+            for item in self.visit(d, subdirs):
+                self._q.put(item)
+        except OSError as e:
+            # исчезнувший каталог — удаление; прочие ошибки (сбой NAS) удалением считать нельзя
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                self.failed.append(d)
+                print(f"cannot list {d}: {e}", file=sys.stderr, flush=True)
+        return subdirs
+
+    def _walk_tree(self, top: str):
+        stack = [top]
+        while stack:
+            stack.extend(self._walk_dir(stack.pop()))
+
+    def _run(self):
+        try:
+            top = self._walk_dir(self.root)
+            if self.parallel > 1:
+                with ThreadPoolExecutor(max_workers=self.parallel, thread_name_prefix="walk") as ex:
+                    list(ex.map(self._walk_tree, top))
+            else:
+                for d in top:
+                    self._walk_tree(d)
+        except BaseException as e:
+            self.error = e
+        finally:
+            self._q.put(_END)
+
+    def __iter__(self) -> Iterator[Item]:
+        threading.Thread(target=self._run, name="walker", daemon=True).start()
+        while True:
+            item = self._q.get()
+            if item is _END:
+                break
+            self.files += 1
+            self.bytes += item[1]
+            yield item
+        self.done = True
+        if self.error is not None:
+            raise self.error
+
+class Progress:
+    """Периодический отчёт в stderr: найдено/обработано, файлов/с, байт/с, ETA."""
+
+    def __init__(self, walker: Walker, expected: int = 0, interval: float = 5.0):
+        self.walker = walker
+        self.expected = expected
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self.t0 = self._last = time.monotonic()
+
+    def update(self, files: int, nbytes: int):
+        self.files += files
+        self.bytes += nbytes
+        now = time.monotonic()
+        if now - self._last >= self.interval:
+            self._last = now
+            self.report()
+
+    def report(self):
+        el = max(time.monotonic() - self.t0, 1e-6)
+        rate, brate = self.files / el, self.bytes / el
+        total = self.walker.files if self.walker.done else max(self.walker.files, self.expected)
+        if rate and total and (self.walker.done or self.expected):
+            eta = f"{max(total - self.files, 0) / rate:.0f}s"
+        else:
+            eta = "?"
+        walk = "done" if self.walker.done else "in progress"
+        print(f"[{el:.0f}s] found={self.walker.files} ({walk}) processed={self.files} "
+              f"{rate:.0f} files/s {brate / 1024 / 1024:.1f} MB/s ETA {eta}", file=sys.stderr, flush=True)
+
+def _chunked(items: Iterable, n: int) -> Iterator[list]:
+    it = iter(items)
+    while chunk := list(islice(it, n)):
+        yield chunk
+
+def index_batched(items: Iterable[Item], workers: int, batch_size: int,
+                  touched: set[str], changed: set[str] | None = None, backend: str = "process",
+                  fast: bool = True, progress: Progress | None = None, tool: str = "indexer") -> tuple[int, int]:
+    # заголовки читаются параллельно (процессы или потоки), в БД пишет один писатель пачками по batch_size;
+    # tool — метка в метриках (индексатор или демон watcher)
+    writer = BatchWriter(SessionLocal)
+    ok = bad = 0
+    batch: list[HeaderRecord] = []
+    files: list[dict] = []
+
+    def write(recs: list[HeaderRecord], rows: list[dict]):
+        nonlocal ok, bad
+        replaced = [f["path"] for f in rows if changed and f["path"] in changed]
+        try:
+            touched.update(writer.write(recs, files=rows, replaced=replaced))
+            ok += len(recs)
+            count_files(tool, "ok", len(recs))
+            return
+        except OperationalError as e:
+            # БД недоступна или заблокирована — дробить пачку бессмысленно
+            failed, err = rows, e
+        except Exception as e:
+            if len(rows) > 1:
+                # одна плохая строка не должна терять всю пачку: пишем половинами до отдельной записи
+                half = len(rows) // 2
+                for part in (rows[:half], rows[half:]):
+                    paths = {f["path"] for f in part}
+                    write([r for r in recs if r.path in paths], part)
+                return
+            failed, err = rows, e
+        print(f"db_error: {len(failed)} file(s), first {failed[0]['path']}: {err!r}", file=sys.stderr, flush=True)
+        bad += len(recs)
+        count_files(tool, "db_error", len(recs))
+
+    def flush():
+        write(list(batch), list(files))
+        batch.clear()
+        files.clear()
+
+    def collect(fut, chunk):
+        nonlocal bad
+        for (p, size, mtime_ns), rec in zip(chunk, fut.result()):
+            if isinstance(rec, str):
+                bad += 1
+                count_files(tool, rec)
+                # "error" (ошибка чтения) не запоминаем — файл попробуем снова
+                if rec != "error" and size is not None:
+                    files.append(file_row(p, size, mtime_ns, rec))
+            else:
+                batch.append(rec)
+                files.append(file_row(rec.path, rec.size, rec.mtime_ns, "ok"))
+            if len(files) >= batch_size:
+                flush()
+        nbytes = sum(size or 0 for _, size, _ in chunk)
+        INDEX_BYTES.inc(nbytes, tool=tool)
+        if progress:
+            progress.update(len(chunk), nbytes)
+
+    if backend == "process":
+        # к этому моменту уже идёт поток обхода и открыты соединения с БД — fork в таком
+        # состоянии может зависнуть на унаследованной блокировке, поэтому процессы стартуют чисто
+        methods = multiprocessing.get_all_start_methods()
+        ctx = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=ctx)
+    else:
+        pool = ThreadPoolExecutor(max_workers=workers)
+    # в полёте не больше нескольких пачек на воркер — обход не убегает вперёд разбора
+    max_inflight = workers * 4
+    with pool as ex:
+        inflight = {}
+        for chunk in _chunked(((str(p), size, mtime_ns) for p, size, mtime_ns in items), PARSE_CHUNK):
+            inflight[ex.submit(parse_many, chunk, fast)] = chunk
+            if len(inflight) >= max_inflight:
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for f in done:
+                    collect(f, inflight.pop(f))
+        for f in as_completed(list(inflight)):
+            collect(f, inflight.pop(f))
+    if files or batch:
+        flush()
+    return ok, bad
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--root", required=True, help="Корень с DICOM-файлами (каноническая структура или любая)")
     parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=5000,
+                        help="Записей на транзакцию; 0 — старый режим: своя транзакция на каждый файл")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Читать только новые/изменённые файлы (size+mtime), удалённые — убрать из индекса")
+    parser.add_argument("--trust-dir-mtime", action="store_true",
+                        help="С --incremental: не проверять файлы в каталогах с прежним mtime")
+    parser.add_argument("--backend", choices=("process", "thread"), default="process",
+                        help="Пул разбора заголовков в пакетном режиме: процессы (масштабируется по ядрам) или потоки")
+    parser.add_argument("--no-fast-header", action="store_true",
+                        help="Всегда читать заголовки через pydicom, без быстрого разбора первых килобайт")
+    parser.add_argument("--walkers", type=int, default=4,
+                        help="Параллельный обход каталогов верхнего уровня (1 — последовательно)")
+    parser.add_argument("--progress", type=float, default=10.0, help="Интервал отчёта о прогрессе, с (0 — молча)")
+    parser.add_argument("--prebuild", action="store_true", help="Предсобрать архивы затронутых исследований в CACHE_DIR")
     args = parser.parse_args()
-    Base.metadata.create_all(bind=engine)
-    paths = [p for p in Path(args.root).rglob("*") if p.is_file()]
+    ensure_schema()
+    started = time.monotonic()
     ok = bad = 0
-    with ThreadPoolExecutor(max_workers=args.workers) as ex:
-        futs = [ex.submit(process_file, p) for p in paths]
-        for f in as_completed(futs):
-            good, _ = f.result()
-            if good: ok += 1
-            else: bad += 1
-    print(f"indexed ok={ok} bad={bad}")
+    touched: set[str] = set()
+    root = Path(args.root)
+    if args.incremental:
+        changes = Changes()
+        visitor = IncrementalVisitor(root, changes, args.trust_dir_mtime)
+        walker = Walker(root, visitor, parallel=args.walkers)
+        progress = Progress(walker, interval=args.progress) if args.progress else None
+        ok, bad = index_batched(walker, args.workers, max(args.batch_size, 1), touched, changes.changed,
+                                backend=args.backend, fast=not args.no_fast_header, progress=progress)
+        visitor.finish(walker.failed)
+        writer = BatchWriter(SessionLocal)
+        if changes.deleted:
+            touched.update(writer.prune(changes.deleted))
+        writer.save_dirs(changes.dirs, changes.gone_dirs)
+        print(f"changed={len(changes.changed)} deleted={len(changes.deleted)}"
+              + (f" unreadable_dirs={len(walker.failed)}" if walker.failed else ""))
+    elif args.batch_size > 0:
+        # полный проход тоже пишет отпечатки, чтобы следующий --incremental от них отталкивался
+        walker = Walker(root, parallel=args.walkers)
+        progress = None
+        if args.progress:
+            with ReadSession() as s:
+                # ожидаемый объём — сколько файлов под корнем видели в прошлый раз
+                expected = s.execute(select(func.count()).select_from(IndexedFile).where(
+                    IndexedFile.path.startswith(str(root) + os.sep, autoescape=True))).scalar() or 0
+            progress = Progress(walker, expected=expected, interval=args.progress)
+        ok, bad = index_batched(walker, args.workers, args.batch_size, touched,
+                                backend=args.backend, fast=not args.no_fast_header, progress=progress)
+    else:
+        paths = [p for p in Path(args.root).rglob("*") if p.is_file()]
+        with ThreadPoolExecutor(max_workers=args.workers) as ex:
+            futs = [ex.submit(process_file, p, touched) for p in paths]
+            for f in as_completed(futs):
+                good, status = f.result()
+                count_files("indexer", status)
+                if good: ok += 1
+                else: bad += 1
+    reasons = " ".join(f"{k}={v}" for k, v in sorted(file_counts("indexer").items()) if k != "ok")
+    print(f"indexed ok={ok} bad={bad}" + (f" ({reasons})" if reasons else ""))
+    finish_run("indexer", started, ok + bad)
+    if args.prebuild and touched:
+        for f in as_completed(coordinator.prebuild(sorted(touched))):
+            f.result()
+        print(f"prebuilt packages={len(touched)}")
 
 if __name__ == "__main__":
     main()
@@ -1,4 +1,6 @@
 
-from server.db import Base, engine
-Base.metadata.create_all(bind=engine)
+from server.db import ensure_schema
+added = ensure_schema()
+if added:
+    print("Added columns:", ", ".join(added))
 print("DB initialized.")
@@ -0,0 +1,508 @@
+"""Демон непрерывной индексации: следит за DICOM_ROOT и INBOX_DIR.
+
+Новые снимки попадают в поиск через секунды, без ночного прохода индексатора.
+События inotify копятся по каталогу (серии); когда запись в каталог затихла
+на --debounce секунд, каталог сверяется с отпечатками в индексе так же, как
+при `indexer.py --incremental`: новые и изменённые файлы разбираются и пишутся
+пачками (index_batched), исчезнувшие убираются. Каталог сверяется целиком,
+поэтому пропущенные события и недописанные файлы догоняются следующей сверкой.
+
+На NFS/CIFS inotify не видит записей с других машин, поэтому там (и когда не
+хватает fs.inotify.max_user_watches) дерево опрашивается инкрементальным
+проходом раз в --poll секунд.
+
+Новые .iso и каталоги в INBOX_DIR (тоже через inotify, на сетевой ФС — опросом),
+переставшие расти, уходят в ISO-инжест; рост проверяется опросом подписи входа.
+Затронутые исследования после --settle секунд тишины предсобираются
+(--prebuild) или их устаревшие архивы удаляются из кэша.
+
+Запуск: python scripts/watcher.py [--root DICOM_ROOT] [--inbox INBOX_DIR] [--prebuild]
+"""
+import argparse, ctypes, ctypes.util, errno, os, select, struct, sys, time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, Iterator
+
+# запуск как `python scripts/watcher.py` из любого каталога и как `python -m scripts.watcher`:
+# корень проекта — для server, каталог скрипта — для соседнего indexer.py
+_HERE = os.path.dirname(os.path.abspath(__file__))
+for _p in (_HERE, os.path.dirname(_HERE)):
+    if _p not in sys.path:
+        sys.path.insert(0, _p)
+
+from server.config import DICOM_ROOT, INBOX_DIR
+from server.db import SessionLocal, ensure_schema
+from server.bulk import BatchWriter
+from server.packager import cache, coordinator
+from server.ingest.ingest import process_dir
+from server.metrics import WATCH_LAG, count_files, finish_run
+from indexer import Changes, IncrementalVisitor, Item, Walker, index_batched
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+# запись файла заканчивается IN_CLOSE_WRITE, IN_MODIFY не нужен — их тысячи на файл
+TREE_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+# INBOX_DIR: только верхний уровень — появился или дописан вход; рост внутри каталога видно по подписи
+INBOX_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len; дальше имя длиной len
+
+# события inotify на этих ФС приходят только о локальных изменениях
+NETWORK_FS = {"nfs", "nfs4", "cifs", "smb3", "smbfs", "9p", "ceph", "glusterfs", "fuse.glusterfs",
+              "fuse.sshfs", "afs"}
+
+class Inotify:
+    """inotify через ctypes (Linux), без внешних зависимостей."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add = libc.inotify_add_watch
+        self._add.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self._rm = libc.inotify_rm_watch
+        self._rm.argtypes = (ctypes.c_int, ctypes.c_int)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.fd = fd
+
+    def add_watch(self, path: str, mask: int) -> int:
+        wd = self._add(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd: int):
+        self._rm(self.fd, wd)
+
+    def read(self, timeout: float | None) -> list[tuple[int, int, str]]:
+        """События за timeout секунд: (wd, mask, имя)."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buf = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        events, off = [], 0
+        while off < len(buf):
+            wd, mask, _, n = _EVENT.unpack_from(buf, off)
+            off += _EVENT.size
+            events.append((wd, mask, os.fsdecode(buf[off:off + n].rstrip(b"\0"))))
+            off += n
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class WatchLimit(Exception):
+    """Не хватило fs.inotify.max_user_watches — дерево придётся опрашивать."""
+
+class TreeWatch:
+    """Рекурсивное наблюдение за деревом: события переводятся в «грязные» каталоги."""
+
+    def __init__(self, ino: Inotify, root: str):
+        self.ino = ino
+        self.root = root
+        self.dirs: dict[int, str] = {}
+        self.overflow = False
+
+    def add_tree(self, top: str) -> int:
+        # каталоги, созданные, пока мы спускаемся, подхватит сверка top
+        stack, n = [top], 0
+        while stack:
+            d = stack.pop()
+            try:
+                self.dirs[self.ino.add_watch(d, TREE_MASK)] = d
+                n += 1
+                with os.scandir(d) as it:
+                    stack.extend(de.path for de in it if de.is_dir(follow_symlinks=False))
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    raise WatchLimit(d) from e
+        return n
+
+    def _forget(self, top: str):
+        # каталог уехал из-под наблюдаемого места — его наблюдения больше не про это дерево
+        for wd, d in list(self.dirs.items()):
+            if d == top or d.startswith(top + os.sep):
+                self.ino.rm_watch(wd)
+                del self.dirs[wd]
+
+    def handle(self, wd: int, mask: int, name: str) -> Iterator[str]:
+        """Каталоги, которые надо сверить с индексом после события."""
+        if mask & IN_Q_OVERFLOW:
+            self.overflow = True
+            return
+        if mask & IN_IGNORED:
+            self.dirs.pop(wd, None)
+            return
+        d = self.dirs.get(wd)
+        if d is None or not name:
+            return
+        path = os.path.join(d, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(path)
+            elif mask & IN_MOVED_FROM:
+                self._forget(path)
+            yield path
+        else:
+            yield d
+
+class Debouncer:
+    """Ключ отдаётся, когда по нему delay секунд не было событий (но не позже max_wait с первого)."""
+
+    def __init__(self, delay: float, max_wait: float):
+        self.delay = delay
+        self.max_wait = max_wait
+        self._first: dict[str, float] = {}
+        self._last: dict[str, float] = {}
+
+    def touch(self, key: str, now: float | None = None):
+        now = time.monotonic() if now is None else now
+        self._first.setdefault(key, now)
+        self._last[key] = now
+
+    def due(self, now: float | None = None) -> dict[str, float]:
+        """Созревшие ключи с временем первого события; они снимаются с ожидания."""
+        now = time.monotonic() if now is None else now
+        out = {k: self._first[k] for k, last in self._last.items()
+               if now - last >= self.delay or now - self._first[k] >= self.max_wait}
+        for k in out:
+            del self._first[k], self._last[k]
+        return out
+
+    def next_deadline(self) -> float | None:
+        if not self._last:
+            return None
+        return min(min(last + self.delay, self._first[k] + self.max_wait) for k, last in self._last.items())
+
+def fs_type(path: str) -> str:
+    """Тип ФС, на которой лежит path (по самой длинной точке монтирования из /proc/mounts)."""
+    path = os.path.realpath(path)
+    best, kind = "", ""
+    try:
+        with open("/proc/mounts", encoding="utf-8") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) < 3:
+                    continue
+                mnt = parts[1].replace("\\040", " ")
+                if (path == mnt or path.startswith(mnt.rstrip("/") + "/")) and len(mnt) > len(best):
+                    best, kind = mnt, parts[2]
+    except OSError:
+        pass
+    return kind
+
+def _outermost(dirs: Iterable[str]) -> list[str]:
+    # каталог сверяется вместе с подкаталогами — вложенные в уже выбранные не нужны
+    out: list[str] = []
+    for d in sorted(dirs):
+        if not out or not (d == out[-1] or d.startswith(out[-1] + os.sep)):
+            out.append(d)
+    return out
+
+def _signature(path: Path) -> tuple | None:
+    # по ней видно, что копирование в INBOX закончилось: файл — размер и mtime, каталог — сводка по дереву
+    try:
+        st = path.stat()
+        if not path.is_dir():
+            return st.st_size, st.st_mtime_ns
+        n = size = mtime = 0
+        for d, _, files in os.walk(path):
+            for name in files:
+                fst = os.stat(os.path.join(d, name))
+                n, size, mtime = n + 1, size + fst.st_size, max(mtime, fst.st_mtime_ns)
+        return n, size, mtime
+    except OSError:
+        return None
+
+def _inbox_entry(p: Path) -> bool:
+    return not p.name.startswith(".") and (p.is_dir() or p.suffix.lower() == ".iso")
+
+class Inbox:
+    """INBOX_DIR: новые .iso и каталоги, переставшие расти, уходят в инжест по одному.
+
+    С inotify (watch) новые входы приходят событиями, а опрашиваются только те, что
+    ещё растут; без него (сетевая ФС, режим poll) каталог просматривается каждый такт.
+    """
+
+    def __init__(self, root: Path, settle: float, skip_existing: bool = True):
+        self.root = root
+        self.settle = settle
+        self.wd: int | None = None              # наблюдение inotify; None — просмотр каталога
+        self._events: set[str] = set()          # входы, о которых пришли события
+        self._rescan = False
+        self._seen: dict[str, tuple] = {}       # вход -> (подпись, когда снята)
+        self._done: dict[str, tuple | None] = {}
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest")
+        self._running: dict[str, Future] = {}
+        if skip_existing:
+            # лежавшее до запуска уже обработано iso-import@ или прошлым запуском демона
+            for p in self._entries():
+                self._done[p.name] = _signature(p)
+
+    def watch(self, ino: Inotify) -> bool:
+        """Следить за INBOX_DIR через inotify; False — остаётся просмотр каталога."""
+        kind = fs_type(str(self.root))
+        if kind in NETWORK_FS:
+            print(f"{self.root} on {kind}: inotify does not see remote writes, polling inbox", file=sys.stderr, flush=True)
+            return False
+        try:
+            self.wd = ino.add_watch(str(self.root), INBOX_MASK)
+        except OSError as e:
+            print(f"inbox {self.root}: inotify unavailable ({e}), polling inbox", file=sys.stderr, flush=True)
+            return False
+        # входы, появившиеся до наблюдения, подхватит первый просмотр
+        self._rescan = True
+        return True
+
+    def unwatch(self):
+        self.wd = None
+
+    def handle(self, mask: int, name: str):
+        if mask & IN_IGNORED:
+            # каталог INBOX удалён или размонтирован — дальше только просмотр
+            self.wd = None
+        elif name:
+            self._events.add(name)
+
+    def rescan(self):
+        # события потеряны (переполнение очереди) — просмотреть каталог целиком
+        self._rescan = True
+
+    def _entries(self) -> list[Path]:
+        try:
+            return [p for p in self.root.iterdir() if _inbox_entry(p)]
+        except OSError:
+            return []
+
+    def _candidates(self) -> list[Path]:
+        if self.wd is None or self._rescan:
+            self._rescan = False
+            self._events.clear()
+            return self._entries()
+        # пришедшие события плюс входы, которые ещё растут
+        names, self._events = self._events | set(self._seen), set()
+        out = []
+        for name in sorted(names):
+            p = self.root / name
+            if p.exists() and _inbox_entry(p):
+                out.append(p)
+            else:
+                self._seen.pop(name, None)
+        return out
+
+    def poll(self) -> set[str]:
+        """Запустить инжест созревших входов; вернуть исследования из завершившихся."""
+        touched: set[str] = set()
+        for name, fut in list(self._running.items()):
+            if fut.done():
+                del self._running[name]
+                try:
+                    touched |= fut.result() or set()
+                except Exception as e:
+                    print(f"ingest {name}: {e!r}", file=sys.stderr, flush=True)
+        now = time.monotonic()
+        for p in self._candidates():
+            if p.name in self._running:
+                continue
+            if p.name in self._done:
+                if p.is_dir() or self._done[p.name] == _signature(p):
+                    continue
+                # файл с тем же именем заменили — обработаем заново
+                del self._done[p.name]
+            sig = _signature(p)
+            prev = self._seen.get(p.name)
+            if sig is None:
+                continue
+            if prev is None or prev[0] != sig:
+                self._seen[p.name] = (sig, now)
+                continue
+            if now - prev[1] < self.settle:
+                continue
+            del self._seen[p.name]
+            self._done[p.name] = sig
+            print(f"ingest {p}", flush=True)
+            self._running[p.name] = self._pool.submit(process_dir, p, prebuild=False)
+        return touched
+
+class Watcher:
+    def __init__(self, root: Path, args):
+        self.root = str(root)
+        self.args = args
+        self.writer = BatchWriter(SessionLocal)
+        self.dirs = Debouncer(args.debounce, max(args.debounce * 10, 30))
+        self.studies = Debouncer(args.settle, max(args.settle * 10, 600))
+        self.inbox = Inbox(Path(args.inbox), args.debounce, skip_existing=not args.inbox_existing) \
+            if args.inbox else None
+
+    def sync(self, dirs: Iterable[str], trust_dir_mtime: bool = False, first_event: dict[str, float] | None = None):
+        """Сверить каталоги (с подкаталогами) с индексом: дописать новое, убрать исчезнувшее."""
+        started = time.monotonic()
+        dirs = _outermost(dirs)
+        changes = Changes()
+        touched: set[str] = set()
+        walks: list[tuple[IncrementalVisitor, Walker]] = []
+        young: set[str] = set()
+
+        def items() -> Iterator[Item]:
+            horizon = time.time_ns() - int(self.args.debounce * 1e9)
+            for d in dirs:
+                visitor = IncrementalVisitor(Path(d), changes, trust_dir_mtime)
+                walker = Walker(Path(d), visitor, parallel=self.args.walkers if d == self.root else 1)
+                walks.append((visitor, walker))
+                for item in walker:
+                    if item[2] > horizon:
+                        young.add(str(item[0].parent))
+                    yield item
+
+        ok, bad = index_batched(items(), self.args.workers, self.args.batch_size, touched, changes.changed,
+                                backend="thread", tool="watcher")
+        for visitor, walker in walks:
+            # непрочитанные каталоги (сбой NAS) не считаются удалёнными
+            visitor.finish(walker.failed)
+        if changes.deleted:
+            touched |= self.writer.prune(changes.deleted)
+            count_files("watcher", "deleted", len(changes.deleted))
+        # файл ещё может дописываться: mtime такого каталога не сохраняем, иначе
+        # --trust-dir-mtime больше не заглянет в него
+        for d in young:
+            changes.dirs.pop(d, None)
+        self.writer.save_dirs(changes.dirs, changes.gone_dirs)
+        if ok or bad or changes.deleted:
+            now = time.monotonic()
+            for t in (first_event or {}).values():
+                WATCH_LAG.observe(now - t)
+            print(f"dirs={len(dirs)} indexed ok={ok} bad={bad} changed={len(changes.changed)} "
+                  f"deleted={len(changes.deleted)} studies={len(touched)} {now - started:.1f}s", flush=True)
+            finish_run("watcher", started, ok + bad)
+        for uid in touched:
+            self.studies.touch(uid)
+
+    def settle_studies(self, extra: Iterable[str] = ()):
+        for uid in extra:
+            self.studies.touch(uid)
+        due = sorted(self.studies.due())
+        if not due:
+            return
+        if self.args.prebuild:
+            # прежние версии архивов уберёт PackageCache.add, когда соберутся новые
+            for uid, fut in zip(due, coordinator.prebuild(due)):
+                fut.add_done_callback(lambda f, uid=uid: f.exception() and print(
+                    f"prebuild {uid}: {f.exception()!r}", file=sys.stderr, flush=True))
+        else:
+            dropped = sum(cache.invalidate(uid) for uid in due)
+            if dropped:
+                print(f"invalidated packages={dropped} studies={len(due)}", flush=True)
+
+    def _tick(self):
+        self.settle_studies(self.inbox.poll() if self.inbox else ())
+
+    def _timeout(self, poll: float) -> float:
+        deadlines = [t for t in (self.dirs.next_deadline(), self.studies.next_deadline()) if t is not None]
+        if not deadlines:
+            return poll
+        return min(max(min(deadlines) - time.monotonic(), 0.05), poll)
+
+    def run_inotify(self, ino: Inotify):
+        tree = TreeWatch(ino, self.root)
+        n = tree.add_tree(self.root)
+        print(f"watching {self.root} (inotify, dirs={n})", flush=True)
+        if self.inbox is not None and self.inbox.watch(ino):
+            print(f"watching inbox {self.inbox.root} (inotify)", flush=True)
+        if self.args.catch_up:
+            # что появилось, пока демон не работал; наблюдения уже стоят — ничего не проскочит
+            self.sync([self.root], trust_dir_mtime=True)
+        while True:
+            for wd, mask, name in ino.read(self._timeout(self.args.debounce)):
+                if self.inbox is not None and wd == self.inbox.wd:
+                    self.inbox.handle(mask, name)
+                    continue
+                for d in tree.handle(wd, mask, name):
+                    self.dirs.touch(d)
+            if tree.overflow:
+                # очередь ядра переполнилась — события потеряны, сверяем всё дерево и INBOX
+                print("inotify queue overflow, full resync", file=sys.stderr, flush=True)
+                tree.overflow = False
+                if self.inbox is not None:
+                    self.inbox.rescan()
+                tree.add_tree(self.root)
+                self.dirs.due(float("inf"))
+                self.sync([self.root], trust_dir_mtime=True)
+            due = self.dirs.due()
+            if due:
+                self.sync(due, first_event=due)
+            self._tick()
+
+    def run_poll(self):
+        if self.inbox is not None:
+            # сюда попадаем и после отказа inotify — его наблюдения больше не читаются
+            self.inbox.unwatch()
+        print(f"watching {self.root} (poll every {self.args.poll:g}s)", flush=True)
+        next_scan = time.monotonic() if self.args.catch_up else time.monotonic() + self.args.poll
+        while True:
+            if time.monotonic() >= next_scan:
+                self.sync([self.root], trust_dir_mtime=self.args.trust_dir_mtime)
+                next_scan = time.monotonic() + self.args.poll
+            self._tick()
+            time.sleep(self._timeout(min(self.args.debounce, max(next_scan - time.monotonic(), 0.05))))
+
+def main():
+    ap = argparse.ArgumentParser(description="Непрерывная индексация DICOM_ROOT и инжест из INBOX_DIR")
+    ap.add_argument("--root", default=DICOM_ROOT, help="Корень хранилища (по умолчанию DICOM_ROOT)")
+    ap.add_argument("--inbox", default=INBOX_DIR, help="Папка «+++» с ISO (по умолчанию INBOX_DIR, пусто — не следить)")
+    ap.add_argument("--mode", choices=("auto", "inotify", "poll"), default="auto",
+                    help="auto — inotify, а на сетевых ФС и без свободных inotify-наблюдений — опрос")
+    ap.add_argument("--debounce", type=float, default=2.0, help="Тишина в каталоге перед индексацией, с")
+    ap.add_argument("--poll", type=float, default=30.0, help="Период опроса дерева в режиме poll, с")
+    ap.add_argument("--trust-dir-mtime", action="store_true",
+                    help="В режиме poll не проверять файлы в каталогах с прежним mtime")
+    ap.add_argument("--settle", type=float, default=30.0,
+                    help="Тишина по исследованию перед предсборкой или сбросом его архивов, с")
+    ap.add_argument("--prebuild", action="store_true",
+                    help="Предсобирать архивы затронутых исследований (иначе — удалять устаревшие из кэша)")
+    ap.add_argument("--no-catch-up", dest="catch_up", action="store_false",
+                    help="Не сверять дерево при старте (изменения, пока демон не работал, не подхватятся)")
+    ap.add_argument("--inbox-existing", action="store_true", help="Инжестировать и то, что лежало в INBOX до запуска")
+    ap.add_argument("--workers", type=int, default=4, help="Потоков разбора заголовков")
+    ap.add_argument("--batch-size", type=int, default=5000)
+    ap.add_argument("--walkers", type=int, default=4, help="Параллельный обход при сверке всего дерева")
+    args = ap.parse_args()
+    ensure_schema()
+    root = Path(args.root).resolve()
+    watcher = Watcher(root, args)
+    mode = args.mode
+    if mode == "auto":
+        kind = fs_type(str(root))
+        mode = "poll" if kind in NETWORK_FS else "inotify"
+        if mode == "poll":
+            print(f"{root} on {kind}: inotify does not see remote writes, polling", file=sys.stderr, flush=True)
+    if mode == "inotify":
+        try:
+            ino = Inotify()
+        except (OSError, AttributeError) as e:
+            if args.mode == "inotify":
+                raise
+            print(f"inotify unavailable ({e}), polling", file=sys.stderr, flush=True)
+        else:
+            try:
+                watcher.run_inotify(ino)
+            except WatchLimit as e:
+                if args.mode == "inotify":
+                    raise
+                print(f"fs.inotify.max_user_watches exhausted at {e}, polling", file=sys.stderr, flush=True)
+            finally:
+                ino.close()
+    watcher.run_poll()
+
+if __name__ == "__main__":
+    main()
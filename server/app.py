@@ -1,12 +1,18 @@
 
-from fastapi import FastAPI, Query, HTTPException
+from fastapi import FastAPI, Query, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import select, func
-from .db import SessionLocal, engine, Base, Patient, Study, Series, Instance
+from sqlalchemy import select
+from .db import ReadSession, ensure_schema, Patient, Study
 from .utils import normalize_name
-from .packager import get_or_build_package
-from .config import DICOM_ROOT
+from .packager import (get_or_build_package, study_instances, package_manifest, cache, series_cache, coordinator,
+                       PackageFileResponse)
+from .jobs import JobManager, DONE
+from .names import NameIndex
+from .metrics import REGISTRY, MetricsMiddleware, CACHE_LOOKUPS, CACHE_EVICTIONS, CACHE_BYTES, CACHE_ENTRIES
+from .config import DICOM_ROOT, NAME_INDEX_REFRESH_SEC, FUZZY_MIN_SCORE, PACKAGE_JOB_WORKERS, PACKAGE_JOB_TTL_SEC
 
+import threading
 from typing import List, Dict
 
 app = FastAPI(title="DICOM Index & Packaging API")
@@ -17,67 +23,155 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# время, объём ответов и фазы по маршрутам для /metrics (и Server-Timing при SERVER_TIMING=1)
+app.add_middleware(MetricsMiddleware)
 
-# Создаём таблицы, если их нет
-Base.metadata.create_all(bind=engine)
+# Создаём таблицы, если их нет, и докатываем новые колонки
+ensure_schema()
+
+# Триграммный индекс ФИО для нечёткого поиска; строим в фоне, чтобы не задерживать старт
+name_index = NameIndex(refresh_sec=NAME_INDEX_REFRESH_SEC)
+threading.Thread(target=name_index.refresh, kwargs={"force": True}, daemon=True).start()
+
+# Задания сборки архивов: свой пул, не занимает потоки обработчиков запросов
+jobs = JobManager(coordinator, cache, workers=PACKAGE_JOB_WORKERS, ttl_sec=PACKAGE_JOB_TTL_SEC)
 
 @app.get("/health") 
 def health():
     return {"status":"ok"}
 
+def _collect_cache_stats():
+    # кэши сами считают попадания и вытеснения — переносим их значения при каждом сборе
+    for name, c in (("packages", cache), ("series", series_cache)):
+        st = c.stats()
+        CACHE_LOOKUPS.set(st["hits"], cache=name, result="hit")
+        CACHE_LOOKUPS.set(st["misses"], cache=name, result="miss")
+        CACHE_EVICTIONS.set(st["evictions"], cache=name)
+        CACHE_BYTES.set(st["bytes"], cache=name)
+        CACHE_ENTRIES.set(st["entries"], cache=name)
+
+REGISTRY.on_collect(_collect_cache_stats)
+
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/search")
 def search(
     name: str = Query(..., description="ФИО пациента"),
-    dob: str = Query(..., description="Дата рождения в формате YYYYMMDD"),
+    dob: str | None = Query(None, description="Дата рождения в формате YYYYMMDD (обязательна без fuzzy)"),
     sex: str | None = Query(None, description="Пол (M/F)"),
     year: int | None = Query(None, description="Год исследования"),
+    fuzzy: bool = Query(False, description="Нечёткий поиск по ФИО: опечатки, транслитерация, без отчества"),
+    limit: int = Query(20, ge=1, le=200, description="Сколько пациентов-кандидатов брать в нечётком поиске"),
 ):
-    nname = normalize_name(name)
-    with SessionLocal() as s:
-        # Найдём пациентов
-        q_pat = select(Patient.id).where(Patient.patient_name_norm == nname, Patient.birth_date == dob)
-        if sex:
-            q_pat = q_pat.where(Patient.sex == sex)
-        pat_ids = [r[0] for r in s.execute(q_pat).all()]
+    if not fuzzy and not dob:
+        raise HTTPException(422, "dob is required unless fuzzy=true")
+    with ReadSession() as s:
+        scores: Dict[int, float] = {}
+        if fuzzy:
+            scores = dict(name_index.search(name, dob, sex, limit=limit, min_score=FUZZY_MIN_SCORE))
+            pat_ids = list(scores)
+        else:
+            # Найдём пациентов
+            nname = normalize_name(name)
+            q_pat = select(Patient.id).where(Patient.patient_name_norm == nname, Patient.birth_date == dob)
+            if sex:
+                q_pat = q_pat.where(Patient.sex == sex)
+            pat_ids = [r[0] for r in s.execute(q_pat).all()]
         if not pat_ids:
             return []
-        # Исследования по пациентам
+        # Исследования по пациентам: агрегаты уже лежат в studies, без join по экземплярам
         q = (
-            select(
-                Study.study_uid,
-                Study.study_date,
-                func.count(Instance.sop_uid).label("files"),
-                func.coalesce(func.sum(Instance.size_bytes), 0).label("bytes"),
-            )
-            .join(Series, Series.study_uid == Study.study_uid)
-            .join(Instance, Instance.series_uid == Series.series_uid)
-            .where(Study.patient_fk.in_(pat_ids))
-            .group_by(Study.study_uid, Study.study_date)
-            .order_by(func.coalesce(func.sum(Instance.size_bytes), 0).desc())
+            select(Study.study_uid, Study.study_date, Study.files, Study.bytes, Study.series_count, Study.modality,
+                   Patient.id, Patient.patient_name, Patient.birth_date)
+            .join(Patient, Patient.id == Study.patient_fk)
+            .where(Study.patient_fk.in_(pat_ids), Study.files > 0)
+            .order_by(Study.bytes.desc())
         )
         if year:
-            q = q.where(Study.study_date.like(f"{year}%"))
+            # диапазон по строке YYYYMMDD вместо LIKE — работает по индексу (patient_fk, study_date)
+            q = q.where(Study.study_date >= f"{year:04d}0101", Study.study_date < f"{year + 1:04d}0101")
         rows = s.execute(q).all()
         out: List[Dict] = []
-        for suid, sdate, files, bytes_ in rows:
-            out.append({
+        for suid, sdate, files, bytes_, nseries, modality, pid, pname, pdob in rows:
+            row = {
                 "study_uid": suid,
                 "study_date": sdate,
                 "files": int(files),
                 "bytes": int(bytes_),
-            })
+                "series_count": int(nseries),
+                "modality": modality,
+                "patient_name": pname,
+                "birth_date": pdob,
+            }
+            if fuzzy:
+                row["score"] = scores[pid]
+            out.append(row)
+        if fuzzy:
+            # сначала самые похожие пациенты, внутри — крупные исследования (сортировка устойчива)
+            out.sort(key=lambda r: -r["score"])
         return out
 
-@app.get("/package")
-def package(study_uid: str = Query(...)):
+@app.get("/patients/index/stats")
+def name_index_stats():
+    return name_index.stats()
+
+@app.api_route("/package", methods=["GET", "HEAD"])
+def package(
+    request: Request,
+    study_uid: str = Query(...),
+    series_uid: List[str] | None = Query(None, description="Только эти серии (параметр можно повторять)"),
+):
     # собираем пути файлов исследования
-    with SessionLocal() as s:
-        q = (
-            select(Instance.path)
-            .join(Series, Series.series_uid == Instance.series_uid)
-            .where(Series.study_uid == study_uid)
-        )
-        paths = [r[0] for r in s.execute(q).scalars().all()]
-        if not paths:
-            raise HTTPException(404, detail="Study not found or empty")
-    return get_or_build_package(study_uid, paths)
+    instances = study_instances(study_uid, series_uid)
+    if not instances:
+        raise HTTPException(404, detail="Study not found or empty")
+    # Range/HEAD требуют известной длины — дождёмся готового файла кэша
+    ranged = "range" in request.headers or request.method == "HEAD"
+    return get_or_build_package(study_uid, instances, ranged=ranged, series_uids=series_uid)
+
+@app.get("/package/manifest")
+def package_manifest_only(request: Request, study_uid: str = Query(...)):
+    # состав архива по индексу: клиент сверяет его со своим кэшем, не скачивая архив
+    instances = study_instances(study_uid)
+    if not instances:
+        raise HTTPException(404, detail="Study not found or empty")
+    manifest = package_manifest(study_uid, instances)
+    etag = f'"{manifest["key"]}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return JSONResponse(manifest, headers={"ETag": etag})
+
+@app.post("/package-jobs", status_code=202)
+def create_package_job(
+    study_uid: str = Query(...),
+    series_uid: List[str] | None = Query(None, description="Только эти серии (параметр можно повторять)"),
+):
+    job = jobs.submit(study_uid, series_uid)
+    if job is None:
+        raise HTTPException(404, detail="Study not found or empty")
+    return JSONResponse(job.status(), status_code=202, headers={"Location": f"/package-jobs/{job.id}"})
+
+@app.get("/package-jobs/{job_id}")
+def package_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(404, detail="Job not found")
+    return job.status()
+
+@app.api_route("/package-jobs/{job_id}/download", methods=["GET", "HEAD"])
+def package_job_download(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(404, detail="Job not found")
+    if job.state != DONE:
+        raise HTTPException(409, detail=f"Job is {job.state}")
+    if not job.package_path.exists():
+        # архив вытеснен из кэша — нужно новое задание
+        raise HTTPException(410, detail="Package evicted from cache, submit a new job")
+    return PackageFileResponse(job.package_path, f"{job.study_uid}.tar.zst")
+
+@app.get("/cache/stats")
+def cache_stats():
+    return dict(cache.stats(), series=series_cache.stats(), jobs=jobs.stats())
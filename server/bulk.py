@@ -0,0 +1,312 @@
+"""Пакетная запись заголовков DICOM в индекс.
+
+Один писатель, тысячи строк на транзакцию: INSERT ... ON CONFLICT DO NOTHING
+на SQLite/PostgreSQL, для экземпляров на PostgreSQL — COPY во временную таблицу.
+"""
+import csv, io, os
+from typing import Iterable, NamedTuple
+from sqlalchemy import select, insert, update, delete, tuple_, text, func, union_all
+from sqlalchemy.dialects import sqlite, postgresql
+from sqlalchemy.orm import Session
+from .db import Patient, Study, Series, Instance, InstanceAlias, IndexedFile, IndexedDir
+from .utils import normalize_name
+
+# ограничение числа параметров в одном запросе (SQLite)
+_CHUNK = 400
+# длина Study.modality: "CT\\SR\\PR" по убыванию числа экземпляров, сколько влезет
+_MODALITY_LEN = 16
+
+class HeaderRecord(NamedTuple):
+    path: str
+    size: int
+    study_uid: str
+    series_uid: str
+    sop_uid: str
+    patient_id: str
+    patient_name: str
+    birth_date: str
+    sex: str
+    study_date: str
+    modality: str
+    transfer_syntax: str
+    mtime_ns: int = 0
+    pixel_sha256: str | None = None
+
+def file_row(path: str, size: int, mtime_ns: int, status: str) -> dict:
+    # строка indexed_files
+    return {"path": path, "dir": os.path.dirname(path), "size": size, "mtime_ns": mtime_ns, "status": status}
+
+def record_from_dataset(ds, path: str, size: int, mtime_ns: int = 0) -> HeaderRecord | None:
+    # None — нет обязательных UID
+    for key in ("StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID"):
+        if not getattr(ds, key, None):
+            return None
+    ts = getattr(getattr(ds, "file_meta", None), "TransferSyntaxUID", None) or getattr(ds, "TransferSyntaxUID", "")
+    return HeaderRecord(
+        path=str(path), size=int(size),
+        study_uid=str(ds.StudyInstanceUID), series_uid=str(ds.SeriesInstanceUID), sop_uid=str(ds.SOPInstanceUID),
+        patient_id=str(getattr(ds, "PatientID", "")), patient_name=str(getattr(ds, "PatientName", "")),
+        birth_date=str(getattr(ds, "PatientBirthDate", "")), sex=str(getattr(ds, "PatientSex", "")),
+        study_date=str(getattr(ds, "StudyDate", "")), modality=str(getattr(ds, "Modality", "")),
+        transfer_syntax=str(ts), mtime_ns=int(mtime_ns),
+    )
+
+def _chunks(seq: list, n: int = _CHUNK):
+    for i in range(0, len(seq), n):
+        yield seq[i:i + n]
+
+def _insert_ignore(s: Session, model, rows: list[dict], returning=None) -> list:
+    """INSERT ... ON CONFLICT DO NOTHING; вернуть значения `returning` вставленных строк."""
+    if not rows:
+        return []
+    dialect = s.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        ins = (sqlite.insert if dialect == "sqlite" else postgresql.insert)(model).on_conflict_do_nothing()
+        if returning is None:
+            s.execute(ins, rows)
+            return []
+        return list(s.execute(ins.returning(returning), rows).scalars())
+    # прочие СУБД: отсеиваем существующие по первичному ключу
+    pk = model.__table__.primary_key.columns.values()[0]
+    keys = [r[pk.key] for r in rows]
+    existing = set()
+    for part in _chunks(keys):
+        existing.update(s.execute(select(pk).where(pk.in_(part))).scalars())
+    rows = [r for r in rows if r[pk.key] not in existing]
+    if rows:
+        s.execute(insert(model), rows)
+    return [r[returning.key] for r in rows] if returning is not None else []
+
+def _upsert(s: Session, model, rows: list[dict]) -> None:
+    """INSERT ... ON CONFLICT (pk) DO UPDATE — для отпечатков файлов и каталогов."""
+    if not rows:
+        return
+    dialect = s.get_bind().dialect.name
+    pk = model.__table__.primary_key.columns.values()[0]
+    if dialect in ("sqlite", "postgresql"):
+        ins = (sqlite.insert if dialect == "sqlite" else postgresql.insert)(model)
+        cols = [c for c in rows[0] if c != pk.key]
+        s.execute(ins.on_conflict_do_update(index_elements=[pk], set_={c: ins.excluded[c] for c in cols}), rows)
+        return
+    for part in _chunks(rows):
+        s.execute(delete(model).where(pk.in_([r[pk.key] for r in part])))
+    s.execute(insert(model), rows)
+
+def _copy_instances(s: Session, rows: list[dict]) -> list[str] | None:
+    # COPY во временную таблицу + INSERT ... SELECT; None — драйвер не умеет COPY
+    dbapi_conn = s.connection().connection.dbapi_connection
+    cur = dbapi_conn.cursor()
+    if not hasattr(cur, "copy_expert"):
+        return None
+    cols = ("sop_uid", "series_uid", "transfer_syntax", "size_bytes", "path", "mtime", "pixel_sha256")
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS _bulk_instances "
+                "(LIKE instances INCLUDING DEFAULTS) ON COMMIT DELETE ROWS")
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    for r in rows:
+        w.writerow([r[c] for c in cols])
+    buf.seek(0)
+    cur.copy_expert(f"COPY _bulk_instances ({', '.join(cols)}) FROM STDIN WITH (FORMAT csv)", buf)
+    res = s.execute(text(
+        f"INSERT INTO instances ({', '.join(cols)}) SELECT {', '.join(cols)} FROM _bulk_instances "
+        "ON CONFLICT DO NOTHING RETURNING sop_uid"))
+    return list(res.scalars())
+
+class BatchWriter:
+    """Единственный писатель индекса: upsert пачки записей одной транзакцией.
+
+    Кэширует id пациентов между пачками, чтобы не переспрашивать БД.
+    """
+
+    def __init__(self, session_factory, use_copy: bool = True):
+        self.session_factory = session_factory
+        self.use_copy = use_copy
+        self._patients: dict[tuple[str, str], int] = {}
+
+    def _patient_ids(self, s: Session, records: list[HeaderRecord]) -> None:
+        wanted = {}
+        for r in records:
+            key = (r.patient_id, r.birth_date)
+            if key not in self._patients and key not in wanted:
+                wanted[key] = r
+        if not wanted:
+            return
+        keys = list(wanted)
+        for part in _chunks(keys):
+            q = select(Patient.id, Patient.patient_id, Patient.birth_date).where(
+                tuple_(Patient.patient_id, Patient.birth_date).in_(part))
+            for pid, patient_id, birth_date in s.execute(q):
+                self._patients.setdefault((patient_id, birth_date), pid)
+        new = [Patient(patient_id=r.patient_id, birth_date=r.birth_date, sex=r.sex, patient_name=r.patient_name,
+                       patient_name_norm=normalize_name(r.patient_name))
+               for key, r in wanted.items() if key not in self._patients]
+        if new:
+            s.add_all(new)
+            s.flush()
+            for p in new:
+                self._patients[(p.patient_id, p.birth_date)] = p.id
+
+    def write(self, records: Iterable[HeaderRecord], files: list[dict] | None = None,
+              replaced: list[str] | None = None,
+              aliases: list[tuple[HeaderRecord, str]] | None = None) -> set[str]:
+        """Записать пачку; вернуть StudyInstanceUID, в которые добавлены экземпляры.
+
+        files — отпечатки обработанных файлов (`file_row`), replaced — пути
+        изменившихся файлов: их прежние экземпляры удаляются в той же транзакции,
+        aliases — (заголовок дубликата, SOPInstanceUID хранимого экземпляра): дубликат
+        по пиксельным данным становится экземпляром своей серии, ссылаясь на файл хранимого.
+        """
+        by_sop: dict[str, HeaderRecord] = {}
+        for r in records:
+            by_sop.setdefault(r.sop_uid, r)
+        records = list(by_sop.values())
+        aliases = aliases or []
+        if not records and not files and not replaced and not aliases:
+            return set()
+        with self.session_factory() as s:
+            try:
+                touched = set()
+                for part in _chunks(replaced or []):
+                    touched.update(_delete_paths(s, part))
+                _upsert(s, IndexedFile, files or [])
+                # исследования и серии дубликатов тоже заводим: без них дубликат не найти и не упаковать
+                described = records + [r for r, _ in aliases]
+                if described:
+                    self._patient_ids(s, described)
+                    studies, series = {}, {}
+                    for r in described:
+                        studies.setdefault(r.study_uid, {
+                            "study_uid": r.study_uid, "patient_fk": self._patients[(r.patient_id, r.birth_date)],
+                            "study_date": r.study_date, "modality": r.modality})
+                        series.setdefault(r.series_uid, {"series_uid": r.series_uid, "study_uid": r.study_uid,
+                                                         "modality": r.modality})
+                    _insert_ignore(s, Study, list(studies.values()))
+                    _insert_ignore(s, Series, list(series.values()))
+                if records:
+                    rows = [{"sop_uid": r.sop_uid, "series_uid": r.series_uid, "transfer_syntax": r.transfer_syntax,
+                             "size_bytes": r.size, "path": r.path, "mtime": r.mtime_ns // 1_000_000_000 or None,
+                             "pixel_sha256": r.pixel_sha256}
+                            for r in records]
+                    inserted = None
+                    if self.use_copy and s.get_bind().dialect.name == "postgresql":
+                        inserted = _copy_instances(s, rows)
+                    if inserted is None:
+                        inserted = _insert_ignore(s, Instance, rows, Instance.sop_uid)
+                    _follow_moves(s, [r for r in records if r.sop_uid not in set(inserted)])
+                    touched |= {by_sop[sop].study_uid for sop in inserted}
+                if aliases:
+                    _insert_ignore(s, InstanceAlias, [
+                        {"sop_uid": r.sop_uid, "series_uid": r.series_uid, "study_uid": r.study_uid,
+                         "instance_sop_uid": canon, "source": r.path} for r, canon in aliases])
+                    touched |= {r.study_uid for r, _ in aliases}
+                refresh_study_aggregates(s, touched)
+                s.commit()
+            except BaseException:
+                s.rollback()
+                # id новых пациентов из откатившейся транзакции недействительны
+                self._patients.clear()
+                raise
+        return touched
+
+    def prune(self, paths: list[str]) -> set[str]:
+        """Удалить экземпляры и отпечатки исчезнувших файлов; вернуть затронутые исследования."""
+        touched = set()
+        with self.session_factory() as s:
+            for part in _chunks(paths):
+                touched.update(_delete_paths(s, part))
+                s.execute(delete(IndexedFile).where(IndexedFile.path.in_(part)))
+            refresh_study_aggregates(s, touched)
+            s.commit()
+        return touched
+
+    def save_dirs(self, dirs: dict[str, int], gone: Iterable[str] = ()) -> None:
+        # mtime каталогов пишем в конце прохода, когда их файлы уже в индексе
+        with self.session_factory() as s:
+            _upsert(s, IndexedDir, [{"path": p, "mtime_ns": m} for p, m in dirs.items()])
+            for part in _chunks(list(gone)):
+                s.execute(delete(IndexedDir).where(IndexedDir.path.in_(part)))
+            s.commit()
+
+def _follow_moves(s: Session, records: list[HeaderRecord]) -> None:
+    # экземпляр уже в индексе, но по старому пути файла больше нет — файл переехал
+    by_sop = {r.sop_uid: r for r in records}
+    for part in _chunks(list(by_sop)):
+        q = select(Instance.sop_uid, Instance.path).where(Instance.sop_uid.in_(part))
+        for sop_uid, old_path in s.execute(q).all():
+            r = by_sop[sop_uid]
+            if old_path != r.path and not os.path.exists(old_path):
+                s.execute(update(Instance).where(Instance.sop_uid == sop_uid)
+                          .values(path=r.path, size_bytes=r.size, mtime=r.mtime_ns // 1_000_000_000 or None))
+
+def _members(study_uids: list[str]):
+    # экземпляры исследований вместе с дубликатами (у дубликата размер хранимого файла)
+    series = select(Series.series_uid).where(Series.study_uid.in_(study_uids))
+    return union_all(
+        select(Instance.series_uid.label("series_uid"), Instance.sop_uid.label("sop_uid"),
+               Instance.size_bytes.label("size_bytes")).where(Instance.series_uid.in_(series)),
+        select(InstanceAlias.series_uid, InstanceAlias.sop_uid, Instance.size_bytes)
+        .join(Instance, Instance.sop_uid == InstanceAlias.instance_sop_uid)
+        .where(InstanceAlias.series_uid.in_(series)),
+    ).subquery()
+
+def refresh_study_aggregates(s: Session, study_uids: Iterable[str] | None) -> None:
+    """Пересчитать files/bytes/series_count/modality исследований по экземплярам и дубликатам.
+
+    study_uids=None — все исследования (миграция старой БД).
+    """
+    if study_uids is None:
+        uids = list(s.execute(select(Study.study_uid)).scalars())
+    else:
+        uids = list(study_uids)
+    for part in _chunks(uids):
+        agg = {uid: (0, 0, 0) for uid in part}
+        m = _members(part)
+        q = (select(Series.study_uid, func.count(m.c.sop_uid), func.coalesce(func.sum(m.c.size_bytes), 0),
+                    func.count(func.distinct(Series.series_uid)))
+             .select_from(Series).outerjoin(m, m.c.series_uid == Series.series_uid)
+             .where(Series.study_uid.in_(part)).group_by(Series.study_uid))
+        for uid, files, nbytes, nseries in s.execute(q):
+            agg[uid] = (int(files), int(nbytes), int(nseries))
+        mods: dict[str, list[tuple[int, str]]] = {}
+        q = (select(Series.study_uid, Series.modality, func.count(m.c.sop_uid))
+             .select_from(Series).join(m, m.c.series_uid == Series.series_uid)
+             .where(Series.study_uid.in_(part), Series.modality.is_not(None), Series.modality != "")
+             .group_by(Series.study_uid, Series.modality))
+        for uid, modality, n in s.execute(q):
+            mods.setdefault(uid, []).append((int(n), modality))
+        for uid, (files, nbytes, nseries) in agg.items():
+            values = {"files": files, "bytes": nbytes, "series_count": nseries}
+            if uid in mods:
+                values["modality"] = _modalities(mods[uid])
+            s.execute(update(Study).where(Study.study_uid == uid).values(**values))
+
+def _modalities(counts: list[tuple[int, str]]) -> str:
+    out = ""
+    for _, m in sorted(counts, key=lambda t: (-t[0], t[1])):
+        cand = f"{out}\\{m}" if out else m
+        if len(cand) > _MODALITY_LEN:
+            break
+        out = cand
+    return out
+
+def bump_study_aggregates(s: Session, study_uid: str, size: int, new_series: bool = False) -> None:
+    # +1 экземпляр в исследовании; атомарно на стороне БД (per-file запись из нескольких потоков)
+    values = {"files": Study.files + 1, "bytes": Study.bytes + (size or 0)}
+    if new_series:
+        values["series_count"] = Study.series_count + 1
+    s.execute(update(Study).where(Study.study_uid == study_uid).values(**values))
+
+def _studies_of_paths(s: Session, paths: list[str]) -> set[str]:
+    q = (select(Series.study_uid).join(Instance, Instance.series_uid == Series.series_uid)
+         .where(Instance.path.in_(paths)).distinct())
+    return set(s.execute(q).scalars())
+
+def _delete_paths(s: Session, paths: list[str]) -> set[str]:
+    """Удалить экземпляры по путям вместе с дубликатами, ссылавшимися на них; вернуть исследования."""
+    touched = _studies_of_paths(s, paths)
+    gone = select(Instance.sop_uid).where(Instance.path.in_(paths))
+    touched.update(s.execute(select(InstanceAlias.study_uid).where(InstanceAlias.instance_sop_uid.in_(gone))
+                             .distinct()).scalars())
+    s.execute(delete(InstanceAlias).where(InstanceAlias.instance_sop_uid.in_(gone)))
+    s.execute(delete(Instance).where(Instance.path.in_(paths)))
+    return touched
@@ -0,0 +1,190 @@
+"""Кэш архивов в CACHE_DIR: бюджет по байтам, вытеснение LRU/LFU, счётчики.
+
+Имя архива `<StudyUID>.<key>.tar.zst`, где key — хэш набора экземпляров
+исследования (sop_uid + размер из индекса). Новые серии меняют key,
+поэтому устаревший архив не отдаётся и удаляется при появлении свежего.
+"""
+import os, time, hashlib, threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Tuple
+
+SUFFIX = ".tar.zst"
+# .partial старше суток — остаток упавшей сборки
+STALE_PARTIAL_SEC = 24 * 3600
+
+def instance_set_key(instances: Iterable[Tuple[str, int | None]], version: str = "") -> str:
+    """Ключ архива по набору (sop_uid, size_bytes) — не зависит от порядка.
+
+    version — версия раскладки архива: архивы прежнего формата получают другой ключ.
+    """
+    h = hashlib.sha1(version.encode("utf-8"))
+    for sop_uid, size in sorted((str(u), int(sz or 0)) for u, sz in instances):
+        h.update(f"{sop_uid}:{size}\n".encode("utf-8"))
+    return h.hexdigest()[:16]
+
+def split_name(name: str) -> tuple[str, str] | None:
+    # "<StudyUID>.<key>.tar.zst" -> (StudyUID, key); UID сам содержит точки
+    if not name.endswith(SUFFIX):
+        return None
+    stem = name[:-len(SUFFIX)]
+    if "." not in stem:
+        return None
+    study_uid, key = stem.rsplit(".", 1)
+    return study_uid, key
+
+@dataclass
+class _Entry:
+    size: int
+    last_access: float
+    hits: int = 0
+
+class PackageCache:
+    def __init__(self, root: str | Path, max_bytes: int = 0, policy: str = "lru"):
+        self.root = Path(root)
+        self.max_bytes = max_bytes  # 0 — без ограничения
+        self.policy = policy if policy in ("lru", "lfu") else "lru"
+        self._lock = threading.Lock()
+        self._entries: dict[str, _Entry] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.invalidations = 0
+        # кэши с общим бюджетом: max_bytes ограничивает их суммарный объём
+        self._peers: list["PackageCache"] = []
+        self.used = 0  # байт в кэше; соседи читают без блокировки
+        self._scan()
+
+    def share_budget(self, other: "PackageCache"):
+        """Считать объём other в бюджете этого кэша и наоборот."""
+        self._peers.append(other)
+        other._peers.append(self)
+
+    def path_for(self, study_uid: str, key: str) -> Path:
+        return self.root / f"{study_uid}.{key}{SUFFIX}"
+
+    def _scan(self):
+        # подхватываем архивы, собранные другими процессами (индексатор, инжест)
+        now = time.time()
+        seen = set()
+        try:
+            it = os.scandir(self.root)
+        except FileNotFoundError:
+            return
+        with it:
+            for de in it:
+                if not de.is_file():
+                    continue
+                st = de.stat()
+                if de.name.endswith(".partial"):
+                    if now - st.st_mtime > STALE_PARTIAL_SEC:
+                        _remove(de.path)
+                    continue
+                if split_name(de.name) is None:
+                    continue
+                seen.add(de.name)
+                e = self._entries.get(de.name)
+                if e is None:
+                    self._entries[de.name] = _Entry(st.st_size, max(st.st_atime, st.st_mtime))
+                else:
+                    e.size = st.st_size
+        for name in list(self._entries):
+            if name not in seen:
+                del self._entries[name]
+        self._recount()
+
+    def _recount(self):
+        self.used = sum(e.size for e in self._entries.values())
+
+    def lookup(self, path: Path) -> bool:
+        """Есть ли готовый архив; учитывает попадание/промах."""
+        with self._lock:
+            e = self._entries.get(path.name)
+            if e is None and path.exists():
+                e = self._entries[path.name] = _Entry(path.stat().st_size, time.time())
+                self._recount()
+            if e is None:
+                self.misses += 1
+                return False
+            if not path.exists():
+                del self._entries[path.name]
+                self._recount()
+                self.misses += 1
+                return False
+            e.hits += 1
+            e.last_access = time.time()
+            self.hits += 1
+            return True
+
+    def add(self, path: Path):
+        """Зарегистрировать свежий архив: убрать его старые версии и уложиться в бюджет."""
+        parsed = split_name(path.name)
+        with self._lock:
+            self._scan()
+            if parsed is not None:
+                study_uid, _ = parsed
+                for name in list(self._entries):
+                    other = split_name(name)
+                    if name != path.name and other and other[0] == study_uid:
+                        self._drop(name)
+                        self.invalidations += 1
+            self._evict(keep=path.name)
+
+    def invalidate(self, study_uid: str) -> int:
+        """Удалить все архивы исследования (его состав изменился); вернуть сколько."""
+        with self._lock:
+            self._scan()
+            names = [n for n in self._entries if (split_name(n) or ("",))[0] == study_uid]
+            for name in names:
+                self._drop(name)
+            self.invalidations += len(names)
+        return len(names)
+
+    def _drop(self, name: str):
+        e = self._entries.pop(name, None)
+        _remove(self.root / name)
+        if e is not None:
+            self.used -= e.size
+        return e
+
+    def _evict(self, keep: str):
+        if not self.max_bytes:
+            return
+        # вытесняем только свои записи, но считаем и объём соседей по бюджету
+        total = self.used + sum(p.used for p in self._peers)
+        if total <= self.max_bytes:
+            return
+        if self.policy == "lfu":
+            order = sorted(self._entries.items(), key=lambda kv: (kv[1].hits, kv[1].last_access))
+        else:
+            order = sorted(self._entries.items(), key=lambda kv: kv[1].last_access)
+        for name, e in order:
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            self._drop(name)
+            total -= e.size
+            self.evictions += 1
+            self.evicted_bytes += e.size
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "policy": self.policy,
+                "max_bytes": self.max_bytes,
+                "bytes": self.used,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "evicted_bytes": self.evicted_bytes,
+                "invalidations": self.invalidations,
+            }
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
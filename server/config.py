@@ -1,10 +1,67 @@
-
 import os
 
 DB_URL = os.getenv("DB_URL", "sqlite:///dicom_index.sqlite3")
+# Пулы соединений с БД: на PostgreSQL — общий пул процесса, на SQLite — пул читателей
+# (писатель у SQLite один на процесс). Запросы по большим выборкам читаются пачками по
+# DB_STREAM_ROWS строк (на PostgreSQL — серверным курсором)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_STREAM_ROWS = int(os.getenv("DB_STREAM_ROWS", "5000"))
+# SQLite: режим журнала (WAL — читатели не ждут писателя; на сетевой ФС WAL не работает,
+# там DELETE), synchronous, кэш страниц и mmap на соединение, сколько ждать блокировку записи
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_CACHE_MB = int(os.getenv("SQLITE_CACHE_MB", "64"))
+SQLITE_MMAP_MB = int(os.getenv("SQLITE_MMAP_MB", "256"))
+SQLITE_BUSY_TIMEOUT_SEC = float(os.getenv("SQLITE_BUSY_TIMEOUT_SEC", "60"))
 DICOM_ROOT = os.getenv("DICOM_ROOT", "./_demo_studies")
 CACHE_DIR = os.getenv("CACHE_DIR", "./cache")
 INBOX_DIR = os.getenv("INBOX_DIR", "./_inbox_plus")
 RADIANT_CMD = os.getenv("RADIANT_CMD", "RadiantViewer")
+# Потоковая выдача /package: архив уходит клиенту по мере сборки (0 — собрать целиком, потом отдать)
+PACKAGE_STREAMING = os.getenv("PACKAGE_STREAMING", "1") == "1"
+# Фоновая предсборка архивов для только что проиндексированных исследований
+PREBUILD_WORKERS = int(os.getenv("PREBUILD_WORKERS", "2"))
+PREBUILD_QUEUE = int(os.getenv("PREBUILD_QUEUE", "256"))
+# Бюджет кэша архивов в CACHE_DIR (ГБ, 0 — без ограничения) и политика вытеснения: lru | lfu
+CACHE_MAX_BYTES = int(float(os.getenv("CACHE_MAX_GB", "200")) * 1024**3)
+CACHE_POLICY = os.getenv("CACHE_POLICY", "lru")
+# Кэш сжатых кадров отдельных серий, из которых склеиваются архивы исследований (1 — включить).
+# Новая серия при этом пишется на диск дважды — в архив и в кадр, поэтому по умолчанию выключен;
+# кадры считаются в общем бюджете CACHE_MAX_GB вместе с архивами
+SERIES_CACHE = os.getenv("SERIES_CACHE", "0") == "1"
+SERIES_CACHE_DIR = os.getenv("SERIES_CACHE_DIR", os.path.join(CACHE_DIR, "series"))
+
+# Сжатие архивов: потоки zstd (-1 — по числу ядер, 0 — в потоке сборки) и уровни по составу
+# исследования — почти всё уже сжато (JPEG/J2K/RLE), почти всё «сырое» или смесь
+PACK_THREADS = int(os.getenv("PACK_THREADS", "-1"))
+PACK_LEVEL_RAW = int(os.getenv("PACK_LEVEL_RAW", "9"))
+PACK_LEVEL_MIXED = int(os.getenv("PACK_LEVEL_MIXED", "6"))
+PACK_LEVEL_COMPRESSED = int(os.getenv("PACK_LEVEL_COMPRESSED", "-1"))
+# доля байт сжатых экземпляров, начиная с которой исследование считается «уже сжатым»
+PACK_COMPRESSED_SHARE = float(os.getenv("PACK_COMPRESSED_SHARE", "0.8"))
+
+# Упреждающее чтение исходных файлов при упаковке: потоки, бюджет в памяти и порог,
+# выше которого файл не буферизуется, а читается потоком
+PREFETCH_THREADS = int(os.getenv("PREFETCH_THREADS", "8"))
+PREFETCH_BYTES = int(float(os.getenv("PREFETCH_MB", "256")) * 1024**2)
+PREFETCH_MAX_FILE = int(float(os.getenv("PREFETCH_MAX_FILE_MB", "64")) * 1024**2)
+
+# Асинхронные задания сборки (/package-jobs): отдельный пул и время жизни завершённых заданий
+PACKAGE_JOB_WORKERS = int(os.getenv("PACKAGE_JOB_WORKERS", "2"))
+PACKAGE_JOB_TTL_SEC = float(os.getenv("PACKAGE_JOB_TTL_SEC", "3600"))
+
+# Нечёткий поиск по ФИО: как часто дочитывать новых пациентов в индекс и порог сходства
+NAME_INDEX_REFRESH_SEC = float(os.getenv("NAME_INDEX_REFRESH_SEC", "30"))
+FUZZY_MIN_SCORE = float(os.getenv("FUZZY_MIN_SCORE", "0.45"))
+
+# Метрики: заголовок Server-Timing с фазами запроса и файл для textfile-коллектора
+# node_exporter, куда индексатор и инжест пишут итог прогона (пусто — не писать)
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"
+METRICS_TEXTFILE = os.getenv("METRICS_TEXTFILE", "")
 
 os.makedirs(CACHE_DIR, exist_ok=True)
+if SERIES_CACHE:
+    os.makedirs(SERIES_CACHE_DIR, exist_ok=True)
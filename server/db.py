@@ -1,8 +1,9 @@
 
-from sqlalchemy import create_engine, String, Integer, BigInteger, Text, ForeignKey
+from sqlalchemy import create_engine, event, inspect, text, String, Integer, BigInteger, Text, ForeignKey, Index
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, sessionmaker
 from sqlalchemy.pool import StaticPool
-from .config import DB_URL
+from .config import (DB_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_STREAM_ROWS,
+                     SQLITE_JOURNAL_MODE, SQLITE_SYNCHRONOUS, SQLITE_CACHE_MB, SQLITE_MMAP_MB, SQLITE_BUSY_TIMEOUT_SEC)
 
 class Base(DeclarativeBase):
     pass
@@ -18,30 +19,146 @@ class Patient(Base):
 
 class Study(Base):
     __tablename__ = "studies"
+    __table_args__ = (Index("ix_studies_patient_date", "patient_fk", "study_date"),)
     study_uid: Mapped[str] = mapped_column(String(128), primary_key=True)
     patient_fk: Mapped[int] = mapped_column(ForeignKey("patients.id"))
     study_date: Mapped[str] = mapped_column(String(16), index=True, nullable=True)
     modality: Mapped[str] = mapped_column(String(16), nullable=True)
+    # денормализованные агрегаты по экземплярам — /search не делает join + GROUP BY
+    files: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    bytes: Mapped[int] = mapped_column(BigInteger, default=0, server_default="0")
+    series_count: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
 
 class Series(Base):
     __tablename__ = "series"
     series_uid: Mapped[str] = mapped_column(String(128), primary_key=True)
-    study_uid: Mapped[str] = mapped_column(ForeignKey("studies.study_uid"))
+    study_uid: Mapped[str] = mapped_column(ForeignKey("studies.study_uid"), index=True)
+    modality: Mapped[str] = mapped_column(String(16), nullable=True)
 
 class Instance(Base):
     __tablename__ = "instances"
     sop_uid: Mapped[str] = mapped_column(String(128), primary_key=True)
-    series_uid: Mapped[str] = mapped_column(ForeignKey("series.series_uid"))
+    series_uid: Mapped[str] = mapped_column(ForeignKey("series.series_uid"), index=True)
     transfer_syntax: Mapped[str] = mapped_column(String(64), nullable=True)
     size_bytes: Mapped[int] = mapped_column(BigInteger, nullable=True)
     path: Mapped[str] = mapped_column(Text, unique=True)
+    # mtime файла (секунды) на момент индексации — для манифеста архива без stat по NAS
+    mtime: Mapped[int] = mapped_column(BigInteger, nullable=True)
+    # sha256 значения Pixel Data (считается инжестом при копировании) — дедуп по содержимому
+    pixel_sha256: Mapped[str] = mapped_column(String(64), index=True, nullable=True)
+
+class InstanceAlias(Base):
+    # экземпляр с другими UID, но теми же пиксельными данными, что у хранимого:
+    # файл не копируется, экземпляр ссылается на уже хранимый
+    __tablename__ = "instance_aliases"
+    sop_uid: Mapped[str] = mapped_column(String(128), primary_key=True)
+    series_uid: Mapped[str] = mapped_column(String(128), index=True)
+    study_uid: Mapped[str] = mapped_column(String(128), index=True)
+    instance_sop_uid: Mapped[str] = mapped_column(ForeignKey("instances.sop_uid"), index=True)
+    source: Mapped[str] = mapped_column(Text, nullable=True)
+
+class IndexedFile(Base):
+    # отпечаток файла для инкрементальной переиндексации (в т.ч. не-DICOM)
+    __tablename__ = "indexed_files"
+    path: Mapped[str] = mapped_column(Text, primary_key=True)
+    dir: Mapped[str] = mapped_column(Text, index=True)
+    size: Mapped[int] = mapped_column(BigInteger)
+    mtime_ns: Mapped[int] = mapped_column(BigInteger)
+    status: Mapped[str] = mapped_column(String(16), nullable=True)
+
+class IndexedDir(Base):
+    __tablename__ = "indexed_dirs"
+    path: Mapped[str] = mapped_column(Text, primary_key=True)
+    mtime_ns: Mapped[int] = mapped_column(BigInteger)
+
+def _sqlite_memory(url: str) -> bool:
+    return url in ("sqlite://", "sqlite:///:memory:") or "mode=memory" in url
 
-def make_engine():
-    if DB_URL.startswith("sqlite"):
-        engine = create_engine(DB_URL, connect_args={"check_same_thread": False}, poolclass=StaticPool)
-    else:
-        engine = create_engine(DB_URL, pool_pre_ping=True)
-    return engine
+def _sqlite_pragmas(engine, readonly: bool):
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_conn, _):
+        # транзакциями управляем сами (BEGIN ниже), а не модуль sqlite3
+        dbapi_conn.isolation_level = None
+        cur = dbapi_conn.cursor()
+        cur.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+        cur.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cur.execute(f"PRAGMA cache_size={-SQLITE_CACHE_MB * 1024}")
+        cur.execute(f"PRAGMA mmap_size={SQLITE_MMAP_MB * 1024**2}")
+        cur.execute(f"PRAGMA busy_timeout={int(SQLITE_BUSY_TIMEOUT_SEC * 1000)}")
+        cur.execute("PRAGMA temp_store=MEMORY")
+        if readonly:
+            cur.execute("PRAGMA query_only=ON")
+        cur.close()
+
+    @event.listens_for(engine, "begin")
+    def on_begin(conn):
+        # писатель сразу берёт блокировку записи: без этого транзакция, начавшая с чтения,
+        # при первой записи может получить SQLITE_BUSY, которого busy_timeout не ждёт.
+        # Читатель в WAL видит снимок на начало транзакции и писателя не ждёт
+        conn.exec_driver_sql("BEGIN" if readonly else "BEGIN IMMEDIATE")
+
+def make_engine(url: str = DB_URL, readonly: bool = False):
+    """Движок БД. readonly — для чтения (поиск, выборки для упаковки, обход индексатора).
+
+    SQLite: WAL и прагмы на каждое соединение; писатель — одно соединение на процесс
+    (записи внутри процесса ждут очереди пула, между процессами — блокировку файла),
+    читатели — отдельный пул, в WAL они не блокируют запись и не блокируются ею.
+    PostgreSQL: пул заданного размера с проверкой соединений.
+    """
+    if url.startswith("sqlite"):
+        if _sqlite_memory(url):
+            # БД в памяти живёт, пока открыто её единственное соединение
+            return create_engine(url, connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        args = {"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_SEC}
+        if readonly:
+            engine = create_engine(url, connect_args=args, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                                   pool_timeout=DB_POOL_TIMEOUT)
+        else:
+            engine = create_engine(url, connect_args=args, pool_size=1, max_overflow=0,
+                                   pool_timeout=SQLITE_BUSY_TIMEOUT_SEC)
+        _sqlite_pragmas(engine, readonly)
+        return engine
+    return create_engine(url, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT,
+                         pool_recycle=DB_POOL_RECYCLE, pool_pre_ping=True)
 
 engine = make_engine()
+# на PostgreSQL читатели и писатели делят один пул; у SQLite в памяти соединение одно
+read_engine = make_engine(readonly=True) if DB_URL.startswith("sqlite") and not _sqlite_memory(DB_URL) else engine
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+ReadSession = sessionmaker(bind=read_engine, autoflush=False, autocommit=False)
+
+def stream(s, q, rows: int = DB_STREAM_ROWS):
+    """Выполнить запрос, читая результат пачками по rows строк (на PostgreSQL — серверным курсором)."""
+    return s.execute(q, execution_options={"yield_per": rows})
+
+def ensure_schema(bind=None) -> list[str]:
+    """create_all + добавление новых колонок и индексов в уже существующие таблицы.
+
+    Вернуть список добавленных колонок ("table.column").
+    """
+    bind = bind or engine
+    Base.metadata.create_all(bind=bind)
+    added = []
+    with bind.begin() as conn:
+        # инспектор на том же соединении: у писателя SQLite оно в пуле одно
+        insp = inspect(conn)
+        for table in Base.metadata.sorted_tables:
+            have = {c["name"] for c in insp.get_columns(table.name)}
+            for col in table.columns:
+                if col.name in have:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {col.name} {col.type.compile(dialect=bind.dialect)}"
+                if col.server_default is not None:
+                    ddl += f" DEFAULT {col.server_default.arg}"
+                conn.execute(text(ddl))
+                added.append(f"{table.name}.{col.name}")
+        for table in Base.metadata.sorted_tables:
+            for idx in table.indexes:
+                idx.create(conn, checkfirst=True)
+    if "studies.files" in added:
+        # агрегаты только что появились — посчитаем их по уже накопленным экземплярам
+        from .bulk import refresh_study_aggregates
+        with SessionLocal(bind=bind) as s:
+            refresh_study_aggregates(s, None)
+            s.commit()
+    return added
@@ -0,0 +1,352 @@
+"""Быстрое чтение индексируемых тегов из заголовка DICOM.
+
+Читаем только первые килобайты файла и разбираем элементы до (0020,000E)
+без pydicom. Если встречается что-то необычное (big endian, deflate,
+заголовок длиннее буфера, битая структура) — откатываемся на pydicom.
+Результат — компактный HeaderRecord, его дёшево возвращать из процесса-воркера.
+"""
+import hashlib, io, struct
+from pathlib import Path
+import pydicom
+from pydicom.charset import convert_encodings, decode_bytes
+from pydicom.errors import InvalidDicomError
+from pydicom.valuerep import PersonName
+from .bulk import HeaderRecord, record_from_dataset
+
+TAGS = ["StudyInstanceUID","SeriesInstanceUID","SOPInstanceUID",
+        "PatientID","PatientName","PatientBirthDate","PatientSex",
+        "StudyDate","Modality","TransferSyntaxUID"]
+
+# сколько байт читаем сначала и до скольких готовы дочитать, прежде чем звать pydicom
+HEADER_READ = 16 * 1024
+HEADER_READ_MAX = 256 * 1024
+
+_WANTED = {
+    0x00080005: "charset",
+    0x00080018: "sop_uid",
+    0x00080020: "study_date",
+    0x00080060: "modality",
+    0x00100010: "patient_name",
+    0x00100020: "patient_id",
+    0x00100030: "birth_date",
+    0x00100040: "sex",
+    0x0020000D: "study_uid",
+    0x0020000E: "series_uid",
+}
+_LAST_TAG = 0x0020000E
+_LONG_VRS = {b"OB", b"OD", b"OF", b"OL", b"OV", b"OW", b"SQ", b"SV", b"UC", b"UN", b"UR", b"UT", b"UV"}
+_IMPLICIT_LE = "1.2.840.10008.1.2"
+# big endian и deflate разбирать не берёмся
+_UNSUPPORTED_TS = {"1.2.840.10008.1.2.2", "1.2.840.10008.1.2.1.99"}
+_ITEM, _ITEM_END, _SEQ_END = 0xFFFEE000, 0xFFFEE00D, 0xFFFEE0DD
+_UNDEFINED = 0xFFFFFFFF
+
+class _NeedMore(Exception):
+    """Буфер кончился раньше, чем нужные теги."""
+
+class _Unsupported(Exception):
+    """Структура, которую быстрый разбор не поддерживает."""
+
+def _element(buf: bytes, pos: int, explicit: bool) -> tuple[int, bytes | None, int, int]:
+    # (tag, vr, длина значения, позиция значения)
+    if pos + 8 > len(buf):
+        raise _NeedMore()
+    group, elem = struct.unpack_from("<HH", buf, pos)
+    tag = (group << 16) | elem
+    if group == 0xFFFE:
+        (length,) = struct.unpack_from("<I", buf, pos + 4)
+        return tag, None, length, pos + 8
+    if not explicit:
+        (length,) = struct.unpack_from("<I", buf, pos + 4)
+        return tag, None, length, pos + 8
+    vr = buf[pos + 4:pos + 6]
+    if vr in _LONG_VRS:
+        if pos + 12 > len(buf):
+            raise _NeedMore()
+        (length,) = struct.unpack_from("<I", buf, pos + 8)
+        return tag, vr, length, pos + 12
+    if not vr.isalpha():
+        raise _Unsupported()
+    (length,) = struct.unpack_from("<H", buf, pos + 6)
+    return tag, vr, length, pos + 8
+
+def _skip_undefined(buf: bytes, pos: int, explicit: bool) -> int:
+    # пропустить последовательность неопределённой длины; вернуть позицию после (FFFE,E0DD)
+    while True:
+        tag, _, length, pos = _element(buf, pos, explicit)
+        if tag == _SEQ_END:
+            return pos
+        if tag != _ITEM:
+            raise _Unsupported()
+        if length != _UNDEFINED:
+            pos += length
+            continue
+        # элемент неопределённой длины: вложенный набор данных до (FFFE,E00D)
+        while True:
+            tag, vr, length, pos = _element(buf, pos, explicit)
+            if tag == _ITEM_END:
+                break
+            if length == _UNDEFINED:
+                # UN неопределённой длины внутри — implicit VR
+                pos = _skip_undefined(buf, pos, explicit and vr != b"UN")
+            else:
+                pos += length
+
+def _meta(buf: bytes) -> tuple[str, int]:
+    # (transfer syntax, позиция первого элемента набора данных)
+    if len(buf) < 132:
+        raise _NeedMore()
+    if buf[128:132] != b"DICM":
+        raise _Unsupported()
+    pos = 132
+    ts = ""
+    # file meta (0002,xxxx) всегда explicit VR little endian
+    while True:
+        if pos + 8 > len(buf):
+            raise _NeedMore()
+        (group,) = struct.unpack_from("<H", buf, pos)
+        if group != 0x0002:
+            break
+        tag, _, length, vpos = _element(buf, pos, True)
+        if vpos + length > len(buf):
+            raise _NeedMore()
+        if tag == 0x00020010:
+            ts = buf[vpos:vpos + length].rstrip(b"\x00 ").decode("ascii", "replace")
+        pos = vpos + length
+    if not ts or ts in _UNSUPPORTED_TS:
+        raise _Unsupported()
+    return ts, pos
+
+def _parse(buf: bytes) -> tuple[str, dict[str, bytes]]:
+    if len(buf) < 132 or buf[128:132] != b"DICM":
+        raise _Unsupported()
+    ts, pos = _meta(buf)
+    explicit = ts != _IMPLICIT_LE
+    found: dict[str, bytes] = {}
+    prev = 0
+    while True:
+        if pos + 8 > len(buf):
+            raise _NeedMore()
+        tag, vr, length, vpos = _element(buf, pos, explicit)
+        if tag < prev:
+            raise _Unsupported()
+        prev = tag
+        if tag > _LAST_TAG:
+            break
+        if length == _UNDEFINED:
+            pos = _skip_undefined(buf, vpos, explicit and vr != b"UN")
+            continue
+        if tag in _WANTED:
+            if vpos + length > len(buf):
+                raise _NeedMore()
+            found[_WANTED[tag]] = buf[vpos:vpos + length]
+        pos = vpos + length
+    return ts, found
+
+def _text(raw: bytes | None, encodings: list[str]) -> str:
+    if not raw:
+        return ""
+    return decode_bytes(raw.rstrip(b"\x00 "), encodings, set()).strip()
+
+def _ascii(raw: bytes | None) -> str:
+    if not raw:
+        return ""
+    return raw.rstrip(b"\x00 ").decode("ascii", "replace").strip()
+
+def fast_header(path: str, size: int, mtime_ns: int = 0) -> HeaderRecord | str | None:
+    """Разобрать заголовок без pydicom; None — нужен полноценный разбор."""
+    want = min(HEADER_READ, size) if size else HEADER_READ
+    with open(path, "rb") as f:
+        buf = f.read(want)
+        while True:
+            try:
+                ts, found = _parse(buf)
+                break
+            except _NeedMore:
+                if len(buf) >= HEADER_READ_MAX or (size and len(buf) >= size):
+                    return None
+                more = f.read(min(len(buf) * 3, HEADER_READ_MAX - len(buf)))
+                if not more:
+                    return None
+                buf += more
+            except (_Unsupported, struct.error, UnicodeDecodeError):
+                return None
+    return _record(path, size, mtime_ns, ts, found)
+
+def _record(path: str, size: int, mtime_ns: int, ts: str, found: dict[str, bytes]) -> HeaderRecord | str:
+    if not (found.get("study_uid") and found.get("series_uid") and found.get("sop_uid")):
+        return "missing_tags"
+    charsets = [c for c in _ascii(found.get("charset")).split("\\") if c] or None
+    encodings = convert_encodings(charsets)
+    name_raw = (found.get("patient_name") or b"").rstrip(b"\x00 ")
+    return HeaderRecord(
+        path=path, size=size,
+        study_uid=_ascii(found["study_uid"]), series_uid=_ascii(found["series_uid"]), sop_uid=_ascii(found["sop_uid"]),
+        patient_id=_text(found.get("patient_id"), encodings),
+        patient_name=str(PersonName(name_raw, encodings=encodings)) if name_raw else "",
+        birth_date=_ascii(found.get("birth_date")), sex=_ascii(found.get("sex")),
+        study_date=_ascii(found.get("study_date")), modality=_ascii(found.get("modality")),
+        transfer_syntax=ts, mtime_ns=mtime_ns,
+    )
+
+def parse_header(p: Path | str, size: int | None = None, mtime_ns: int | None = None,
+                 fast: bool = True) -> HeaderRecord | str:
+    """Запись заголовка либо статус ошибки: invalid / error / missing_tags."""
+    path = str(p)
+    try:
+        if size is None or mtime_ns is None:
+            st = Path(path).stat()
+            size, mtime_ns = st.st_size, st.st_mtime_ns
+        if fast:
+            rec = fast_header(path, size, mtime_ns)
+            if rec is not None:
+                return rec
+        ds = pydicom.dcmread(path, stop_before_pixels=True, force=True, specific_tags=TAGS)
+    except InvalidDicomError:
+        return "invalid"
+    except Exception:
+        return "error"
+    rec = record_from_dataset(ds, path, size, mtime_ns)
+    if rec is None:
+        return "missing_tags"
+    return rec
+
+def parse_header_bytes(data: bytes, path: str, mtime_ns: int = 0, fast: bool = True) -> HeaderRecord | str:
+    """То же по содержимому файла в памяти (например, прочитанному из ISO); path — только метка."""
+    try:
+        if fast:
+            try:
+                ts, found = _parse(data[:HEADER_READ_MAX])
+                return _record(path, len(data), mtime_ns, ts, found)
+            except (_NeedMore, _Unsupported, struct.error, UnicodeDecodeError):
+                pass
+        ds = pydicom.dcmread(io.BytesIO(data), stop_before_pixels=True, force=True, specific_tags=TAGS)
+    except InvalidDicomError:
+        return "invalid"
+    except Exception:
+        return "error"
+    rec = record_from_dataset(ds, path, len(data), mtime_ns)
+    if rec is None:
+        return "missing_tags"
+    return rec
+
+_PIXEL_DATA = 0x7FE00010
+
+class PixelHasher:
+    """sha256 значения Pixel Data (7FE0,0010), считаемый по кускам файла при копировании.
+
+    Элементы до пиксельных данных пропускаются по длинам, не буферизуясь; заголовок
+    (UID, имена) в хеш не входит, поэтому диск, перезаписанный с новыми UID, даёт тот же
+    хеш. Элементы после Pixel Data (подписи, заполнитель) тоже не входят. None — пиксельных
+    данных нет, файл обрезан или формат не поддерживается быстрым разбором.
+    """
+
+    def __init__(self):
+        self._sha = hashlib.sha256()
+        self._buf = b""
+        self._pos = 0            # позиция следующего элемента в _buf
+        self._explicit: bool | None = None  # None — file meta ещё не разобран
+        self._skip = 0           # сколько байт длинного элемента осталось пропустить
+        self._left: int | None = None  # байт Pixel Data осталось; -1 — инкапсулированные, до разделителя
+        self._item = 0           # байт текущего фрагмента инкапсулированных данных осталось
+        self._hdr = b""          # начало заголовка фрагмента, разрезанного между кусками
+        self._failed = False
+
+    def update(self, chunk: bytes) -> None:
+        if self._failed or not chunk:
+            return
+        if self._left is not None:
+            self._take(chunk)
+            return
+        if self._skip:
+            n = min(self._skip, len(chunk))
+            self._skip -= n
+            chunk = chunk[n:]
+            if not chunk:
+                return
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        try:
+            self._scan()
+        except _NeedMore:
+            if len(self._buf) - self._pos > HEADER_READ_MAX:
+                self._fail()
+        except (_Unsupported, struct.error, UnicodeDecodeError):
+            self._fail()
+
+    def _fail(self):
+        self._failed = True
+        self._buf = b""
+
+    def _take(self, data: bytes):
+        if self._left < 0:
+            self._take_items(data)
+            return
+        n = min(self._left, len(data))
+        self._sha.update(data[:n])
+        self._left -= n
+
+    def _take_items(self, data: bytes):
+        # инкапсулированные данные: фрагменты (FFFE,E000) до разделителя (FFFE,E0DD) включительно
+        pos = 0
+        while pos < len(data):
+            if self._item:
+                n = min(self._item, len(data) - pos)
+                self._sha.update(data[pos:pos + n])
+                self._item -= n
+                pos += n
+                continue
+            need = 8 - len(self._hdr)
+            self._hdr += data[pos:pos + need]
+            pos += need
+            if len(self._hdr) < 8:
+                return
+            hdr, self._hdr = self._hdr, b""
+            self._sha.update(hdr)
+            group, elem, length = struct.unpack("<HHI", hdr)
+            if (group, elem) == (0xFFFE, 0xE0DD):
+                self._left = 0
+                return
+            if (group, elem) != (0xFFFE, 0xE000) or length == _UNDEFINED:
+                self._fail()
+                return
+            self._item = length
+
+    def _scan(self):
+        buf = self._buf
+        if self._explicit is None:
+            ts, self._pos = _meta(buf)
+            self._explicit = ts != _IMPLICIT_LE
+        while True:
+            tag, vr, length, vpos = _element(buf, self._pos, self._explicit)
+            if tag == _PIXEL_DATA:
+                # инкапсулированные (сжатые) данные — неопределённой длины, хешируем фрагменты до разделителя
+                self._left = -1 if length == _UNDEFINED else length
+                self._buf = b""
+                self._take(buf[vpos:])
+                return
+            if tag > _PIXEL_DATA:
+                raise _Unsupported()
+            if length == _UNDEFINED:
+                self._pos = _skip_undefined(buf, vpos, self._explicit and vr != b"UN")
+            elif vpos + length > len(buf):
+                self._skip = vpos + length - len(buf)
+                self._buf, self._pos = b"", 0
+                return
+            else:
+                self._pos = vpos + length
+
+    def hexdigest(self) -> str | None:
+        if self._failed or self._left != 0:
+            return None
+        return self._sha.hexdigest()
+
+def pixel_sha256(data: bytes) -> str | None:
+    """sha256 пиксельных данных файла, уже прочитанного в память."""
+    h = PixelHasher()
+    h.update(data)
+    return h.hexdigest()
+
+def parse_many(items: list[tuple[str, int | None, int | None]], fast: bool = True) -> list[HeaderRecord | str]:
+    # пачка файлов на одну задачу пула — меньше накладных расходов на IPC
+    return [parse_header(p, size, mtime_ns, fast) for p, size, mtime_ns in items]
@@ -1,21 +1,38 @@
 
-"""Скелет ISO-инжеста.
+"""ISO-инжест.
 Запуск: python -m server.ingest.ingest /path/to/file.iso
 
-Примечание: монтирование ISO зависит от ОС. На Linux можно использовать:
+Образ читается напрямую через pycdlib (см. isoread.py), монтировать его не нужно.
+Каталог уже смонтированного диска тоже принимается:
   sudo mount -o loop,ro file.iso /mnt/iso
-Далее обойти файлы и обработать DICOM.
+  python -m server.ingest.ingest /mnt/iso
 
-Ниже — каркас: разбор каталога, чтение заголовков, дедуп (упрощённо), раскладка.
+Разбор каталога, чтение заголовков, дедуп (по SOPInstanceUID и sha256 пиксельных данных), раскладка.
+По умолчанию диск обрабатывается конвейером (`ingest_tree`): заголовки читаются
+пулом потоков, копирование идёт отдельным ограниченным пулом, каталоги создаются
+раз на серию, а в БД пишется одна транзакция на серию. `--per-file` — прежний
+пофайловый путь (`upsert_from_header`).
 """
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
 from pathlib import Path
-import sys, shutil, hashlib, os
+from typing import Callable, Iterable
+import argparse, shutil, hashlib, os, threading, time
 import pydicom
 from pydicom.errors import InvalidDicomError
 from sqlalchemy import select
 from ..config import DICOM_ROOT
-from ..db import SessionLocal, Patient, Study, Series, Instance, Base, engine
+from ..db import SessionLocal, ReadSession, Patient, Study, Series, Instance, InstanceAlias, ensure_schema
 from ..utils import normalize_name
+from ..bulk import HeaderRecord, BatchWriter, bump_study_aggregates, file_row, refresh_study_aggregates
+from ..dcmheader import parse_header, parse_header_bytes, pixel_sha256, PixelHasher
+from .isoread import open_iso, plan, read_file
+from ..packager import coordinator
+from ..metrics import INDEX_BYTES, count_files, file_counts, finish_run
+
+# сколько файлов диска в работе одновременно (разобранных, но ещё не записанных в БД)
+PIPELINE_DEPTH = 512
+COPY_CHUNK = 1024 * 1024
 
 def ensure_dirs_for(uid: str) -> Path:
     # Фан-аут по первым 4 символам sha1(study_uid)
@@ -38,6 +55,26 @@ def upsert_from_header(ds, src_path: Path):
     study_date = str(getattr(ds, "StudyDate", ""))
     ts = str(getattr(ds, "file_meta", {}).get("TransferSyntaxUID", getattr(ds, "TransferSyntaxUID", "")))
 
+    # чтения и копирование — вне транзакции записи: писатель SQLite берёт блокировку сразу
+    # (BEGIN IMMEDIATE), и другие процессы ждали бы копирования и хеширования всего файла
+    with ReadSession() as s:
+        if s.get(Instance, sop_uid) or s.get(InstanceAlias, sop_uid):
+            # дубликат — упрощение: пропускаем
+            return False
+    dest_dir = ensure_dirs_for(study_uid) / series_uid
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    dest = dest_dir / f"{sop_uid}.dcm"
+    rec = _copy(HeaderRecord(str(src_path), 0, study_uid, series_uid, sop_uid, patient_id, patient_name,
+                             birth_date, sex, study_date, "", ts), None, dest)
+    canon = None
+    if rec.pixel_sha256:
+        with ReadSession() as s:
+            canon = _canonical(rec, _by_pixels(s, [rec.pixel_sha256]))
+    if canon:
+        # те же пиксельные данные под новыми UID — ссылка на хранимый экземпляр вместо копии
+        dest.unlink()
+    st_dest = None if canon else dest.stat()
+
     with SessionLocal() as s:
         # patient (грубый upsert)
         p = s.execute(select(Patient).where(Patient.patient_id==patient_id, Patient.birth_date==birth_date)).scalar_one_or_none()
@@ -60,26 +97,287 @@ def upsert_from_header(ds, src_path: Path):
             s.add(st)
 
         se = s.get(Series, series_uid)
+        new_series = False
         if not se:
-            se = Series(series_uid=series_uid, study_uid=study_uid)
+            se = Series(series_uid=series_uid, study_uid=study_uid, modality=str(getattr(ds, "Modality", "")))
             s.add(se)
+            new_series = True
 
-        inst = s.get(Instance, sop_uid)
-        if inst:
-            # дубликат — упрощение: пропускаем
+        if s.get(Instance, sop_uid) or s.get(InstanceAlias, sop_uid):
+            # другой процесс успел записать тот же экземпляр, пока мы копировали (файл тот же)
+            return False
+        if canon:
+            # исследование и серия остаются, агрегаты считаются вместе с дубликатами
+            s.add(InstanceAlias(sop_uid=sop_uid, series_uid=series_uid, study_uid=study_uid,
+                                instance_sop_uid=canon, source=str(src_path)))
+            s.flush()
+            refresh_study_aggregates(s, [study_uid])
+            s.commit()
             return False
-        dest_dir = ensure_dirs_for(study_uid) / series_uid
-        dest_dir.mkdir(parents=True, exist_ok=True)
-        dest = dest_dir / f"{sop_uid}.dcm"
-        shutil.copy2(src_path, dest)
-        size = dest.stat().st_size
-        inst = Instance(sop_uid=sop_uid, series_uid=series_uid, transfer_syntax=ts, size_bytes=size, path=str(dest))
+        size = st_dest.st_size
+        inst = Instance(sop_uid=sop_uid, series_uid=series_uid, transfer_syntax=ts, size_bytes=size, path=str(dest),
+                        mtime=int(st_dest.st_mtime), pixel_sha256=rec.pixel_sha256)
         s.add(inst)
+        s.flush()
+        bump_study_aggregates(s, study_uid, size, new_series)
         s.commit()
         return True
 
-def process_dir(root: Path):
+def _partial(dest: Path) -> Path:
+    # файл пишется под временным именем и переименовывается целиком:
+    # при ошибке в хранилище не остаётся обрезанного .dcm
+    return dest.with_name(f"{dest.name}.{os.getpid()}.{threading.get_ident():x}.partial")
+
+def _copy(rec: HeaderRecord, payload, dest: Path) -> HeaderRecord:
+    # один проход по источнику: пишем в хранилище и тут же хешируем пиксельные данные;
+    # mtime переносим как copy2, размер известен из разбора — stat назначения не нужен
+    h = PixelHasher()
+    tmp = _partial(dest)
+    try:
+        with open(rec.path, "rb") as src, open(tmp, "wb") as out:
+            while chunk := src.read(COPY_CHUNK):
+                out.write(chunk)
+                h.update(chunk)
+        shutil.copystat(rec.path, tmp)
+        os.replace(tmp, dest)
+    except BaseException:
+        _unlink(tmp)
+        raise
+    return rec._replace(path=str(dest), pixel_sha256=h.hexdigest())
+
+def _write(rec: HeaderRecord, payload: bytes, dest: Path) -> HeaderRecord:
+    # содержимое уже в памяти (прочитано из ISO); mtime берём у открытого файла
+    tmp = _partial(dest)
+    try:
+        with open(tmp, "wb") as f:
+            f.write(payload)
+            st = os.fstat(f.fileno())
+        os.replace(tmp, dest)
+    except BaseException:
+        _unlink(tmp)
+        raise
+    return rec._replace(path=str(dest), size=st.st_size, mtime_ns=st.st_mtime_ns,
+                        pixel_sha256=pixel_sha256(payload))
+
+def _unlink(path: Path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+class _SeriesBatch:
+    """Экземпляры одной серии в пути: копии в пуле, запись в БД одной транзакцией."""
+
+    def __init__(self, series_uid: str):
+        self.series_uid = series_uid
+        self.copies: list[tuple[str, Future]] = []  # (исходный путь, копия)
+
+def _existing(sop_uids: list[str]) -> set[str]:
+    # уже в индексе: хранимые экземпляры и принятые ранее дубликаты по содержимому
+    with ReadSession() as s:
+        out = set(s.execute(select(Instance.sop_uid).where(Instance.sop_uid.in_(sop_uids))).scalars())
+        q = select(InstanceAlias.sop_uid).where(InstanceAlias.sop_uid.in_(sop_uids))
+        return out | set(s.execute(q).scalars())
+
+def _by_pixels(s, hashes: list[str]) -> dict[str, list[tuple[str, str, tuple[str, str]]]]:
+    # pixel_sha256 -> [(SOPInstanceUID, StudyInstanceUID, (PatientID, дата рождения))] хранимых экземпляров
+    out: dict[str, list] = {}
+    hashes = sorted(set(hashes))
+    for i in range(0, len(hashes), 500):
+        q = (select(Instance.pixel_sha256, Instance.sop_uid, Series.study_uid, Patient.patient_id, Patient.birth_date)
+             .join(Series, Series.series_uid == Instance.series_uid)
+             .join(Study, Study.study_uid == Series.study_uid)
+             .join(Patient, Patient.id == Study.patient_fk)
+             .where(Instance.pixel_sha256.in_(hashes[i:i + 500])))
+        for sha, sop, study_uid, patient_id, birth_date in s.execute(q):
+            out.setdefault(sha, []).append((sop, study_uid, (patient_id, birth_date)))
+    return out
+
+def _canonical(r: HeaderRecord, *known: dict) -> str | None:
+    """Хранимый экземпляр, дубликатом которого является r, либо None.
+
+    Дубликат — те же пиксельные данные у того же пациента, но в другом исследовании
+    (диск перезаписан с новыми UID). Одинаковые срезы внутри одного исследования
+    (пустые, повторные) — законные разные экземпляры, их храним.
+    """
+    if not r.pixel_sha256:
+        return None
+    for k in known:
+        for sop, study_uid, patient in k.get(r.pixel_sha256, ()):
+            if study_uid != r.study_uid and patient == (r.patient_id, r.birth_date):
+                return sop
+    return None
+
+def _pipeline(items: Iterable, read: Callable, store: Callable, read_workers: int, copy_workers: int,
+              depth: int = PIPELINE_DEPTH) -> tuple[int, int, int, int, set[str]]:
+    """Общий конвейер инжеста; вернуть (added, skip, dup, err, затронутые исследования).
+
+    read(item) -> (HeaderRecord | статус ошибки, payload) — в пуле read_workers, по порядку items;
+    store(rec, payload, dest) -> HeaderRecord с путём в хранилище и pixel_sha256 — в пуле copy_workers.
+    dup — экземпляры с новыми UID, но уже хранимыми пиксельными данными: копия удаляется,
+    экземпляр записывается в instance_aliases со ссылкой на хранимый и упаковывается из его файла.
+    """
+    writer = BatchWriter(SessionLocal)
+    cnt_add = cnt_skip = cnt_dup = cnt_err = 0
+    touched: set[str] = set()
+    series_dirs: dict[str, Path] = {}
+    seen: set[str] = set()
+    pixels: dict[str, list] = {}  # то же, что _by_pixels, для сохранённых в этом проходе
+    batch: _SeriesBatch | None = None
+    # ограничение очереди копирования: payload в памяти не копится, если диск хранилища медленнее
+    copy_slots = threading.BoundedSemaphore(copy_workers * 4)
+
+    def flush(b: _SeriesBatch):
+        nonlocal cnt_add, cnt_dup, cnt_err
+        copied = []
+        for src, f in b.copies:
+            try:
+                copied.append((src, f.result()))
+            except OSError:
+                cnt_err += 1
+                count_files("ingest", "copy_error")
+        with ReadSession() as s:
+            known = _by_pixels(s, [r.pixel_sha256 for _, r in copied if r.pixel_sha256])
+        records, aliases = [], []
+        for src, r in copied:
+            canon = _canonical(r, known, pixels)
+            if canon is None:
+                if r.pixel_sha256:
+                    pixels.setdefault(r.pixel_sha256, []).append((r.sop_uid, r.study_uid, (r.patient_id, r.birth_date)))
+                records.append(r)
+                continue
+            # те же снимки, перезаписанные с новыми UID: заголовок другой, так что
+            # файл не побайтно равен хранимому — ссылаемся на хранимый, копию удаляем
+            os.unlink(r.path)
+            aliases.append((r._replace(path=src), canon))
+        if records or aliases:
+            rows = [file_row(r.path, r.size, r.mtime_ns, "ok") for r in records]
+            touched.update(writer.write(records, rows, aliases=aliases))
+            cnt_add += len(records)
+            cnt_dup += len(aliases)
+            count_files("ingest", "ok", len(records))
+            count_files("ingest", "dup", len(aliases))
+            INDEX_BYTES.inc(sum(r.size or 0 for r in records), tool="ingest")
+
+    with ThreadPoolExecutor(read_workers, thread_name_prefix="ingest-read") as read_pool, \
+            ThreadPoolExecutor(copy_workers, thread_name_prefix="ingest-copy") as copy_pool:
+        pending: deque[Future] = deque()
+        it = iter(items)
+
+        def fill():
+            while len(pending) < depth:
+                item = next(it, None)
+                if item is None:
+                    return
+                pending.append(read_pool.submit(read, item))
+
+        fill()
+        while pending:
+            # пачка разобранных заголовков по порядку обхода; дубликаты отсекаем одним запросом
+            chunk = []
+            while pending and len(chunk) < 256:
+                chunk.append(pending.popleft().result())
+            fill()
+            recs = []
+            for r, payload in chunk:
+                if isinstance(r, str):
+                    cnt_err += 1
+                    count_files("ingest", r)
+                elif r.sop_uid in seen:
+                    cnt_skip += 1
+                    count_files("ingest", "skip")
+                else:
+                    seen.add(r.sop_uid)
+                    recs.append((r, payload))
+            dup = _existing([r.sop_uid for r, _ in recs]) if recs else set()
+            for r, payload in recs:
+                if r.sop_uid in dup:
+                    cnt_skip += 1  # дубликат — упрощение: пропускаем
+                    count_files("ingest", "skip")
+                    continue
+                if batch is None or batch.series_uid != r.series_uid:
+                    # серия сменилась — предыдущую дописываем в БД, когда докопируются её файлы
+                    if batch is not None:
+                        flush(batch)
+                    batch = _SeriesBatch(r.series_uid)
+                dest_dir = series_dirs.get(r.series_uid)
+                if dest_dir is None:
+                    # каталог серии создаём один раз, а не на каждый файл
+                    dest_dir = series_dirs[r.series_uid] = ensure_dirs_for(r.study_uid) / r.series_uid
+                    dest_dir.mkdir(parents=True, exist_ok=True)
+                copy_slots.acquire()
+                fut = copy_pool.submit(store, r, payload, dest_dir / f"{r.sop_uid}.dcm")
+                fut.add_done_callback(lambda _: copy_slots.release())
+                batch.copies.append((r.path, fut))
+        if batch is not None:
+            flush(batch)
+    return cnt_add, cnt_skip, cnt_dup, cnt_err, touched
+
+def ingest_tree(root: Path, parse_workers: int = 8, copy_workers: int = 4) -> tuple[int, int, int, int, set[str]]:
+    """Конвейерный инжест дерева файлов (смонтированного диска)."""
+    paths = (p for p in root.rglob("*") if p.is_file())
+    return _pipeline(paths, lambda p: (parse_header(p), None), _copy, parse_workers, copy_workers)
+
+def ingest_iso(iso_path: Path, parse_workers: int = 8, copy_workers: int = 4) -> tuple[int, int, int, int, set[str]]:
+    """Инжест прямо из образа .iso: план по DICOMDIR, чтение в порядке экстентов."""
+    iso = open_iso(str(iso_path))
+    try:
+        entries, from_dicomdir = plan(iso)
+        skipped = 0
+        if from_dicomdir:
+            # SOPInstanceUID известен из DICOMDIR — уже проиндексированное даже не читаем
+            known = set()
+            hinted = [e.sop_uid for e in entries if e.sop_uid]
+            for i in range(0, len(hinted), 500):
+                known |= _existing(hinted[i:i + 500])
+            before = len(entries)
+            entries = [e for e in entries if e.sop_uid not in known]
+            skipped = before - len(entries)
+            count_files("ingest", "skip", skipped)
+        mtime_ns = iso_path.stat().st_mtime_ns
+
+        def read(job):
+            # разбор — в пуле конвейера; содержимое уже читает единственный поток чтения
+            e, data = job
+            try:
+                data = data.result()
+            except Exception:
+                return "read_error", None
+            return parse_header_bytes(data, f"{iso_path}:{e.iso_path}", mtime_ns), data
+
+        # pycdlib читает через один файловый объект — один поток чтения, строго по экстентам;
+        # конвейер берёт не больше depth файлов вперёд, так что в памяти не больше depth содержимых
+        with ThreadPoolExecutor(1, thread_name_prefix="ingest-iso") as reader:
+            jobs = ((e, reader.submit(read_file, iso, e)) for e in entries)
+            added, skip, dup, err, touched = _pipeline(jobs, read, _write, parse_workers, copy_workers, depth=64)
+        return added, skip + skipped, dup, err, touched
+    finally:
+        iso.close()
+
+def process_dir(root: Path, prebuild: bool = True, per_file: bool = False,
+                parse_workers: int = 8, copy_workers: int = 4) -> set[str]:
+    """Инжест образа или каталога; вернуть StudyInstanceUID, куда добавлены экземпляры."""
+    started = time.monotonic()
+    cnt_dup = 0
+    if root.is_file() and root.suffix.lower() == ".iso":
+        cnt_add, cnt_skip, cnt_dup, cnt_err, touched = ingest_iso(root, parse_workers, copy_workers)
+    elif not per_file:
+        cnt_add, cnt_skip, cnt_dup, cnt_err, touched = ingest_tree(root, parse_workers, copy_workers)
+    else:
+        cnt_add, cnt_skip, cnt_err, touched = _process_dir_per_file(root)
+    reasons = " ".join(f"{k}={v}" for k, v in sorted(file_counts("ingest").items())
+                       if k not in ("ok", "skip", "dup"))
+    print(f"added={cnt_add} skip={cnt_skip} dup={cnt_dup} err={cnt_err}" + (f" ({reasons})" if reasons else ""))
+    finish_run("ingest", started, cnt_add + cnt_skip + cnt_dup + cnt_err)
+    if prebuild and touched:
+        # свежий диск, скорее всего, скоро откроют — соберём архивы заранее
+        for f in coordinator.prebuild(sorted(touched)):
+            f.result()
+    return touched
+
+def _process_dir_per_file(root: Path) -> tuple[int, int, int, set[str]]:
     cnt_add = cnt_skip = cnt_err = 0
+    touched: set[str] = set()
     for p in root.rglob("*"):
         if not p.is_file():
             continue
@@ -91,20 +389,29 @@ def process_dir(root: Path):
                                  )
         except InvalidDicomError:
             cnt_err += 1
+            count_files("ingest", "invalid")
             continue
         except Exception:
             cnt_err += 1
+            count_files("ingest", "error")
             continue
         ok = upsert_from_header(ds, p)
         if ok:
             cnt_add += 1
+            touched.add(str(ds.StudyInstanceUID))
         else:
             cnt_skip += 1
-    print(f"added={cnt_add} skip={cnt_skip} err={cnt_err}")
+        count_files("ingest", "ok" if ok else "skip")
+    return cnt_add, cnt_skip, cnt_err, touched
 
 if __name__ == "__main__":
-    Base.metadata.create_all(bind=engine)
-    if len(sys.argv) < 2:
-        print("Usage: python -m server.ingest.ingest /path/to/mounted_iso_dir")
-        sys.exit(1)
-    process_dir(Path(sys.argv[1]))
+    ap = argparse.ArgumentParser(description="Инжест ISO в DICOM_ROOT")
+    ap.add_argument("path", help="файл .iso (читается без монтирования) или каталог смонтированного ISO")
+    ap.add_argument("--parse-workers", type=int, default=8, help="потоков чтения заголовков")
+    ap.add_argument("--copy-workers", type=int, default=4, help="потоков копирования в хранилище")
+    ap.add_argument("--per-file", action="store_true", help="прежний режим: транзакция и mkdir на каждый файл")
+    ap.add_argument("--no-prebuild", action="store_true", help="не собирать архивы затронутых исследований")
+    args = ap.parse_args()
+    ensure_schema()
+    process_dir(Path(args.path), prebuild=not args.no_prebuild, per_file=args.per_file,
+                parse_workers=args.parse_workers, copy_workers=args.copy_workers)
@@ -0,0 +1,82 @@
+"""Чтение DICOM прямо из образа ISO через pycdlib, без монтирования.
+
+Если на диске есть DICOMDIR, план инжеста строится по нему: читаются только
+файлы, на которые он ссылается (прочие не открываются и не разбираются),
+и SOPInstanceUID известен заранее — дубликаты можно отсечь до чтения.
+Файлы читаются в порядке их экстентов на диске, чтобы оптика и USB
+читались последовательно, без скачков головки.
+"""
+import io
+from pathlib import PurePosixPath
+from typing import Iterator, NamedTuple
+import pycdlib
+import pydicom
+
+class IsoEntry(NamedTuple):
+    iso_path: str          # путь в пространстве имён ISO9660 (как понимает pycdlib)
+    extent: int            # первый логический блок файла на диске
+    size: int
+    sop_uid: str | None = None  # из DICOMDIR, если есть
+
+def _norm(name: str) -> str:
+    # "IM000001;1" / "IM000001." -> "IM000001": так имена записаны в DICOMDIR
+    return name.split(";", 1)[0].rstrip(".").upper()
+
+def open_iso(path: str) -> pycdlib.PyCdlib:
+    iso = pycdlib.PyCdlib()
+    iso.open(path)
+    return iso
+
+def iso_files(iso: pycdlib.PyCdlib) -> dict[str, IsoEntry]:
+    """Все файлы образа: нормализованный путь -> запись с экстентом и размером."""
+    out = {}
+    for parent, _, files in iso.walk(iso_path="/"):
+        for name in files:
+            full = f"{parent.rstrip('/')}/{name}"
+            rec = iso.get_record(iso_path=full)
+            key = "/".join(_norm(part) for part in PurePosixPath(full).parts[1:])
+            out[key] = IsoEntry(full, rec.extent_location(), rec.get_data_length())
+    return out
+
+def read_file(iso: pycdlib.PyCdlib, entry: IsoEntry) -> bytes:
+    with iso.open_file_from_iso(iso_path=entry.iso_path) as f:
+        return f.read()
+
+def _dicomdir_refs(data: bytes) -> Iterator[tuple[str, str | None]]:
+    # (путь файла из ReferencedFileID, SOPInstanceUID) по записям DICOMDIR
+    ds = pydicom.dcmread(io.BytesIO(data), force=True)
+    for rec in ds.get("DirectoryRecordSequence", []):
+        ref = rec.get("ReferencedFileID")
+        if not ref:
+            continue
+        parts = [ref] if isinstance(ref, str) else list(ref)
+        sop = rec.get("ReferencedSOPInstanceUIDInFile")
+        yield "/".join(_norm(str(p)) for p in parts), str(sop) if sop else None
+
+def plan(iso: pycdlib.PyCdlib) -> tuple[list[IsoEntry], bool]:
+    """Файлы для инжеста в порядке экстентов; второй элемент — план взят из DICOMDIR.
+
+    Без DICOMDIR (или если он не читается) — все файлы образа, их разбирает инжест.
+    """
+    files = iso_files(iso)
+    dicomdirs = sorted((k for k in files if k.rsplit("/", 1)[-1] == "DICOMDIR"), key=len)
+    entries: list[IsoEntry] = []
+    from_dicomdir = False
+    if dicomdirs:
+        key = dicomdirs[0]
+        base = key.rsplit("/", 1)[0] + "/" if "/" in key else ""
+        try:
+            refs = list(_dicomdir_refs(read_file(iso, files[key])))
+        except Exception:
+            refs = []
+        seen = set()
+        for rel, sop in refs:
+            e = files.get(base + rel)
+            if e is not None and e.iso_path not in seen:
+                seen.add(e.iso_path)
+                entries.append(e._replace(sop_uid=sop))
+        from_dicomdir = bool(entries)
+    if not from_dicomdir:
+        entries = [e for k, e in files.items() if k.rsplit("/", 1)[-1] != "DICOMDIR"]
+    entries.sort(key=lambda e: e.extent)
+    return entries, from_dicomdir
@@ -0,0 +1,127 @@
+"""Асинхронные задания сборки архивов: POST → опрос прогресса → скачивание.
+
+Сборка идёт в отдельном ограниченном пуле и не держит ни HTTP-соединение,
+ни поток обработчиков FastAPI. Задание на архив, который уже собирается
+(другим заданием, потоковой выдачей /package или предсборкой), присоединяется
+к этой сборке через BuildCoordinator и показывает её прогресс.
+"""
+import threading, time, uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from .cache import PackageCache
+from .packager import (BuildCoordinator, PackageBuild, SeriesPart, study_instances, package_layout, instances_bytes,
+                       compression_level)
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+@dataclass
+class PackageJob:
+    id: str
+    study_uid: str
+    package_path: Path
+    files_total: int
+    bytes_total: int
+    level: int
+    state: str = QUEUED
+    created: float = field(default_factory=time.time)
+    finished: float | None = None
+    error: str | None = None
+    build: PackageBuild | None = None
+
+    def status(self) -> dict:
+        b = self.build
+        files_done = b.files_done if b else (self.files_total if self.state == DONE else 0)
+        bytes_done = b.bytes_done if b else (self.bytes_total if self.state == DONE else 0)
+        eta = None
+        if self.state == RUNNING and b is not None and b.started and bytes_done:
+            rate = bytes_done / max(time.time() - b.started, 1e-3)
+            eta = round(max(self.bytes_total - bytes_done, 0) / rate, 1)
+        out = {
+            "id": self.id,
+            "study_uid": self.study_uid,
+            "state": self.state,
+            "files_done": files_done,
+            "files_total": self.files_total,
+            "bytes_done": bytes_done,
+            "bytes_total": self.bytes_total,
+            "eta_sec": eta,
+            "level": self.level,
+            "created": int(self.created),
+            "error": self.error,
+        }
+        if self.state == DONE and self.package_path.exists():
+            out["package_bytes"] = self.package_path.stat().st_size
+        return out
+
+class JobManager:
+    def __init__(self, coordinator: BuildCoordinator, cache: PackageCache, workers: int = 2, ttl_sec: float = 3600):
+        self.coordinator = coordinator
+        self.cache = cache
+        self.ttl_sec = ttl_sec
+        self._jobs: dict[str, PackageJob] = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="package-job")
+
+    def _purge(self):
+        # завершённые задания живут ttl_sec, потом забываются (архив остаётся в кэше)
+        now = time.time()
+        for jid, job in list(self._jobs.items()):
+            if job.finished is not None and now - job.finished > self.ttl_sec:
+                del self._jobs[jid]
+
+    def submit(self, study_uid: str, series_uids: list[str] | None = None) -> PackageJob | None:
+        """Поставить сборку в очередь; None — исследования (серий) нет в индексе."""
+        instances = study_instances(study_uid, series_uids)
+        if not instances:
+            return None
+        package_path, parts = package_layout(study_uid, instances, series_uids)
+        with self._lock:
+            self._purge()
+            # повторный запрос того же архива — то же задание, пока оно не забыто
+            for job in self._jobs.values():
+                if job.package_path != package_path or job.state == FAILED:
+                    continue
+                if job.state != DONE or package_path.exists():
+                    return job
+            job = PackageJob(id=uuid.uuid4().hex, study_uid=study_uid, package_path=package_path,
+                             files_total=len(instances), bytes_total=instances_bytes(instances),
+                             level=compression_level(instances))
+            self._jobs[job.id] = job
+        if self.cache.lookup(package_path):
+            self._finish(job)
+        else:
+            self._pool.submit(self._run, job, parts)
+        return job
+
+    def _finish(self, job: PackageJob, error: BaseException | None = None):
+        job.error = str(error) if error is not None else None
+        job.state = FAILED if error is not None else DONE
+        job.finished = time.time()
+        job.build = None  # список файлов сборки больше не нужен
+
+    def _run(self, job: PackageJob, parts: list[SeriesPart]):
+        try:
+            build, created = self.coordinator.acquire(job.package_path, parts, job.bytes_total, job.level)
+            if build is None:
+                self._finish(job)  # успели собрать, пока задание стояло в очереди
+                return
+            job.build = build
+            job.state = RUNNING
+            if created:
+                build.run()  # в потоке пула — пул и ограничивает число одновременных сборок
+            else:
+                build.done.wait()
+            self._finish(job, build.error)
+        except Exception as e:
+            self._finish(job, e)
+
+    def get(self, job_id: str) -> PackageJob | None:
+        with self._lock:
+            self._purge()
+            return self._jobs.get(job_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            states = [j.state for j in self._jobs.values()]
+        return {s: states.count(s) for s in (QUEUED, RUNNING, DONE, FAILED)}
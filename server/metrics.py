@@ -0,0 +1,279 @@
+"""Метрики производительности в текстовом формате Prometheus.
+
+Без внешних зависимостей: счётчики, гистограммы и значения с метками,
+потокобезопасные. API отдаёт их на `/metrics`; индексатор и инжест живут
+недолго, поэтому итог прогона пишут в файл METRICS_TEXTFILE для
+textfile-коллектора node_exporter.
+
+Фазы выдачи архива (query — запрос к БД, read — ожидание чтения исходных
+файлов, tar — заголовки и копирование членов tar, compress — zstd,
+send — отправка клиенту) копятся в гистограмме `package_phase_seconds`.
+При SERVER_TIMING=1 фазы, измеренные в обработчике запроса, уходят клиенту
+заголовком Server-Timing. Сборка архива идёт в своём потоке и копит фазы
+у себя; запрос, дождавшийся сборки (Range/HEAD, PACKAGE_STREAMING=0), получает
+их в заголовке, а потоковый ответ — нет: заголовок уходит до конца сборки.
+"""
+import os, threading, time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterable, Iterator
+from .config import SERVER_TIMING, METRICS_TEXTFILE
+
+# секунды: от быстрых запросов к индексу до сборки крупного исследования
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _num(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._lock = threading.Lock()
+        self._values: dict[tuple, object] = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def _labels(self, key: tuple, extra: tuple = ()) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+    def items(self) -> dict[tuple, object]:
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self) -> Iterator[str]:
+        for key, v in sorted(self.items().items()):
+            yield f"{self.name}{self._labels(key)} {_num(v)}"
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, value: float, **labels):
+        # для счётчиков, которые ведёт сам объект (PackageCache.hits и т.п.): переносим при сборе
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+class Gauge(Counter):
+    kind = "gauge"
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            h = self._values.get(key)
+            if h is None:
+                # [счётчики по корзинам (последняя — выше всех границ), сумма, количество]
+                h = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            items = sorted((k, ([*h[0]], h[1], h[2])) for k, h in self._values.items())
+        for key, (counts, total, n) in items:
+            acc = 0
+            for le, c in zip(self.buckets + (float("inf"),), counts):
+                acc += c
+                yield f"{self.name}_bucket{self._labels(key, (('le', _num(le)),))} {acc}"
+            yield f"{self.name}_sum{self._labels(key)} {_num(total)}"
+            yield f"{self.name}_count{self._labels(key)} {n}"
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+        self._hooks: list[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def _add(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, labels: Iterable[str] = ()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Iterable[str] = ()) -> Gauge:
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Iterable[str] = (),
+                  buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def on_collect(self, fn: Callable[[], None]):
+        """fn вызывается перед каждой выдачей — обновить значения, которые ведут другие объекты."""
+        self._hooks.append(fn)
+
+    def render(self) -> str:
+        for fn in self._hooks:
+            fn()
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for m in metrics:
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            lines.extend(m.samples())
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: str):
+        # атомарно: коллектор не должен прочитать недописанный файл
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.counter("http_requests_total", "Запросы к API", ("method", "route", "status"))
+HTTP_DURATION = REGISTRY.histogram("http_request_duration_seconds", "Время запроса до последнего байта ответа",
+                                   ("method", "route"))
+HTTP_BYTES = REGISTRY.counter("http_response_bytes_total", "Байт тела ответов отдано клиентам", ("route",))
+PACKAGE_PHASE = REGISTRY.histogram("package_phase_seconds",
+                                   "Время фаз выдачи архива: query, read, tar, compress (на кадр серии), send",
+                                   ("phase",))
+PACKAGE_BUILDS = REGISTRY.counter("package_builds_total", "Сборки архивов", ("result",))
+PACKAGE_BUILD_SECONDS = REGISTRY.histogram("package_build_seconds", "Длительность сборки архива")
+PACKAGE_BUILD_BYTES = REGISTRY.counter("package_build_input_bytes_total", "Байт исходных файлов упаковано")
+CACHE_LOOKUPS = REGISTRY.counter("package_cache_lookups_total", "Обращения к кэшу архивов", ("cache", "result"))
+CACHE_EVICTIONS = REGISTRY.counter("package_cache_evictions_total", "Вытеснено архивов", ("cache",))
+CACHE_BYTES = REGISTRY.gauge("package_cache_bytes", "Занято кэшем, байт", ("cache",))
+CACHE_ENTRIES = REGISTRY.gauge("package_cache_entries", "Архивов в кэше", ("cache",))
+INDEX_FILES = REGISTRY.counter("index_files_total",
+                               "Файлы индексатора и инжеста по итогу: ok, skip, dup или причина ошибки",
+                               ("tool", "status"))
+INDEX_BYTES = REGISTRY.counter("index_bytes_total", "Байт обработанных файлов", ("tool",))
+INDEX_RUN_SECONDS = REGISTRY.gauge("index_run_duration_seconds", "Длительность последнего прогона", ("tool",))
+INDEX_RUN_RATE = REGISTRY.gauge("index_run_files_per_second", "Файлов в секунду за последний прогон", ("tool",))
+INDEX_RUN_FINISHED = REGISTRY.gauge("index_run_finished_timestamp_seconds", "Когда закончился последний прогон",
+                                    ("tool",))
+WATCH_LAG = REGISTRY.histogram("watcher_index_lag_seconds",
+                               "Демон индексации: от первого события в каталоге до записи в индекс")
+
+# фазы текущего запроса (для Server-Timing); обработчики FastAPI в пуле потоков видят тот же словарь
+_request_timings: ContextVar[dict[str, float] | None] = ContextVar("request_timings", default=None)
+
+def record(hist: Histogram, seconds: float, **labels):
+    """Учесть уже измеренную длительность; фаза попадает и в Server-Timing текущего запроса."""
+    hist.observe(seconds, **labels)
+    timings = _request_timings.get()
+    if timings is not None:
+        key = labels.get("phase", hist.name)
+        timings[key] = timings.get(key, 0.0) + seconds
+
+@contextmanager
+def phase_timings(timings: dict[str, float]):
+    """Собирать фазы record/timed в timings — например, в потоке фоновой сборки архива."""
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+def add_timings(timings: dict[str, float]):
+    """Добавить уже собранные фазы (дождались сборки) в Server-Timing текущего запроса."""
+    current = _request_timings.get()
+    if current is not None:
+        for key, seconds in timings.items():
+            current[key] = current.get(key, 0.0) + seconds
+
+@contextmanager
+def timed(hist: Histogram, **labels):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(hist, time.perf_counter() - t0, **labels)
+
+def count_files(tool: str, status: str, n: int = 1):
+    if n:
+        INDEX_FILES.inc(n, tool=tool, status=status)
+
+def file_counts(tool: str) -> dict[str, int]:
+    """Итог по статусам для одного инструмента: {"ok": ..., "invalid": ...}."""
+    return {status: int(v) for (t, status), v in INDEX_FILES.items().items() if t == tool}
+
+def finish_run(tool: str, started: float, files: int):
+    """Итог прогона CLI; при METRICS_TEXTFILE — записать все метрики в файл."""
+    elapsed = max(time.monotonic() - started, 1e-6)
+    INDEX_RUN_SECONDS.set(round(elapsed, 3), tool=tool)
+    INDEX_RUN_RATE.set(round(files / elapsed, 1), tool=tool)
+    INDEX_RUN_FINISHED.set(int(time.time()), tool=tool)
+    if METRICS_TEXTFILE:
+        REGISTRY.write_textfile(METRICS_TEXTFILE)
+
+def _route(scope) -> str:
+    # шаблон пути (/package-jobs/{job_id}), а не сам путь — иначе метка на каждый id
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+class MetricsMiddleware:
+    """ASGI: время и объём ответов по маршрутам, фаза send для архивов, заголовок Server-Timing."""
+
+    def __init__(self, app, server_timing: bool = SERVER_TIMING):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        t0 = time.perf_counter()
+        timings: dict[str, float] = {}
+        token = _request_timings.set(timings)
+        state = {"status": 500, "sent": 0, "started": None, "archive": False}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+                state["started"] = time.perf_counter()
+                headers = list(message.get("headers", []))
+                state["archive"] = any(k == b"content-type" and v.startswith(b"application/zstd") for k, v in headers)
+                if self.server_timing:
+                    parts = [f"{k};dur={v * 1000:.1f}" for k, v in timings.items()]
+                    parts.append(f"app;dur={(state['started'] - t0) * 1000:.1f}")
+                    headers.append((b"server-timing", ", ".join(parts).encode()))
+                    message = dict(message, headers=headers)
+            elif message["type"] == "http.response.body":
+                state["sent"] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_timings.reset(token)
+            now = time.perf_counter()
+            route, method = _route(scope), scope.get("method", "")
+            HTTP_REQUESTS.inc(method=method, route=route, status=state["status"])
+            HTTP_DURATION.observe(now - t0, method=method, route=route)
+            HTTP_BYTES.inc(state["sent"], route=route)
+            if state["archive"] and state["started"] is not None:
+                PACKAGE_PHASE.observe(now - state["started"], phase="send")
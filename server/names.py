@@ -0,0 +1,166 @@
+"""Нечёткий поиск пациентов по ФИО: триграммный индекс в памяти.
+
+Имя приводится к «ключу»: normalize_name, кириллица транслитерируется,
+латинские варианты одного звука сводятся к одному (kh/h, yu/iu, y/i…),
+поэтому «Иванов», «Ivanov» и «Ivanof» близки. Сходство — доля общих
+триграмм; отсутствующее отчество в запросе не штрафуется.
+
+Индекс строится из таблицы patients при первом обращении и дочитывает
+новых пациентов (id больше последнего загруженного) не чаще раза в
+refresh_sec. Правки имён уже загруженных пациентов подхватываются при
+перезапуске либо rebuild().
+"""
+import math, re, threading, time
+from array import array
+from collections import Counter
+from sqlalchemy import select
+from .db import ReadSession, Patient, stream
+from .utils import normalize_name
+
+_CYR = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ж": "zh", "з": "z",
+    "и": "i", "й": "i", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p",
+    "р": "r", "с": "s", "т": "t", "у": "u", "ф": "f", "х": "h", "ц": "ts", "ч": "ch",
+    "ш": "sh", "щ": "shch", "ъ": "", "ы": "i", "ь": "", "э": "e", "ю": "iu", "я": "ia",
+    "і": "i", "ї": "i", "є": "e", "ґ": "g",
+}
+_TRANSLIT = str.maketrans(_CYR)
+# разные латинские записи одного звука (паспортные, ГОСТ, «на слух»)
+_FOLD = [
+    (re.compile(r"kh"), "h"),
+    (re.compile(r"[yj]([aeiou])"), r"i\1"),
+    (re.compile(r"[yj]"), "i"),
+    (re.compile(r"x"), "ks"),
+    (re.compile(r"w"), "v"),
+    (re.compile(r"ck"), "k"),
+    (re.compile(r"ph"), "f"),
+    (re.compile(r"(.)\1+"), r"\1"),  # удвоенные буквы
+    (re.compile(r"[^a-z0-9 ]+"), ""),
+]
+
+def name_key(name: str) -> str:
+    """Нормализованная латинская форма ФИО для сравнения."""
+    s = normalize_name(name).translate(_TRANSLIT)
+    for rx, repl in _FOLD:
+        s = rx.sub(repl, s)
+    return " ".join(s.split())
+
+def trigrams(key: str) -> set[str]:
+    # по словам, с отступами как в pg_trgm: начало слова весит больше
+    out = set()
+    for w in key.split():
+        w = f"  {w} "
+        out.update(w[i:i + 3] for i in range(len(w) - 2))
+    return out
+
+def _score(shared: int, qlen: int, clen: int) -> float:
+    jaccard = shared / (qlen + clen - shared)
+    # запрос без отчества/имени: покрытие запроса важнее лишних слов у кандидата
+    cover = shared / qlen
+    return max(jaccard, 0.9 * cover)
+
+def similarity(q: set[str], c: set[str]) -> float:
+    """Сходство запроса с именем кандидата, 0..1."""
+    if not q or not c:
+        return 0.0
+    return _score(len(q & c), len(q), len(c))
+
+class NameIndex:
+    def __init__(self, refresh_sec: float = 30.0):
+        self.refresh_sec = refresh_sec
+        self._lock = threading.Lock()
+        self._postings: dict[str, array] = {}
+        self._keys: dict[int, str] = {}
+        self._glen: dict[int, int] = {}  # id -> число триграмм имени
+        self._info: dict[int, tuple[str, str]] = {}  # id -> (birth_date, sex)
+        self._by_dob: dict[str, array] = {}
+        self._max_id = 0
+        self._checked = 0.0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _add(self, pid: int, name: str, birth_date: str | None, sex: str | None):
+        key = name_key(name or "")
+        grams = trigrams(key)
+        self._keys[pid] = key
+        self._glen[pid] = len(grams)
+        self._info[pid] = (birth_date or "", (sex or "").upper())
+        self._by_dob.setdefault(birth_date or "", array("i")).append(pid)
+        for g in grams:
+            self._postings.setdefault(g, array("i")).append(pid)
+
+    def refresh(self, force: bool = False) -> int:
+        """Дочитать новых пациентов; вернуть сколько добавлено."""
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._checked < self.refresh_sec:
+                return 0
+            added = 0
+            with ReadSession() as s:
+                q = (select(Patient.id, Patient.patient_name, Patient.birth_date, Patient.sex)
+                     .where(Patient.id > self._max_id).order_by(Patient.id))
+                for pid, name, dob, sex in stream(s, q, 10000):
+                    self._add(pid, name, dob, sex)
+                    self._max_id = pid
+                    added += 1
+            self._checked = time.monotonic()
+            return added
+
+    def rebuild(self):
+        with self._lock:
+            self._postings, self._keys, self._glen, self._info, self._by_dob = {}, {}, {}, {}, {}
+            self._max_id = 0
+        self.refresh(force=True)
+
+    def _shared(self, grams: set[str], min_score: float, limit: int) -> Counter:
+        # число общих триграмм с запросом у каждого кандидата; считает Counter на C.
+        # Префиксный фильтр: при покрытии >= need кандидат обязан содержать хотя бы
+        # одну из (len - need + 1) самых редких триграмм — остальные только досчитываем.
+        need = max(1, math.ceil(len(grams) * min_score))
+        rare = sorted(grams, key=lambda g: len(self._postings.get(g, ())))
+        prefix = len(grams) - need + 1
+        # очень частые триграммы («ov », « iv») в отбор не берём, если редких уже хватило:
+        # кандидаты, совпадающие только по ним, всё равно не попадут в первые limit
+        common = max(20000, len(self._keys) // 50)
+        shared: Counter = Counter()
+        for i, g in enumerate(rare[:prefix]):
+            posting = self._postings.get(g, ())
+            if shared and len(posting) > common and len(shared) >= limit:
+                prefix = i
+                break
+            shared.update(posting)
+        if not shared:
+            return shared
+        # остальные (частые) триграммы досчитываем по ключам лучших кандидатов, а не по спискам
+        rest = set(rare[prefix:])
+        top = shared.most_common(max(limit * 50, 1000))
+        return Counter({pid: n + len(rest & trigrams(self._keys[pid])) for pid, n in top})
+
+    def search(self, name: str, dob: str | None = None, sex: str | None = None,
+               limit: int = 20, min_score: float = 0.45) -> list[tuple[int, float]]:
+        """Ранжированные (patient id, сходство) по убыванию сходства."""
+        self.refresh()
+        grams = trigrams(name_key(name))
+        if not grams:
+            return []
+        sex = (sex or "").upper()
+        scored = []
+        with self._lock:
+            if dob:
+                # дата рождения известна — сравниваем только с её владельцами
+                pool = {pid: len(grams & trigrams(self._keys[pid])) for pid in self._by_dob.get(dob, ())}
+            else:
+                pool = self._shared(grams, min_score, limit)
+            for pid, shared in pool.items():
+                if sex and self._info[pid][1] not in ("", sex):
+                    continue
+                score = _score(shared, len(grams), self._glen[pid])
+                if score >= min_score:
+                    scored.append((pid, round(score, 3)))
+        scored.sort(key=lambda t: (-t[1], t[0]))
+        return scored[:limit]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"patients": len(self._keys), "trigrams": len(self._postings), "max_id": self._max_id}
@@ -1,50 +1,499 @@
-
-import io, os, tarfile, hashlib, time
+import os, shutil, tarfile, hashlib, time, json, threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from email.utils import formatdate
 from pathlib import Path
-from typing import Iterable, Tuple
+from typing import Iterable, Iterator, BinaryIO, Callable, NamedTuple
 import zstandard as zstd
-from fastapi.responses import FileResponse
-from .config import CACHE_DIR
+from fastapi.responses import FileResponse, StreamingResponse
+from sqlalchemy import select, union_all
+from .config import (CACHE_DIR, SERIES_CACHE, SERIES_CACHE_DIR, PACKAGE_STREAMING, PREBUILD_WORKERS, PREBUILD_QUEUE, CACHE_MAX_BYTES, CACHE_POLICY,
+                     PACK_THREADS, PACK_LEVEL_RAW, PACK_LEVEL_MIXED, PACK_LEVEL_COMPRESSED, PACK_COMPRESSED_SHARE,
+                     PREFETCH_THREADS, PREFETCH_BYTES, PREFETCH_MAX_FILE)
+from .db import ReadSession, Series, Instance, InstanceAlias, stream
+from .cache import PackageCache, instance_set_key
+from .readahead import PackFile, read_ahead
+from .metrics import (PACKAGE_PHASE, PACKAGE_BUILDS, PACKAGE_BUILD_SECONDS, PACKAGE_BUILD_BYTES, record, timed,
+                      phase_timings, add_timings)
+
+CHUNK_SIZE = 1024 * 1024
+# версия раскладки архива (StudyUID/SeriesUID/файл, кадр zstd на серию); входит в ключ кэша
+ARCHIVE_VERSION = "2"
+
+# Transfer syntax со сжатыми пикселями (JPEG, JPEG-LS, JPEG 2000, HTJ2K, MPEG/HEVC, RLE, deflate):
+# zstd на них почти ничего не выигрывает, только тратит CPU
+_COMPRESSED_TS_PREFIXES = ("1.2.840.10008.1.2.4.", "1.2.840.10008.1.2.5", "1.2.840.10008.1.2.1.99")
+
+class InstanceRow(NamedTuple):
+    sop_uid: str
+    size_bytes: int | None
+    path: str
+    transfer_syntax: str | None = None
+    mtime: int | None = None
+    series_uid: str = ""
 
-def _manifest_entry(relpath: str, abspath: str):
-    st = os.stat(abspath)
+def is_compressed_ts(ts: str | None) -> bool:
+    return bool(ts) and ts.startswith(_COMPRESSED_TS_PREFIXES)
+
+def compression_level(instances: Iterable[InstanceRow]) -> int:
+    """Уровень zstd по составу исследования: доля (по байтам) уже сжатых экземпляров."""
+    total = compressed = 0
+    for inst in instances:
+        size = inst.size_bytes or 0
+        total += size
+        if is_compressed_ts(inst.transfer_syntax):
+            compressed += size
+    if not total:
+        return PACK_LEVEL_MIXED
+    share = compressed / total
+    if share >= PACK_COMPRESSED_SHARE:
+        return PACK_LEVEL_COMPRESSED
+    if share <= 1 - PACK_COMPRESSED_SHARE:
+        return PACK_LEVEL_RAW
+    return PACK_LEVEL_MIXED
+
+def _manifest_entry(relpath: str, size: int, mtime: int, series_uid: str | None = None):
     return {
         "path": relpath,
-        "size": st.st_size,
-        "mtime": int(st.st_mtime)
+        "size": size,
+        "mtime": mtime,
+        "series": series_uid,
     }
 
-def build_tar_zst(package_path: Path, base_dir: Path, files: Iterable[Tuple[str, str]]):
-    # files: iterator of (relpath, abspath)
-    tmp_tar = package_path.with_suffix(".partial.tar")
-    tmp_zst = package_path.with_suffix(".partial.tar.zst")
-    # 1) tar
-    with tarfile.open(tmp_tar, mode="w") as tf:
-        # добавим manifest.json в корень
-        manifest = []
-        for rel, abs_ in files:
-            manifest.append(_manifest_entry(rel, abs_))
-            tf.add(abs_, arcname=rel, recursive=False)
-        # manifest
-        import json, tempfile
-        data = json.dumps({"version":"1","generated":int(time.time()),"files":manifest}, ensure_ascii=False).encode("utf-8")
-        info = tarfile.TarInfo(name="manifest.json")
-        info.size = len(data)
-        tf.addfile(info, io.BytesIO(data))
-    # 2) zstd
-    cctx = zstd.ZstdCompressor(level=6)
-    with open(tmp_tar, "rb") as src, open(tmp_zst, "wb") as dst:
-        cctx.copy_stream(src, dst)
-    os.remove(tmp_tar)
-    os.replace(tmp_zst, package_path)
-
-def get_or_build_package(study_uid: str, file_list: Iterable[str]) -> FileResponse:
-    # file_list: absolute paths to dicom files belonging to the study
+def _tar_info(name: str, size: int, mtime: int) -> tarfile.TarInfo:
+    info = tarfile.TarInfo(name=name)
+    info.size = size
+    info.mtime = mtime
+    info.mode = 0o644
+    return info
+
+def _write_member(out: BinaryIO, info: tarfile.TarInfo, src: BinaryIO | bytes):
+    # член tar без маркера конца архива: заголовок, данные, добивка до 512 байт
+    out.write(info.tobuf(tarfile.DEFAULT_FORMAT, "utf-8", "surrogateescape"))
+    if isinstance(src, bytes):
+        out.write(src)
+    else:
+        tarfile.copyfileobj(src, out, info.size)
+    pad = -info.size % tarfile.BLOCKSIZE
+    if pad:
+        out.write(tarfile.NUL * pad)
+
+class _Tee:
+    """Пишет одновременно в архив и в файл кэша серии."""
+
+    def __init__(self, *targets: BinaryIO):
+        self.targets = targets
+
+    def write(self, data) -> int:
+        for t in self.targets:
+            t.write(data)
+        return len(data)
+
+class _Timed:
+    """Считает время внутри write: сжатие zstd (с PACK_THREADS — ожидание его потоков) и запись дальше."""
+
+    def __init__(self, target: BinaryIO):
+        self.target = target
+        self.seconds = 0.0
+
+    def write(self, data) -> int:
+        t = time.perf_counter()
+        n = self.target.write(data)
+        self.seconds += time.perf_counter() - t
+        return n
+
+class SeriesPart(NamedTuple):
+    series_uid: str
+    files: list[PackFile]
+    chunk_path: Path | None = None  # кадр серии в кэше; None — не кэшировать
+
+def write_series_frame(out: BinaryIO, files: Iterable[PackFile], progress: Callable[[int], None] | None = None,
+                       level: int = PACK_LEVEL_MIXED, threads: int = PACK_THREADS) -> list[tuple[PackFile, int, int]]:
+    """Один независимый кадр zstd с членами tar серии; вернуть (файл, размер, mtime) по порядку."""
+    # progress(size) вызывается после каждого упакованного файла
+    # threads: 0 — сжатие в вызывающем потоке, -1 — по числу ядер
+    written = []
+    cctx = zstd.ZstdCompressor(level=level, threads=threads)
+    read_s = tar_s = 0.0
+    with cctx.stream_writer(out, closefd=False) as raw:
+        zw = _Timed(raw)
+        # размер и mtime берём из индекса, содержимое читается заранее пулом потоков
+        t = time.perf_counter()
+        for item in read_ahead(files, PREFETCH_THREADS, PREFETCH_BYTES, PREFETCH_MAX_FILE):
+            t0, z0 = time.perf_counter(), zw.seconds
+            read_s += t0 - t  # ждали упреждающее чтение
+            size = item.size
+            if item.data is not None:
+                _write_member(zw, _tar_info(item.file.rel, size, item.mtime), item.data)
+                tar_s += time.perf_counter() - t0 - (zw.seconds - z0)
+            else:
+                with open(item.file.path, "rb") as src:
+                    size = os.fstat(src.fileno()).st_size
+                    _write_member(zw, _tar_info(item.file.rel, size, item.mtime), src)
+                # крупный файл читается по ходу записи члена tar
+                read_s += time.perf_counter() - t0 - (zw.seconds - z0)
+            written.append((item.file, size, item.mtime))
+            if progress:
+                progress(size)
+            t = time.perf_counter()
+        t = time.perf_counter()
+    # закрытие кадра дожимает остаток сжатия
+    compress_s = zw.seconds + time.perf_counter() - t
+    record(PACKAGE_PHASE, read_s, phase="read")
+    record(PACKAGE_PHASE, tar_s, phase="tar")
+    record(PACKAGE_PHASE, compress_s, phase="compress")
+    return written
+
+def _write_tail(out: BinaryIO, manifest: list[dict]):
+    # последний кадр: manifest.json и маркер конца tar
+    data = json.dumps({"version": ARCHIVE_VERSION, "generated": int(time.time()), "files": manifest},
+                      ensure_ascii=False).encode("utf-8")
+    with zstd.ZstdCompressor(level=3).stream_writer(out, closefd=False) as zw:
+        _write_member(zw, _tar_info("manifest.json", len(data), int(time.time())), data)
+        zw.write(tarfile.NUL * tarfile.BLOCKSIZE * 2)
+
+def _copy_chunk(out: BinaryIO, chunk_path: Path) -> bool:
+    try:
+        with open(chunk_path, "rb") as src:
+            shutil.copyfileobj(src, out, CHUNK_SIZE)
+        return True
+    except FileNotFoundError:
+        return False  # кадр вытеснили между lookup и open — соберём заново
+
+def write_package(fp: BinaryIO, parts: Iterable[SeriesPart], progress: Callable[[int], None] | None = None,
+                  level: int = PACK_LEVEL_MIXED, threads: int = PACK_THREADS):
+    """Архив .tar.zst как склейка кадров zstd по сериям плюс кадр с манифестом.
+
+    Готовые кадры серий берутся из кэша серий как есть, сжимаются только новые
+    (новая серия с chunk_path пишется и в архив, и в кадр кэша).
+    Склейка кадров — обычный поток zstd, `zstd -d` и распаковщики читают его целиком.
+    """
+    manifest = []
+    for part in parts:
+        if part.chunk_path is not None and series_cache.lookup(part.chunk_path) and _copy_chunk(fp, part.chunk_path):
+            for f in part.files:
+                manifest.append(_manifest_entry(f.rel, f.size, f.mtime, part.series_uid))
+                if progress:
+                    progress(f.size or 0)
+            continue
+        if part.chunk_path is None:
+            written = write_series_frame(fp, part.files, progress, level, threads)
+        else:
+            partial = part.chunk_path.with_name(f"{part.chunk_path.name}.{os.getpid()}.{threading.get_ident():x}.partial")
+            try:
+                with open(partial, "wb") as chunk:
+                    written = write_series_frame(_Tee(fp, chunk), part.files, progress, level, threads)
+                os.replace(partial, part.chunk_path)
+            except BaseException:
+                _remove(partial)
+                raise
+            series_cache.add(part.chunk_path)
+        for f, size, mtime in written:
+            manifest.append(_manifest_entry(f.rel, size, mtime, part.series_uid))
+    _write_tail(fp, manifest)
+
+def write_tar_zst(fp: BinaryIO, files: Iterable[PackFile], progress: Callable[[int], None] | None = None,
+                  level: int = PACK_LEVEL_MIXED, threads: int = PACK_THREADS):
+    # набор файлов без разбиения на серии и без кэша кадров
+    write_package(fp, [SeriesPart("", list(files))], progress, level, threads)
+
+def build_tar_zst(package_path: Path, base_dir: Path, files: Iterable[PackFile], level: int = PACK_LEVEL_MIXED):
+    tmp_zst = package_path.with_name(package_path.name + ".partial")
+    try:
+        with open(tmp_zst, "wb") as dst:
+            write_tar_zst(dst, files, level=level)
+        os.replace(tmp_zst, package_path)
+    except BaseException:
+        _remove(tmp_zst)
+        raise
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def package_etag(name: str, mtime: float) -> str:
+    # ETag архива: имя + mtime в секундах. Сборка выставляет mtime заранее,
+    # поэтому потоковая выдача и готовый файл кэша получают один и тот же ETag
+    return '"' + hashlib.md5(f"{name}:{int(mtime)}".encode("utf-8")).hexdigest() + '"'
+
+class PackageFileResponse(FileResponse):
+    """FileResponse со стабильным ETag архива; If-Range сверяется именно с ним."""
+
+    def __init__(self, path: Path, filename: str):
+        st = os.stat(path)
+        super().__init__(str(path), media_type="application/zstd", filename=filename, stat_result=st,
+                         headers={"etag": package_etag(path.name, st.st_mtime)})
+
+    def _should_use_range(self, http_if_range: str, stat_result: os.stat_result) -> bool:
+        return http_if_range in (self.headers["etag"], formatdate(stat_result.st_mtime, usegmt=True))
+
+class PackageBuild:
+    """Фоновая сборка архива в .partial-файл кэша.
+
+    Читатели (`iter_chunks`) идут по растущему файлу следом за сборкой,
+    поэтому клиент получает первые байты сразу, а архив пишется на диск один раз.
+    """
+
+    def __init__(self, package_path: Path, parts: Iterable[SeriesPart],
+                 on_done: Callable[["PackageBuild"], None] | None = None, total_bytes: int = 0,
+                 level: int = PACK_LEVEL_MIXED):
+        self.package_path = package_path
+        self.level = level
+        # имя .partial уникально на процесс и сборку: сервер и индексатор не пишут в один файл
+        self.partial_path = package_path.with_name(f"{package_path.name}.{os.getpid()}.{id(self):x}.partial")
+        self.parts = list(parts)
+        # прогресс сборки: читается без блокировок (целые присваивания атомарны под GIL)
+        self.files_total = sum(len(p.files) for p in self.parts)
+        self.bytes_total = total_bytes
+        self.files_done = 0
+        self.bytes_done = 0
+        self.started: float | None = None
+        self.finished: float | None = None
+        self.stamp = int(time.time())
+        self.etag = package_etag(package_path.name, self.stamp)
+        self.done = threading.Event()
+        self.error: BaseException | None = None
+        # фазы read/tar/compress этой сборки: у потока сборки нет контекста запроса
+        self.timings: dict[str, float] = {}
+        self._on_done = on_done
+        self._lock = threading.Lock()
+        # файл создаём заранее, чтобы читатель мог открыть его до первых байт
+        self._fp = open(self.partial_path, "wb")
+
+    def _advance(self, size: int):
+        self.files_done += 1
+        self.bytes_done += size
+
+    def run(self):
+        self.started = time.time()
+        try:
+            with self._fp, phase_timings(self.timings):
+                write_package(self._fp, self.parts, progress=self._advance, level=self.level)
+            os.utime(self.partial_path, (self.stamp, self.stamp))
+            with self._lock:
+                os.replace(self.partial_path, self.package_path)
+        except BaseException as e:
+            self.error = e
+            try:
+                os.remove(self.partial_path)
+            except OSError:
+                pass
+        finally:
+            self.finished = time.time()
+            PACKAGE_BUILDS.inc(result="error" if self.error is not None else "ok")
+            PACKAGE_BUILD_SECONDS.observe(self.finished - self.started)
+            PACKAGE_BUILD_BYTES.inc(self.bytes_done)
+            self.done.set()
+            if self._on_done:
+                self._on_done(self)
+
+    def start(self) -> "PackageBuild":
+        threading.Thread(target=self.run, name=f"package-{self.package_path.name}", daemon=True).start()
+        return self
+
+    def open_reader(self) -> BinaryIO:
+        # после os.replace .partial уже нет — тогда читаем готовый архив
+        with self._lock:
+            if self.done.is_set() and self.error is None:
+                return open(self.package_path, "rb")
+            return open(self.partial_path, "rb")
+
+    def iter_chunks(self, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        with self.open_reader() as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if chunk:
+                    yield chunk
+                    continue
+                if self.done.is_set():
+                    # сборка закончилась — дочитываем хвост
+                    tail = f.read()
+                    if tail:
+                        yield tail
+                        continue
+                    if self.error is not None:
+                        raise RuntimeError(f"package build failed: {self.error}") from self.error
+                    return
+                self.done.wait(0.05)
+
+class BuildCoordinator:
+    """Single-flight сборок: одна сборка на архив, остальные запросы к ней присоединяются.
+
+    Плюс ограниченный пул предсборки для свежепроиндексированных исследований.
+    """
+
+    def __init__(self, cache: PackageCache, prebuild_workers: int = PREBUILD_WORKERS,
+                 prebuild_queue: int = PREBUILD_QUEUE):
+        self.cache = cache
+        self._builds: dict[Path, PackageBuild] = {}
+        self._lock = threading.Lock()
+        self._prebuild_workers = prebuild_workers
+        self._prebuild_pool: ThreadPoolExecutor | None = None
+        # ограничение очереди: submit блокируется, пока не освободится слот
+        self._prebuild_slots = threading.BoundedSemaphore(max(prebuild_queue, 1))
+
+    def _forget(self, build: PackageBuild):
+        with self._lock:
+            if self._builds.get(build.package_path) is build:
+                del self._builds[build.package_path]
+        if build.error is None:
+            self.cache.add(build.package_path)
+
+    def acquire(self, package_path: Path, parts: Iterable[SeriesPart],
+                total_bytes: int = 0, level: int = PACK_LEVEL_MIXED) -> tuple[PackageBuild | None, bool]:
+        """Вернуть (сборка, создана_ли_она_здесь); (None, False) — архив уже в кэше."""
+        with self._lock:
+            build = self._builds.get(package_path)
+            if build is not None:
+                return build, False
+            if package_path.exists():
+                return None, False
+            build = PackageBuild(package_path, parts, on_done=self._forget, total_bytes=total_bytes, level=level)
+            self._builds[package_path] = build
+            return build, True
+
+    def ensure(self, package_path: Path, parts: Iterable[SeriesPart],
+               total_bytes: int = 0, level: int = PACK_LEVEL_MIXED) -> PackageBuild | None:
+        # запускает сборку в фоне либо присоединяется к уже идущей
+        build, created = self.acquire(package_path, parts, total_bytes, level)
+        if created:
+            build.start()
+        return build
+
+    def _prebuild(self, study_uid: str):
+        try:
+            instances = study_instances(study_uid)
+            if not instances:
+                return
+            package_path, parts = package_layout(study_uid, instances)
+            build, created = self.acquire(package_path, parts, instances_bytes(instances),
+                                          compression_level(instances))
+            if created:
+                build.run()  # в потоке пула — так пул и ограничивает параллелизм
+            elif build is not None:
+                build.done.wait()
+        finally:
+            self._prebuild_slots.release()
+
+    def prebuild(self, study_uids: Iterable[str]) -> list[Future]:
+        """Поставить исследования в очередь предсборки архивов в CACHE_DIR."""
+        with self._lock:
+            if self._prebuild_pool is None:
+                self._prebuild_pool = ThreadPoolExecutor(max_workers=self._prebuild_workers,
+                                                         thread_name_prefix="prebuild")
+        futs = []
+        for uid in study_uids:
+            self._prebuild_slots.acquire()
+            futs.append(self._prebuild_pool.submit(self._prebuild, uid))
+        return futs
+
+cache = PackageCache(CACHE_DIR, max_bytes=CACHE_MAX_BYTES, policy=CACHE_POLICY)
+# кадры серий: <SeriesUID>.<key>.tar.zst — члены tar без маркера конца, бюджет общий с архивами
+series_cache = PackageCache(SERIES_CACHE_DIR, max_bytes=CACHE_MAX_BYTES, policy=CACHE_POLICY)
+cache.share_budget(series_cache)
+coordinator = BuildCoordinator(cache)
+
+def study_instances(study_uid: str, series_uids: Iterable[str] | None = None) -> list[InstanceRow]:
+    # экземпляры исследования из индекса, по порядку серий; series_uids — только эти серии.
+    # дубликаты по пиксельным данным (instance_aliases) берут файл хранимого экземпляра
+    with timed(PACKAGE_PHASE, phase="query"), ReadSession() as s:
+        stored = (
+            select(Instance.sop_uid.label("sop_uid"), Instance.size_bytes.label("size_bytes"),
+                   Instance.path.label("path"), Instance.transfer_syntax.label("transfer_syntax"),
+                   Instance.mtime.label("mtime"), Instance.series_uid.label("series_uid"))
+            .join(Series, Series.series_uid == Instance.series_uid)
+            .where(Series.study_uid == study_uid)
+        )
+        linked = (
+            select(InstanceAlias.sop_uid, Instance.size_bytes, Instance.path, Instance.transfer_syntax, Instance.mtime,
+                   InstanceAlias.series_uid)
+            .join(Instance, Instance.sop_uid == InstanceAlias.instance_sop_uid)
+            .where(InstanceAlias.study_uid == study_uid)
+        )
+        if series_uids:
+            stored = stored.where(Instance.series_uid.in_(list(series_uids)))
+            linked = linked.where(InstanceAlias.series_uid.in_(list(series_uids)))
+        q = union_all(stored, linked)
+        q = q.order_by(q.selected_columns.series_uid, q.selected_columns.path)
+        return [InstanceRow(*r) for r in stream(s, q)]
+
+def instances_bytes(instances: Iterable[InstanceRow]) -> int:
+    return sum(inst.size_bytes or 0 for inst in instances)
+
+def package_name(study_uid: str, series_uids: Iterable[str] | None = None) -> str:
+    # архив части серий кэшируется отдельно от полного: "<StudyUID>~<хэш набора серий>",
+    # иначе полный архив и выборки вытесняли бы друг друга как версии одного исследования
+    if not series_uids:
+        return study_uid
+    h = hashlib.sha1("\n".join(sorted(set(series_uids))).encode("utf-8")).hexdigest()[:8]
+    return f"{study_uid}~{h}"
+
+def _by_series(instances: Iterable[InstanceRow]) -> dict[str, list[InstanceRow]]:
+    by_series: dict[str, list[InstanceRow]] = {}
+    for inst in instances:
+        by_series.setdefault(inst.series_uid, []).append(inst)
+    return by_series
+
+def _member_name(study_uid: str, inst: InstanceRow) -> str:
+    # раскладка в архиве: StudyUID/SeriesUID/<basename>
+    return f"{study_uid}/{inst.series_uid}/" + os.path.basename(inst.path)
+
+def _set_key(instances: Iterable[InstanceRow]) -> str:
+    return instance_set_key(((inst.sop_uid, inst.size_bytes) for inst in instances), ARCHIVE_VERSION)
+
+def package_layout(study_uid: str, instances: Iterable[InstanceRow],
+                   series_uids: Iterable[str] | None = None) -> tuple[Path, list[SeriesPart]]:
+    instances = list(instances)
+    # кадр серии ключуется её экземплярами; без SERIES_CACHE кадры не кэшируются
+    parts = []
+    for series_uid, rows in _by_series(instances).items():
+        files = [PackFile(_member_name(study_uid, inst), inst.path, inst.size_bytes, inst.mtime) for inst in rows]
+        chunk_path = series_cache.path_for(series_uid, _set_key(rows)) if SERIES_CACHE else None
+        parts.append(SeriesPart(series_uid, files, chunk_path))
+    # ключ архива — набор экземпляров: новые серии дают новый архив
+    return cache.path_for(package_name(study_uid, series_uids), _set_key(instances)), parts
+
+def package_manifest(study_uid: str, instances: Iterable[InstanceRow]) -> dict:
+    """Манифест архива исследования по индексу, без сборки и чтения файлов.
+
+    Состав — как у manifest.json в архиве, плюс ключи архива и серий: по ним клиент
+    видит, что исследование не изменилось, или докачивает только изменившиеся серии.
+    """
+    instances = list(instances)
+    series, files = [], []
+    for series_uid, rows in _by_series(instances).items():
+        series.append({"series_uid": series_uid, "key": _set_key(rows), "files": len(rows),
+                       "bytes": instances_bytes(rows)})
+        files.extend(_manifest_entry(_member_name(study_uid, inst), inst.size_bytes, inst.mtime, series_uid)
+                     for inst in rows)
+    return {"version": ARCHIVE_VERSION, "study_uid": study_uid, "key": _set_key(instances),
+            "series": series, "files": files}
+
+def get_or_build_package(study_uid: str, instances: Iterable[InstanceRow], ranged: bool = False,
+                         series_uids: Iterable[str] | None = None):
+    # instances: экземпляры исследования (или выбранных серий series_uids)
+    # ranged: клиент прислал Range — отдаём только готовый файл (нужна известная длина)
     os.makedirs(CACHE_DIR, exist_ok=True)
-    # разложим в архиве как StudyUID/<basename>
-    rel_abs = [(f"{study_uid}/" + os.path.basename(p), p) for p in file_list]
-    # ключ архива — study_uid
-    package_path = Path(CACHE_DIR) / f"{study_uid}.tar.zst"
-    if not package_path.exists():
-        build_tar_zst(package_path, Path("/"), rel_abs)
-    return FileResponse(str(package_path), media_type="application/zstd", filename=f"{study_uid}.tar.zst")
+    instances = list(instances)
+    package_path, parts = package_layout(study_uid, instances, series_uids)
+    filename = f"{study_uid}.tar.zst"
+    if cache.lookup(package_path):
+        return PackageFileResponse(package_path, filename)
+    build = coordinator.ensure(package_path, parts, instances_bytes(instances), compression_level(instances))
+    if build is not None and (ranged or not PACKAGE_STREAMING):
+        build.done.wait()
+        if build.error is not None:
+            raise build.error
+        # ответ ещё не начат — фазы сборки попадут в Server-Timing
+        add_timings(build.timings)
+        build = None
+    if build is None:
+        return PackageFileResponse(package_path, filename)
+    # потоковый режим: отдаём архив по мере сборки; параллельные запросы читают ту же сборку.
+    # ETag совпадёт с ETag будущего файла кэша — после обрыва клиент докачает его через If-Range
+    return StreamingResponse(
+        build.iter_chunks(),
+        media_type="application/zstd",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"', "ETag": build.etag},
+    )
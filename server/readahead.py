@@ -0,0 +1,67 @@
+"""Упреждающее чтение исходных файлов для упаковщика.
+
+На NAS (NFS/SMB) упаковку тысяч мелких срезов ограничивает задержка на
+каждый файл, а не полоса. Следующие файлы открываются и читаются пулом
+потоков заранее, в пределах бюджета по байтам, а писателю tar отдаются
+строго в исходном порядке. Крупные файлы не буферизуются целиком —
+писатель читает их сам, потоком.
+"""
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Iterable, Iterator, NamedTuple
+
+class PackFile(NamedTuple):
+    rel: str                 # путь внутри архива
+    path: str                # путь к исходному файлу
+    size: int | None = None  # из индекса; None — неизвестен
+    mtime: int | None = None
+
+class Loaded(NamedTuple):
+    file: PackFile
+    data: bytes | None  # None — файл крупный, читать потоком
+    size: int
+    mtime: int
+
+def _load(f: PackFile, max_file: int) -> Loaded:
+    with open(f.path, "rb") as fp:
+        size, mtime = f.size, f.mtime
+        if size is None or mtime is None:
+            st = os.fstat(fp.fileno())
+            size = st.st_size if size is None else size
+            mtime = int(st.st_mtime) if mtime is None else mtime
+        if size > max_file:
+            return Loaded(f, None, size, mtime)
+        # читаем до конца: размер в индексе мог устареть, верим прочитанному
+        data = fp.read()
+    return Loaded(f, data, len(data), mtime)
+
+def read_ahead(files: Iterable[PackFile], workers: int = 8, budget: int = 256 * 1024 * 1024,
+               max_file: int = 64 * 1024 * 1024) -> Iterator[Loaded]:
+    """Файлы по порядку с уже прочитанным содержимым; workers <= 0 — без упреждения."""
+    if workers <= 0:
+        for f in files:
+            yield _load(f, max_file)
+        return
+    it = iter(files)
+    pending: deque[tuple[Future, int]] = deque()
+    in_flight = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="readahead") as ex:
+        try:
+            while True:
+                # держим очередь полной: не больше budget байт и не больше 4 задач на поток
+                while len(pending) < workers * 4 and (in_flight < budget or not pending):
+                    f = next(it, None)
+                    if f is None:
+                        break
+                    cost = min(f.size or 0, max_file)
+                    pending.append((ex.submit(_load, f, max_file), cost))
+                    in_flight += cost
+                if not pending:
+                    return
+                fut, cost = pending.popleft()
+                in_flight -= cost
+                yield fut.result()
+        finally:
+            for fut, _ in pending:
+                fut.cancel()
@@ -0,0 +1,8 @@
+import os, sys, tempfile
+
+# server.config читает окружение при импорте: БД, хранилище и кэш тестов — во временном каталоге
+_tmp = tempfile.mkdtemp(prefix="dicom-tests-")
+os.environ.setdefault("DB_URL", f"sqlite:///{_tmp}/index.sqlite3")
+os.environ.setdefault("DICOM_ROOT", os.path.join(_tmp, "studies"))
+os.environ.setdefault("CACHE_DIR", os.path.join(_tmp, "cache"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
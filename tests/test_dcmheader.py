@@ -0,0 +1,92 @@
+"""Быстрый разбор заголовка и хеш пиксельных данных против pydicom."""
+import hashlib, io
+import pytest
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.encaps import encapsulate
+from pydicom.uid import (ExplicitVRBigEndian, ExplicitVRLittleEndian, ImplicitVRLittleEndian, RLELossless,
+                         CTImageStorage, PYDICOM_IMPLEMENTATION_UID)
+from server.dcmheader import PixelHasher, _Unsupported, _parse, parse_header_bytes, pixel_sha256
+
+PIXELS = bytes(range(256)) * 32  # 64x64, 16 бит
+FRAGMENTS = [b"\x01\x02" * 700, b"\x03" * 333 + b"\x00"]
+
+def _dataset(ts, suffix: str = "") -> Dataset:
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = CTImageStorage
+    ds.file_meta.MediaStorageSOPInstanceUID = "1.2.3.4.5" + suffix
+    ds.file_meta.TransferSyntaxUID = ts
+    ds.file_meta.ImplementationClassUID = PYDICOM_IMPLEMENTATION_UID
+    ds.SpecificCharacterSet = "ISO_IR 192"
+    ds.SOPClassUID = CTImageStorage
+    ds.SOPInstanceUID = "1.2.3.4.5" + suffix
+    ds.StudyDate = "20240131"
+    ds.Modality = "CT"
+    # последовательность неопределённой длины до нужных тегов — быстрый разбор её пропускает
+    ref = Dataset()
+    ref.ReferencedSOPClassUID = CTImageStorage
+    ref.ReferencedSOPInstanceUID = "1.2.3.9"
+    ds.ReferencedImageSequence = [ref]
+    ds.PatientName = "Иванов^Иван^Иванович"
+    ds.PatientID = "P0001"
+    ds.PatientBirthDate = "19700101"
+    ds.PatientSex = "M"
+    ds.StudyInstanceUID = "1.2.3" + suffix
+    ds.SeriesInstanceUID = "1.2.3.4" + suffix
+    ds.Rows = ds.Columns = 64
+    ds.BitsAllocated = ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.SamplesPerPixel = 1
+    ds.PixelRepresentation = 0
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    if ts.is_compressed:
+        ds.PixelData = encapsulate(FRAGMENTS)
+        ds["PixelData"].VR = "OB"
+    else:
+        ds.PixelData = PIXELS
+        ds["PixelData"].VR = "OW"
+    return ds
+
+def _bytes(ds: Dataset, trailing: bool = False) -> bytes:
+    if trailing:
+        # заполнитель в конце набора данных (FFFC,FFFC) — в хеш входить не должен
+        ds.DataSetTrailingPadding = b"\x00" * 64
+    buf = io.BytesIO()
+    ts = ds.file_meta.TransferSyntaxUID
+    ds.save_as(buf, implicit_vr=ts.is_implicit_VR, little_endian=ts.is_little_endian, enforce_file_format=True)
+    return buf.getvalue()
+
+SYNTAXES = [ImplicitVRLittleEndian, ExplicitVRLittleEndian, ExplicitVRBigEndian, RLELossless]
+
+@pytest.mark.parametrize("ts", SYNTAXES, ids=lambda ts: ts.name)
+def test_fast_header_matches_pydicom(ts):
+    data = _bytes(_dataset(ts))
+    if ts.is_little_endian:
+        _parse(data)  # поддерживаемый синтаксис разбирается без pydicom
+    else:
+        with pytest.raises(_Unsupported):
+            _parse(data)
+    fast = parse_header_bytes(data, "x.dcm", 7)
+    slow = parse_header_bytes(data, "x.dcm", 7, fast=False)
+    assert fast == slow
+    assert (fast.patient_name, fast.study_uid, fast.transfer_syntax) == ("Иванов^Иван^Иванович", "1.2.3", ts)
+
+def _chunked(data: bytes, n: int) -> str | None:
+    h = PixelHasher()
+    for i in range(0, len(data), n):
+        h.update(data[i:i + n])
+    return h.hexdigest()
+
+@pytest.mark.parametrize("ts", [ImplicitVRLittleEndian, ExplicitVRLittleEndian, RLELossless], ids=lambda ts: ts.name)
+def test_pixel_hash_ignores_header_and_trailing_elements(ts):
+    plain = _bytes(_dataset(ts))
+    digest = pixel_sha256(plain)
+    assert digest is not None
+    if not ts.is_compressed:
+        assert digest == hashlib.sha256(PIXELS).hexdigest()
+    # новые UID и элементы после Pixel Data хеш не меняют, как и нарезка на куски
+    reburned = _bytes(_dataset(ts, ".9"), trailing=True)
+    for n in (1, 7, 100, 4096, len(reburned)):
+        assert _chunked(reburned, n) == digest
+    # обрезанный файл хеша не даёт
+    assert pixel_sha256(plain[:-10]) is None
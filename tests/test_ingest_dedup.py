@@ -0,0 +1,54 @@
+"""Диск, перезаписанный с новыми UID: снимки не копируются, но исследование ищется и упаковывается."""
+import io, tarfile
+from pathlib import Path
+import pydicom
+import zstandard as zstd
+from sqlalchemy import select
+from benchmarks.generate import Layout, generate
+from server.db import ReadSession, Study, ensure_schema
+from server.ingest.ingest import ingest_tree
+from server.packager import package_layout, study_instances, write_package
+
+def _reburn(src: Path, dst: Path) -> str:
+    # те же пиксели и пациент, новые Study/Series/SOP UID — как при повторной записи диска
+    study_uid = None
+    for p in sorted(src.rglob("*.dcm")):
+        ds = pydicom.dcmread(p)
+        ds.StudyInstanceUID = study_uid = ds.StudyInstanceUID + ".9"
+        ds.SeriesInstanceUID = ds.SeriesInstanceUID + ".9"
+        ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID + ".9"
+        out = dst / p.relative_to(src)
+        out.parent.mkdir(parents=True, exist_ok=True)
+        ds.save_as(out)
+    return study_uid
+
+def test_reburned_disc_is_linked_and_packaged(tmp_path):
+    ensure_schema()
+    first = tmp_path / "first"
+    list(generate(first, Layout(patients=1, studies=1, series=2, instances=3)))
+    added, _, dup, err, _ = ingest_tree(first)
+    assert (added, dup, err) == (6, 0, 0)
+
+    second = tmp_path / "second"
+    study_uid = _reburn(first, second)
+    added, _, dup, err, touched = ingest_tree(second)
+    assert (added, dup, err) == (0, 6, 0)
+    assert study_uid in touched
+
+    with ReadSession() as s:
+        study = s.execute(select(Study).where(Study.study_uid == study_uid)).scalar_one()
+        assert (study.files, study.series_count) == (6, 2)
+        assert study.bytes > 0
+
+    instances = study_instances(study_uid)
+    assert len(instances) == 6
+    assert all(Path(inst.path).exists() for inst in instances)
+    _, parts = package_layout(study_uid, instances)
+    buf = io.BytesIO()
+    write_package(buf, parts, threads=0)
+    buf.seek(0)
+    with zstd.ZstdDecompressor().stream_reader(buf, read_across_frames=True) as reader, \
+            tarfile.open(fileobj=reader, mode="r|") as tf:
+        names = [m.name for m in tf if m.name != "manifest.json"]
+    assert len(names) == 6
+    assert all(n.startswith(study_uid + "/") for n in names)